@@ -7,6 +7,8 @@ from celery import Celery # Tasks/job management.
 from celery.task.control import inspect # Task Statuses.
 import dlw_run # The carbon risk simulator.
 import sqlite3 as sq3 # Store and retrieve data parameters and results.
+import configparser # For the output path of the surrogate.
+import dlw_surrogate # Fast SCC queries.
 
 # To start the web app, execute the steps in the following order from the
 # project's root directory:
@@ -43,6 +45,9 @@ app.config['CELERY_RESULT_BACKEND'] = 'amqp://'
 # TODO: NJ: Add try, except and finally handlers.
 celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'], backend=app.config['CELERY_RESULT_BACKEND'])
 
+# Surrogate of the model for fast SCC queries, trained on first use.
+surrogate = None
+
 # =======================================
 # DATA MODEL FUNCTIONS
 # =======================================
@@ -229,6 +234,36 @@ def package(task_id):
     print("DEBUG: ", task_status(task_id))
     return render_template('package_details.html', details=details)
     
+@app.route('/scc/', methods=['GET'])
+@requires_auth
+def scc_query():
+    '''
+    Answers a query for the SCC and first period mitigation, eg /scc/?ra=5&eis=.8
+    from the surrogate in milliseconds, with standard errors. A query outside the
+    region the surrogate can be trusted in queues a model job instead, whose
+    status is at the returned location.
+    '''
+    global surrogate
+    if surrogate is None:
+        config = configparser.ConfigParser()
+        config.read('settings.config')
+        surrogate = dlw_surrogate.scc_surrogate(config['DEFAULT']['output_path'])
+    point = {}
+    for name in dlw_surrogate.query_names:
+        if request.args.get(name) is not None:
+            point[name] = float(request.args.get(name))
+    if 'tp1' in point:
+        point['tp1'] = int(point['tp1'])
+
+    def queue_job(point):
+        task = dlw_run.run_point.apply_async(args=[point])
+        return {'task_id': task.id}
+
+    answer = surrogate.query(point, fallback=queue_job)
+    if answer['source'] == 'model':
+        return jsonify(answer), 202, {'Location': url_for('task_status', task_id=answer['task_id'])}
+    return jsonify(answer)
+
 if __name__ == '__main__':
     app.run(debug=True)
 
@@ -0,0 +1,93 @@
+'''
+   Benchmarks of the accuracy per compute of trees of different branching
+   every tree is solved from the same start with the same Monte Carlo draws, the run time, the time of one gradient and the SCC
+   are recorded, and the SCC of each tree is compared with the SCC of the tree with the most final states in the run
+
+   usage: python branching_benchmarks.py [draws] [shape names ...]
+'''
+import sys
+import json
+import time
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+import dlw_utility as fm
+from dlw_tree_class import tree_model
+from dlw_damage_class import damage_model
+from dlw_cost_class import cost_model
+from dlw_optimize_class import optimize_plan
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+'''  the tree shapes compared, first period mitigation is decided for the first 30 years in all of them '''
+tree_shapes = [ { 'name' : 'binary5', 'branching' : 2, 'nperiods' : 5, 'decision_times' : [ 0, 30, 85, 185, 285, 385] },
+                { 'name' : 'binary6', 'branching' : 2, 'nperiods' : 6, 'decision_times' : [ 0, 30, 45, 85, 185, 285, 385] },
+                { 'name' : 'trinomial4', 'branching' : 3, 'nperiods' : 4, 'decision_times' : [ 0, 30, 85, 185, 385] },
+                { 'name' : 'trinomial5', 'branching' : 3, 'nperiods' : 5, 'decision_times' : [ 0, 30, 85, 185, 285, 385] } ]
+
+def build_models(shape, draws):
+    '''    the tree, damage and cost models of a tree shape, the damage simulation is seeded so every shape sees the same draws
+    '''
+    branching = shape['branching']
+    nperiods = shape['nperiods']
+    my_tree = tree_model(tp1=shape['decision_times'][1], analysis=1, final_states=branching**(nperiods-1), nperiods=nperiods,
+                         x_dim=sum([ branching**p for p in range(0, nperiods) ]), branching=branching, decision_times=list(shape['decision_times']))
+    np.random.seed(0)
+    my_damage_model = damage_model(my_tree=my_tree, draws=draws)
+    my_damage_model.damage_function_initialization()
+    my_damage_model.initialize_tree()
+    my_damage_model.dfc = my_damage_model.damage_function_interpolation()
+    my_cost_model = cost_model(tree=my_tree)
+    return my_tree, my_damage_model, my_cost_model
+
+def run_shape(shape, draws, maxfun=600):
+    '''Solves the model on one tree shape
+
+    Returns
+    -------
+    result : dict
+        the shape, 'final_states', 'nodes', 'utility_nodes', 'gradient_time', 'run_time', 'funcalls', 'fit' and 'scc'
+    '''
+    my_tree, my_damage_model, my_cost_model = build_models(shape, draws)
+    my_optimization = optimize_plan(my_tree=my_tree)
+    my_optimization.set_constraints(constrain=0)
+    args = (my_tree, my_damage_model, my_cost_model)
+    guess = np.zeros(my_tree.x_dim) + .5
+
+    ts = time.time()
+    fm.utility_function(guess, *args)
+    fm.analytic_utility_gradient(guess, *args)
+    gradient_time = time.time() - ts
+
+    ts = time.time()
+    res = fmin_l_bfgs_b( fm.utility_function, guess, fprime=fm.analytic_utility_gradient, factr=1., pgtol=1.0e-5, bounds=my_optimization.xbounds,
+                         maxfun=maxfun, args=args)
+    run_time = time.time() - ts
+    result = dict(shape)
+    result.update({ 'final_states' : my_tree.final_states, 'nodes' : my_tree.x_dim, 'utility_nodes' : my_tree.utility_full_tree,
+                    'gradient_time' : gradient_time, 'run_time' : run_time, 'funcalls' : res[2]['funcalls'], 'fit' : float(res[1]),
+                    'scc' : float(my_cost_model.price_by_state( res[0][0], 0., 0.)) })
+    log.log_it('branching benchmark %s: %i nodes, scc %f, %f seconds' % (shape['name'], my_tree.x_dim, result['scc'], run_time))
+    return result
+
+def run_benchmarks(shapes, draws, output_filename):
+    '''    solves every shape and writes one JSON line per shape, 'scc_error' is the distance from the SCC of the shape with the most final states
+    '''
+    results = [ run_shape(shape, draws) for shape in shapes ]
+    reference = max(results, key=lambda result: result['final_states'])
+    with open(output_filename, 'w') as f:
+        for result in results :
+            result['scc_error'] = abs(result['scc'] - reference['scc'])
+            result['reference'] = reference['name']
+            f.write( json.dumps(result) + '\n' )
+    return results
+
+if __name__ == '__main__':
+    draws = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    names = sys.argv[2:]
+    shapes = [ shape for shape in tree_shapes if not names or shape['name'] in names ]
+    output_filename = "outputs/branching_results_%s.jsonl" % time.strftime("%Y-%m-%d-%H%M%S")
+    for result in run_benchmarks(shapes, draws, output_filename) :
+        log.log_it('%-12s states %4i nodes %4i gradient %8.3f s run %9.2f s scc %9.4f error %8.4f'
+                   % (result['name'], result['final_states'], result['nodes'], result['gradient_time'], result['run_time'], result['scc'], result['scc_error']))
+    log.log_it("Branching benchmarks completed, results in %s" % output_filename)
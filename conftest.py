@@ -0,0 +1,37 @@
+'''
+   pytest fixtures of the dlw model tests
+   the models write their damage matrix to the working directory and read settings.config from it, so every test runs
+   in a directory of its own with an outputs directory and a settings file pointing at it
+'''
+import numpy as np
+import pytest
+from dlw_tree_class import tree_model
+from dlw_damage_class import damage_model
+from dlw_cost_class import cost_model
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+    '''    a working directory with outputs/ and a settings.config whose output path is outputs/
+    '''
+    (tmp_path / 'outputs').mkdir()
+    (tmp_path / 'settings.config').write_text('[DEFAULT]\noutput_path=%s/\n' % (tmp_path / 'outputs'))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def build_models(nperiods=4, branching=2, decision_times=[ 0, 30, 85, 185, 385 ], draws=50, **tree_args):
+    '''    the tree, damage and cost models of a small tree, the damage simulation is seeded so every call sees the same draws
+    '''
+    my_tree = tree_model(tp1=decision_times[1], analysis=1, final_states=branching**(nperiods-1), nperiods=nperiods,
+                         x_dim=sum([ branching**p for p in range(0, nperiods) ]), branching=branching, decision_times=list(decision_times), **tree_args)
+    np.random.seed(1)
+    my_damage_model = damage_model(my_tree=my_tree, draws=draws)
+    my_damage_model.damage_function_initialization()
+    my_damage_model.initialize_tree()
+    my_damage_model.dfc = my_damage_model.damage_function_interpolation()
+    return my_tree, my_damage_model, cost_model(tree=my_tree)
+
+@pytest.fixture
+def models(run_dir):
+    '''    the models of the 4 period binary tree
+    '''
+    return build_models()
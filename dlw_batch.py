@@ -0,0 +1,162 @@
+'''
+   Batch runner for scenario files of the dlw climate model
+   the scenarios of scenarios.xls or benchmark_scenarios.xlsx are grouped by the inputs of the tree and the damage simulation,
+   the tree, damage matrix and interpolation of each group are computed once (see dlw_pipeline), then the optimizations of
+   all scenarios run in a process pool and each result is written as one JSON line as soon as it completes
+
+   usage: python dlw_batch.py [scenario file] [processes]
+'''
+import sys
+import json
+import time
+import queue
+import multiprocessing
+import pandas as pd # For loading the scenario configs.
+import dlw_pipeline
+from dlw_sweep import default_parameters, point_parameters, init_sweep_worker
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+'''  scenario file column (or parm_name) -> pipeline parameter, names already used by the pipeline map to themselves '''
+scenario_names = { 'tree_analysis' : 'analysis', 'tree_final_states' : 'final_states', 'tree_growth' : 'growth', 'tree_ra' : 'ra',
+                   'tree_eis' : 'eis', 'tree_time_pref' : 'time_pref', 'damage_peak_temp' : 'peak_temp',
+                   'damage_disaster_tail' : 'disaster_tail', 'damage_draws' : 'draws', 'cost_g' : 'g', 'cost_a' : 'a',
+                   'cost_join' : 'join', 'cost_max_price' : 'max_price', 'cost_teconst' : 'teconst', 'cost_tescale' : 'tescale' }
+'''  the analysis run_model uses when a scenario does not give one '''
+default_analysis = 4
+
+def scenario_point(values):
+    '''Converts the values of one scenario to pipeline parameters, names the pipeline does not use are skipped
+
+    Parameters
+    ----------
+    values : dict
+        scenario file name -> value
+
+    Returns
+    -------
+    point : dict
+        the pipeline parameters of the scenario, including 'analysis'
+    '''
+    point = { 'analysis' : default_analysis }
+    for name, value in values.items() :
+        name = scenario_names.get(name, name)
+        if name == 'analysis' :
+            point[name] = int(value)
+        elif name in default_parameters :
+            ''' the type of the default, so equal values give equal pipeline hashes '''
+            point[name] = type(default_parameters[name])(value)
+        else :
+            log.log_it('scenario parameter %s not used by the batch runner' % name)
+    return point
+
+def read_scenarios(filename):
+    '''Reads the scenarios from the first sheet of an Excel file
+        a sheet with parm_name and parm_value columns (scenarios.xls) holds one scenario,
+        otherwise each row is a scenario and each column a parameter (benchmark_scenarios.xlsx)
+
+    Returns
+    -------
+    points : list of dict
+        the pipeline parameters of each scenario, see scenario_point
+    '''
+    df_s = pd.read_excel(filename, 0)
+    if 'parm_name' in df_s.columns :
+        return [ scenario_point( dict( zip(df_s.parm_name, df_s.parm_value) ) ) ]
+    return [ scenario_point( row.to_dict() ) for index, row in df_s.iterrows() ]
+
+def upstream_key(point):
+    '''    the hash of the interpolation stage, scenarios with the same key share the tree and the damages
+    '''
+    params = point_parameters(point)
+    return dlw_pipeline.stage_keys(params)['interpolation']
+
+def prepare_group(point, cache_path):
+    '''    computes (or finds) the topology, damage and interpolation artifacts shared by a group of scenarios
+    '''
+    params = point_parameters(point)
+    report = {}
+    dlw_pipeline.prepare_models(params, dlw_pipeline.stage_keys(params), dlw_pipeline.stage_cache(cache_path), report)
+    return report
+
+def run_scenario(index, point, cache_path):
+    '''    runs the pipeline of one scenario, the result is a JSON ready dict
+    '''
+    ts = time.time()
+    scenario = dict(point)
+    analysis = scenario.pop('analysis')
+    outputs, report = dlw_pipeline.run_pipeline(scenario, analysis=analysis, processes=1, cache_path=cache_path)
+    return { 'scenario' : index, 'params' : point, 'scc' : float(outputs['scc']), 'fit' : float(outputs['fit']),
+             'cost_per_ton' : outputs['cost_per_ton'], 'delta_emissions_gigatons' : outputs['delta_emissions_gigatons'],
+             'stages' : report, 'run_time' : time.time() - ts }
+
+def run_batch(points, output_filename, processes=None, cache_path=None):
+    '''Runs a batch of scenarios and streams the results to a JSON lines file
+        the shared artifacts of each group of scenarios are prepared first, one task per group, and the scenarios of a group
+        are scheduled as soon as their group is ready
+
+    Parameters
+    ----------
+    points : list of dict
+        the pipeline parameters of each scenario, see read_scenarios
+
+    output_filename : string
+        the JSON lines file, one record per scenario in completion order
+
+    processes : integer
+        number of worker processes, None uses every core
+
+    cache_path : string
+        directory of the pipeline artifacts, None uses the pipeline default
+
+    Returns
+    -------
+    results : list of dict
+        the records, in scenario order
+    '''
+    if cache_path is None :
+        cache_path = dlw_pipeline.default_cache_path()
+    groups = {}
+    for index, point in enumerate(points) :
+        groups.setdefault( upstream_key(point), [] ).append(index)
+    log.log_it('batch of %i scenarios in %i groups of shared tree and damages' % (len(points), len(groups)))
+
+    completed = queue.Queue()
+    results = [ None ] * len(points)
+    pool = multiprocessing.Pool(processes, initializer=init_sweep_worker, initargs=(multiprocessing.Lock(),))
+    try:
+        for key, members in groups.items() :
+            pool.apply_async( prepare_group, (points[members[0]], cache_path),
+                              callback=lambda report, key=key: completed.put(('group', key, report)), error_callback=completed.put )
+        running = len(groups)
+        with open(output_filename, 'a') as f:
+            while running :
+                message = completed.get()
+                running -= 1
+                if isinstance(message, Exception) :
+                    raise message
+                if message[0] == 'group' :
+                    log.log_it('batch group %s ready: %s' % (message[1], message[2]))
+                    for index in groups[message[1]] :
+                        pool.apply_async( run_scenario, (index, points[index], cache_path),
+                                          callback=lambda record: completed.put(('scenario', record)), error_callback=completed.put )
+                        running += 1
+                else :
+                    record = message[1]
+                    results[ record['scenario'] ] = record
+                    f.write( json.dumps(record) + '\n' )
+                    f.flush()
+                    log.log_it('batch scenario %i: scc %f run time %f' % (record['scenario'], record['scc'], record['run_time']))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+if __name__ == '__main__':
+    scenario_file = sys.argv[1] if len(sys.argv) > 1 else 'benchmark_scenarios.xlsx'
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    output_filename = "outputs/batch_results_%s.jsonl" % time.strftime("%Y-%m-%d-%H%M%S")
+    run_batch(read_scenarios(scenario_file), output_filename, processes=processes)
+    log.log_it("All scenarios completed, results in %s" % output_filename)
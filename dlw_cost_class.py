@@ -62,6 +62,12 @@ class cost_model(object):
         '''
         self.consperton0 = consat0 / tree.bau_emit_level[0]
         self.cost_gradient = np.zeros([self.tree.x_dim, self.tree.x_dim])
+        '''
+            years of technological change by decision period and by node (node 0 has none)
+        '''
+        self.period_tc_years = np.array(self.tree.decision_times[:self.tree.nperiods], dtype=float)
+        self.period_tc_years[0] = 0.
+        self.tc_years = self.period_tc_years[np.array(self.tree.period_map)]
         log.log_it('Exogenous technological change = %f  Endogenous technological change = %f' % (teconst, tescale))
 
     def cost_by_state( self, mitigation, average_mitigation, node):
@@ -302,3 +308,268 @@ class cost_model(object):
         else :
             price = (self.max_price - (self.cbs_k/mitigation)**(1./self.cbs_b)) * te_term
             return price
+
+    def te_term_array( self, average_mitigation, tc_years ):
+        '''Calculates the technological change term for vectors of average mitigation and horizons
+
+        Parameters
+        ----------
+        average_mitigation : float array
+            Average mitigation per year up to each point
+
+        tc_years : float array
+            Years of technological change so far at each point
+
+        Returns
+        -------
+        te_term : float array
+            Multiplier applied to the cost and price curves
+        '''
+        return ( 1. - ((self.teconst + self.tescale * np.asarray(average_mitigation, dtype=float))/100))**tc_years
+
+    def backstop_extension_array( self, mitigation ):
+        '''Calculates the extension of the cost curve beyond cbs_level, the cost at cbs_level included
+
+        Parameters
+        ----------
+        mitigation : float array
+            Mitigation values, only entries >= cbs_level are meaningful
+
+        Returns
+        -------
+        extension : float array
+            base cost plus backstop extension, zero where mitigation < cbs_level
+        '''
+        mitigation = np.asarray(mitigation, dtype=float)
+        extension = np.zeros(mitigation.shape)
+        above = mitigation >= self.cbs_level
+        m = mitigation[above]
+        extension[above] = (self.g * self.cbs_level**self.a
+                            + (m - self.cbs_level)*self.max_price
+                            - self.cbs_b * m * (self.cbs_k/m)**(1.0/self.cbs_b)/(self.cbs_b-1.)
+                            + self.cbs_b * self.cbs_level * (self.cbs_k/self.cbs_level)**(1.0/self.cbs_b)/(self.cbs_b-1.))
+        return extension
+
+    def cost_by_state_array( self, mitigation, average_mitigation, nodes ):
+        '''Vector version of cost_by_state, calculates the mitigation cost for a set of nodes in one pass
+
+        Parameters
+        ----------
+        mitigation : float array
+            Mitigation value in each node
+
+        average_mitigation : float array
+            Average mitigation per year up to each node
+
+        nodes : integer array
+            nodes in tree for which mitigation cost is calculated
+
+        Returns
+        -------
+        cbs : float array
+            Cost by state
+        '''
+        mitigation = np.asarray(mitigation, dtype=float)
+        te_term = self.te_term_array(average_mitigation, self.tc_years[nodes])
+        base = self.g * np.minimum(mitigation, self.cbs_level)**self.a
+        cbs = np.where(mitigation < self.cbs_level, base, self.backstop_extension_array(mitigation))
+        return cbs * te_term / self.consperton0
+
+    def dd_own_cost_by_state_array( self, mitigation, average_mitigation, tc_years ):
+        '''Vector version of dd_own_cost_by_state
+
+        Parameters
+        ----------
+        mitigation : float array
+            Current mitigation values
+
+        average_mitigation : float array
+            Average mitigation per year up to each point
+
+        tc_years : float array
+            Years of technological change so far
+
+        Returns
+        -------
+        dd_cbs : float array
+            Derivative of the cost by state with respect to own mitigation
+        '''
+        return self.price_by_state_array(mitigation, average_mitigation, tc_years) / self.consperton0
+
+    def dd_am_cost_by_state_array( self, mitigation, average_mitigation, tc_years, d_average_mitigation ):
+        '''Vector version of dd_am_cost_by_state
+
+        Parameters
+        ----------
+        mitigation : float array
+            Current mitigation values
+
+        average_mitigation : float array
+            Average mitigation per year up to each point
+
+        tc_years : float array
+            Years of technological change so far
+
+        d_average_mitigation : float array
+            derivative of average mitigation wrt the mitigation the derivative is taken with respect to
+            (the last axis may carry several such nodes)
+
+        Returns
+        -------
+        dd_cbs : float array
+            Derivative of the cost by state with respect to mitigation in previous periods
+        '''
+        mitigation = np.asarray(mitigation, dtype=float)
+        tc_years = np.asarray(tc_years, dtype=float)
+        te_term1 = tc_years * ( 1. - ((self.teconst + self.tescale * np.asarray(average_mitigation, dtype=float))/100))**(tc_years-1.0)
+        base = self.g * np.minimum(mitigation, self.cbs_level)**self.a
+        cbs = np.where(mitigation < self.cbs_level, base, self.backstop_extension_array(mitigation))
+        dd_term = -te_term1 * self.tescale / 100.0
+        scale = cbs * dd_term / self.consperton0
+        d_average_mitigation = np.asarray(d_average_mitigation, dtype=float)
+        if d_average_mitigation.ndim > scale.ndim :
+            scale = scale[..., np.newaxis]
+        return scale * d_average_mitigation
+
+    def price_by_state_array( self, mitigation, average_mitigation, tc_years ):
+        '''Vector version of price_by_state, gives emissions prices for arrays of mitigation, average_mitigation and horizons
+
+        Parameters
+        ----------
+        mitigation : float array
+            Current mitigation values
+
+        average_mitigation : float array
+            Average mitigation per year up to each point
+
+        tc_years : float array
+            Years of technological change so far
+
+        Returns
+        -------
+        price : float array
+            Emission price per ton CO2 equivalent
+        '''
+        mitigation = np.asarray(mitigation, dtype=float)
+        te_term = self.te_term_array(average_mitigation, tc_years)
+        below = mitigation < self.cbs_level
+        price = np.empty(np.broadcast(mitigation, te_term).shape)
+        m = np.broadcast_to(mitigation, price.shape)
+        below = np.broadcast_to(below, price.shape)
+        price[below] = self.g * self.a * m[below]**(self.a-1.)
+        price[~below] = self.max_price - (self.cbs_k/m[~below])**(1./self.cbs_b)
+        return price * te_term
+
+    def cost_gradient_by_state( self, my_damage_model, x, average_mitigation ):
+        '''Calculates the analytic derivative of cost by state for every node with respect to every mitigation in one pass
+            and stores it in cost_gradient, cost_gradient[emit_node, x_node] matches d_cost_by_state( emit_node, x_node )
+
+        Parameters
+        ----------
+        my_damage_model : damage class object
+            provides the derivatives of average_mitigation wrt x
+
+        x : float array
+            the vector of mitigations
+
+        average_mitigation : float array
+            Average mitigation per year up to each node in the tree
+
+        Returns
+        -------
+        cost_gradient : float array
+            [x_dim] x [x_dim] matrix of derivatives of cost by state wrt mitigation
+        '''
+        x_dim = self.tree.x_dim
+        mitigation = np.asarray(x[:x_dim], dtype=float)
+        average_mitigation = np.asarray(average_mitigation[:x_dim], dtype=float)
+        d_ave = my_damage_model.d_average_mitigation_matrix()
+        self.cost_gradient[:, :] = self.dd_am_cost_by_state_array(mitigation, average_mitigation, self.tc_years, d_ave)
+        diagonal = np.arange(x_dim)
+        self.cost_gradient[diagonal, diagonal] = self.dd_own_cost_by_state_array(mitigation, average_mitigation, self.tc_years)
+        return self.cost_gradient
+
+    def create_price_tables( self, points=2001, max_mitigation=3.0 ):
+        '''Creates a dense monotone table of the emissions price against mitigation, used for vectorized
+            forward (mitigation -> price) and inverse (price -> mitigation) lookups
+            the price curve factors into a function of mitigation times the technological change term,
+            so one table over mitigation serves every decision period and every level of average mitigation,
+            the technological change term is applied exactly
+            the grid is concentrated at low mitigation where the inverse of the price curve is steepest
+
+        Parameters
+        ----------
+        points : integer
+            number of mitigation values in the table
+
+        max_mitigation : float
+            largest mitigation in the table, inverse lookups of higher prices return max_mitigation
+
+        Returns
+        -------
+        price_table_error : float vector
+            accuracy bounds of the table, [ maximum error of price in $ per ton, maximum error of mitigation ]
+            measured at the midpoints of the grid, before the technological change term (which is <= 1 for teconst >= 0)
+        '''
+        self.table_mitigation = max_mitigation * np.linspace(0., 1., points)**2
+        self.table_price = self.price_by_state_array(self.table_mitigation, 0., 0.)
+        '''
+            the accuracy of the linear interpolation is worst between grid points
+        '''
+        mid_mitigation = (self.table_mitigation[1:] + self.table_mitigation[:-1]) / 2.
+        mid_price = self.price_by_state_array(mid_mitigation, 0., 0.)
+        price_error = np.abs(np.interp(mid_mitigation, self.table_mitigation, self.table_price) - mid_price)
+        mitigation_error = np.abs(np.interp(mid_price, self.table_price, self.table_mitigation) - mid_mitigation)
+        self.price_table_error = np.array([ price_error.max(), mitigation_error.max() ])
+        log.log_it('Price table with %i points up to mitigation %f: max price error %e  max mitigation error %e'
+                   % (points, max_mitigation, self.price_table_error[0], self.price_table_error[1]))
+        return self.price_table_error
+
+    def price_by_state_table( self, mitigation, average_mitigation, tc_years ):
+        '''Table lookup version of price_by_state for arrays of mitigation, average_mitigation and horizons
+
+        Parameters
+        ----------
+        mitigation : float array
+            Current mitigation values
+
+        average_mitigation : float array
+            Average mitigation per year up to each point
+
+        tc_years : float array
+            Years of technological change so far, period_tc_years gives the value for each decision period
+
+        Returns
+        -------
+        price : float array
+            Emission price per ton CO2 equivalent
+        '''
+        if getattr(self, 'table_price', None) is None:
+            self.create_price_tables()
+        base_price = np.interp(mitigation, self.table_mitigation, self.table_price)
+        return base_price * self.te_term_array(average_mitigation, tc_years)
+
+    def mitigation_by_price( self, price, average_mitigation, tc_years ):
+        '''Inverse of price_by_state, gives the mitigation that reaches a given emissions price
+            for arrays of prices, average_mitigation and horizons
+
+        Parameters
+        ----------
+        price : float array
+            Emission price per ton CO2 equivalent
+
+        average_mitigation : float array
+            Average mitigation per year up to each point
+
+        tc_years : float array
+            Years of technological change so far, period_tc_years gives the value for each decision period
+
+        Returns
+        -------
+        mitigation : float array
+            mitigation at which the marginal cost equals price, prices beyond the table give the table's max_mitigation
+        '''
+        if getattr(self, 'table_price', None) is None:
+            self.create_price_tables()
+        base_price = np.asarray(price, dtype=float) / self.te_term_array(average_mitigation, tc_years)
+        return np.interp(base_price, self.table_price, self.table_mitigation)
@@ -8,6 +8,9 @@ from dlw_log import LogUtil # For logging. Currently DEBUG use only.
 
 log = LogUtil() # Instanciate the logger utility.
 
+'''  the file the Monte Carlo damage matrix is written to and read from '''
+damage_matrix_file = '\\Users\\Bob Litterman\\Dropbox\\EZ Climate calibration paper\\dlw code\\dlw_damage_matrix'
+
 class damage_model(object):
     '''Includes functions to evaluate the damages for the dlw climate model
     '''
@@ -120,6 +123,14 @@ class damage_model(object):
         self.rb_sigf = [.049921, .033055, .042408 ]
         self.rb_theta = [ 2.304627, 3.333599, 2.356967 ]
         self.damage_function_interpolation_coefficients = np.zeros([self.my_tree.final_states,self.my_tree.nperiods,self.dnum-1,3])
+        '''  damage coefficients of each node, from the damage classes of the recombining tree, see compress_states '''
+        self.node_coefficients = None
+        '''  the directions of a tied plan and the derivatives of average mitigation along them, see set_directions '''
+        self.directions = None
+        self.d_ave_directions = None
+        '''  the damage matrix and state probabilities as simulated, before initialize_tree recombines them '''
+        self.simulated_d = None
+        self.simulated_probs = None
         
         log.log_it("Initializing Damage Function")
         log.log_it("Peak temp parameter = %f Disaster tail parameter = %f" % (self.peak_temp, self.disaster_tail))
@@ -173,8 +184,66 @@ class damage_model(object):
                     '''   solve this system of equations  '''
                     self.damage_function_interpolation_coefficients[state][p][dnum-simul-2] = np.linalg.solve(amat,bmat)
               
+        self.compress_states()
         return(self.damage_function_interpolation_coefficients)
 
+    def partition(self, node):
+        '''
+            the period index (period-1) of the damage coefficients of a node and the partition of final states reachable from it
+            (first_state, last_state), as used by damage_function
+            these are the partitions the model was calibrated with: the nodes after period 3 are matched to a single state and the
+            final states use the damages of period 5, which for the five and six period trees and for shallower trees of any
+            branching are the partitions of the tree
+        '''
+        if( node >= self.my_tree.x_dim ):
+            period = min(5, self.my_tree.nperiods)
+        else :
+            period = self.my_tree.period_map[node]
+        if period <= min(3, self.my_tree.nperiods-2):
+            first_state = self.my_tree.node_mapping[period-1][node - self.my_tree.decision_period_pointer[period]][0]
+            last_state = self.my_tree.node_mapping[period-1][node - self.my_tree.decision_period_pointer[period]][1]
+        elif node < self.my_tree.x_dim :
+            first_state = node - self.my_tree.decision_period_pointer[period]
+            last_state = first_state
+        else :
+            first_state = node - self.my_tree.x_dim
+            last_state = first_state
+        return period-1, first_state, last_state
+
+    def compress_states(self):
+        '''
+            compresses the final states of the recombining tree into damage classes
+            initialize_tree gives every state of the same recombining class (its "d_class", see tree_model.recombining_class) the same damages,
+            so the final states collapse to at most (branching-1)*(nperiods-1)+1 distinct damage profiles; the damage in a node is the probability weighted mixture of the classes
+            of its partition, and since the interpolated damage is linear in the coefficients the mixture is a single quadratic per
+            interpolation piece, whose coefficients are computed here once for every node
+            a tree whose states were not made recombining (rows of coefficients differ within a class) keeps one class per state
+
+        Returns
+        -------
+        node_coefficients : float
+            [full_tree] x [2] x [3] coefficients of the damage of each node below (index 1) and above (index 0) emit_percentage[1]
+        '''
+        final_states = self.my_tree.final_states
+        dfc = self.damage_function_interpolation_coefficients
+        state_class = np.array([ self.my_tree.recombining_class(state) for state in range(0, final_states) ])
+        first_of_class = [ np.where(state_class == k)[0][0] for k in range(0, state_class.max()+1) ]
+        if any( not np.array_equal(dfc[state], dfc[ first_of_class[state_class[state]] ]) for state in range(0, final_states) ):
+            state_class = np.arange(final_states)
+            first_of_class = list(range(0, final_states))
+        class_coefficients = dfc[first_of_class][:, :, 0:2, :]
+
+        self.class_weights = np.zeros([self.my_tree.full_tree, len(first_of_class)])
+        self.node_coefficients = np.zeros([self.my_tree.full_tree, 2, 3])
+        for node in range(1, self.my_tree.full_tree):
+            pm1, first_state, last_state = self.partition(node)
+            for state in range(first_state, last_state+1):
+                self.class_weights[node, state_class[state]] += self.my_tree.probs[state]
+            self.class_weights[node] /= self.class_weights[node].sum()
+            self.node_coefficients[node] = np.tensordot(self.class_weights[node], class_coefficients[:, pm1], axes=1)
+        log.log_it('damage function: %i final states compressed to %i damage classes' % (final_states, len(first_of_class)))
+        return(self.node_coefficients)
+
     def damage_function(self,x,node):
         '''
             Calculates the damages for any given node, for the path of mitigation actions given by the vector x
@@ -193,49 +262,49 @@ class damage_model(object):
         damage : float
             the damages in the state at the given period given mitigation specified
         '''
-        if( node >= self.my_tree.x_dim ):
-            period = 5
-        else :
-            period = self.my_tree.period_map[node]
-
         '''  no damage in period 0 '''
-        if (period == 0):
+        if (node == 0):
             return(0.)
-
-        '''  find the partition of final states reachable from the given node '''
-        if period <= 3:
-            first_state = self.my_tree.node_mapping[period-1][node - self.my_tree.decision_period_pointer[period]][0]
-            last_state = self.my_tree.node_mapping[period-1][node - self.my_tree.decision_period_pointer[period]][1]
-        elif period == 4:
-            first_state = node - self.my_tree.decision_period_pointer[period]
-            last_state = first_state
-        else :
-            first_state = node - self.my_tree.x_dim
-            last_state = first_state
-        pm1 = period-1
+        if self.node_coefficients is None :
+            self.compress_states()
         '''
-            the damage in the given node is the average over all possible future states (that is the partition reachable from this node)
+            the damage in the given node is the average over all possible future states (that is the partition reachable from this node),
+            a mixture of the damage classes of the partition, see compress_states
         '''
-        
         average_mitigation = self.average_mitigation( x, node )
+        if average_mitigation < self.emit_percentage[1] :
+            coefficients = self.node_coefficients[node][1]
+            return(coefficients[0]*average_mitigation**2 + coefficients[1]*average_mitigation + coefficients[2])
+        coefficients = self.node_coefficients[node][0]
+        damage = coefficients[0]*average_mitigation**2 + coefficients[1]*average_mitigation + coefficients[2]
+        if average_mitigation < 1.0 :
+            return(damage)
+        return(.5**(10.0*(average_mitigation-1.0)) * damage)
+
+    def damage_function_array(self, average_mitigation, nodes):
+        '''Vector version of damage_function, calculates the damages in a set of nodes of the given average mitigation in one pass
 
-        sum_prob = 0.
-        damage = 0.
-        for state in range(first_state, last_state+1):
-            prob = self.my_tree.probs[state]
-            sum_prob += prob
-            if average_mitigation < self.emit_percentage[1] :
-                simul = 1
-                damage += prob * (self.damage_function_interpolation_coefficients[state][pm1][simul][0]*average_mitigation**2 + self.damage_function_interpolation_coefficients[state][pm1][simul][1]*average_mitigation + self.damage_function_interpolation_coefficients[state][pm1][simul][2])
-            else :
-                if average_mitigation < 1.0 :
-                    simul = 0
-                    damage += prob * (self.damage_function_interpolation_coefficients[state][pm1][simul][0]*average_mitigation**2 + self.damage_function_interpolation_coefficients[state][pm1][simul][1]*average_mitigation + self.damage_function_interpolation_coefficients[state][pm1][simul][2])
-                else :
-                    simul = 0
-                    damage += prob * .5**(10.0*(average_mitigation-1.0)) * (self.damage_function_interpolation_coefficients[state][pm1][simul][0]*average_mitigation**2 + self.damage_function_interpolation_coefficients[state][pm1][simul][1]*average_mitigation + self.damage_function_interpolation_coefficients[state][pm1][simul][2])
-                    
-        return(damage/sum_prob)
+        Parameters
+        ----------
+        average_mitigation : float array
+            Average mitigation per year up to each node
+
+        nodes : integer array
+            nodes in tree for which the damage is calculated, none of them the first node
+
+        Returns
+        -------
+        damage : float array
+            the damages in the nodes
+        '''
+        if self.node_coefficients is None :
+            self.compress_states()
+        average_mitigation = np.asarray(average_mitigation, dtype=float)
+        below = average_mitigation < self.emit_percentage[1]
+        coefficients = np.where( below[:,None], self.node_coefficients[nodes,1], self.node_coefficients[nodes,0] )
+        damage = coefficients[:,0]*average_mitigation**2 + coefficients[:,1]*average_mitigation + coefficients[:,2]
+        decay = .5**(10.0*(np.maximum(average_mitigation, 1.0)-1.0))
+        return np.where( below, damage, decay * damage )
 
     def d_damage_by_state(self, x, node, j):
         '''
@@ -257,57 +326,55 @@ class damage_model(object):
         damage_derivative : float
             the derivative of the damage function with respect to changes in mitigation
         '''
-        if( node == j ):
-            return( 0 )
-        if( node >= self.my_tree.x_dim ):
-            period = 5
-        else :
-            period = self.my_tree.period_map[node]
-
-        '''  no damage in period 0 '''
-        if (period == 0):
-            return(0.)
-
-        '''  find the partition of final states reachable from the given node '''
-        if period <= 3:
-            first_state = self.my_tree.node_mapping[period-1][node - self.my_tree.decision_period_pointer[period]][0]
-            last_state = self.my_tree.node_mapping[period-1][node - self.my_tree.decision_period_pointer[period]][1]
-        elif period == 4:
-            first_state = node - self.my_tree.decision_period_pointer[period]
-            last_state = first_state
+        if self.d_ave_directions is not None :
+            ''' along direction j of a tied plan, see set_directions '''
+            emissions_deriv = self.d_ave_directions[node, j]
+        elif( node == j or node == 0 ):
+            return( 0. )
         else :
-            first_state = node - self.my_tree.x_dim
-            last_state = first_state
-        pm1 = period-1
-        '''
-            the damage in the given node is the average over all possible future states (that is the partition reachable from this node)
-        '''
+            '''  the damage only depends on the mitigation along the path to the node, most j do not change the average mitigation '''
+            emissions_deriv = self.d_average_mitigation(node, j)
+        if emissions_deriv == 0. :
+            return( 0. )
+        if self.node_coefficients is None :
+            self.compress_states()
         average_mitigation = self.average_mitigation( x, node )
-        sum_prob = 0.
-        d_damage = 0.
-        for state in range(first_state, last_state+1):
-            prob = self.my_tree.probs[state]
-            sum_prob += prob
-            if average_mitigation < self.emit_percentage[1] :
-                simul = 1
-                d_damage += prob * (2.*self.damage_function_interpolation_coefficients[state][pm1][simul][0]*average_mitigation + self.damage_function_interpolation_coefficients[state][pm1][simul][1])
-            else :
-                if average_mitigation < 1. :
-                    simul = 0
-                    d_damage += prob * (2.*self.damage_function_interpolation_coefficients[state][pm1][simul][0]*average_mitigation + self.damage_function_interpolation_coefficients[state][pm1][simul][1])
-                else :
-                    simul = 0
-                    decay = .5**(10.*(average_mitigation-1.))
-                    damage = (self.damage_function_interpolation_coefficients[state][pm1][simul][0]*average_mitigation**2 + self.damage_function_interpolation_coefficients[state][pm1][simul][1]*average_mitigation + self.damage_function_interpolation_coefficients[state][pm1][simul][2])
-                    ddamage = 2*self.damage_function_interpolation_coefficients[state][pm1][simul][0]*average_mitigation + self.damage_function_interpolation_coefficients[state][pm1][simul][1]
-                    ddecay = (-12295127. * 2.**(13.-10.*average_mitigation))/14190495.
-                    d_damage += prob * (damage * ddecay + ddamage * decay)
-
-        d_damage = d_damage / sum_prob
-        emissions_deriv = self.d_average_mitigation(node, j)
+        if average_mitigation < self.emit_percentage[1] :
+            coefficients = self.node_coefficients[node][1]
+            d_damage = 2.*coefficients[0]*average_mitigation + coefficients[1]
+        else :
+            coefficients = self.node_coefficients[node][0]
+            d_damage = 2.*coefficients[0]*average_mitigation + coefficients[1]
+            if average_mitigation >= 1. :
+                decay = .5**(10.*(average_mitigation-1.))
+                damage = coefficients[0]*average_mitigation**2 + coefficients[1]*average_mitigation + coefficients[2]
+                ddecay = (-12295127. * 2.**(13.-10.*average_mitigation))/14190495.
+                d_damage = damage * ddecay + d_damage * decay
 
         return(emissions_deriv * d_damage )
 
+    def set_directions(self, directions):
+        '''Makes d_damage_by_state differentiate along the columns of directions instead of the unit vectors,
+            d_damage_by_state(x, node, j) is then the derivative of damages at node along directions[:, j]
+            (see fm.analytic_utility_gradient), None restores the derivatives wrt mitigation at node j
+
+        Parameters
+        ----------
+        directions : float array
+            [x_dim] x [columns] matrix, or None
+        '''
+        self.directions = directions
+        if directions is None :
+            self.d_ave_directions = None
+            return
+        if getattr(self, 'd_ave_full', None) is None :
+            '''  the derivatives of average mitigation at every node of the tree, the damage at a node does not depend on its own mitigation '''
+            self.d_ave_full = np.zeros([self.my_tree.full_tree, self.my_tree.x_dim])
+            for node in range(1, self.my_tree.full_tree):
+                for j in range(0, min(node, self.my_tree.x_dim)):
+                    self.d_ave_full[node, j] = self.d_average_mitigation(node, j)
+        self.d_ave_directions = np.dot(self.d_ave_full, directions)
+
     def nd_damage_by_state( self, x, node, j ):
         '''
             Calculates and returns the numerical derivative of damage by state
@@ -451,6 +518,23 @@ class damage_model(object):
 
         return(deriv_average_mitigation_wrt_xj)
 
+    def d_average_mitigation_matrix(self):
+        '''Calculates the derivatives of average_mitigation for every node in the decision tree wrt mitigation at every node
+            the derivatives do not depend on the mitigation plan, so the matrix is calculated once and stored
+
+        Returns
+        -------
+        d_ave_mitigation : float
+            [x_dim] x [x_dim] matrix, d_ave_mitigation[node, j] = d_average_mitigation(node, j)
+        '''
+        if getattr(self, 'd_ave_mitigation', None) is None:
+            x_dim = self.my_tree.x_dim
+            self.d_ave_mitigation = np.zeros([x_dim, x_dim])
+            for node in range(0, x_dim):
+                for j in range(0, node+1):
+                    self.d_ave_mitigation[node, j] = self.d_average_mitigation(node, j)
+        return(self.d_ave_mitigation)
+
     def nd_average_mitigation(self, x, node, j):
         '''Calculates the numerical derivative of average_mitigation wrt mitigation at node j
         
@@ -489,47 +573,42 @@ class damage_model(object):
                     in order to create a recombining tree we first calculate the damage by state separately for each state, but then 
                     the damage in the combined state is set equal to the average damage across both 
             '''
+            self.simulated_d = self.d.copy()
+            self.simulated_probs = np.array(self.my_tree.probs, dtype=float)
             nperiods = self.my_tree.nperiods
+            '''  the classes of the states with the same sum of branch indices, see tree_model.recombining_class '''
+            nclasses = (self.my_tree.branching-1)*(nperiods-1)+1
             
-            sum_class = np.zeros(nperiods,dtype=int)
-            new_state = np.zeros( [nperiods, self.my_tree.final_states], dtype=int )
+            sum_class = np.zeros(nclasses,dtype=int)
+            new_state = np.zeros( [nclasses, self.my_tree.final_states], dtype=int )
             temp_prob = np.zeros(self.my_tree.final_states)
             
             for old_state in range(0, self.my_tree.final_states):
                 temp_prob[old_state] = self.my_tree.probs[old_state]
-                binary_rep = np.zeros(nperiods-1)
-                rem = old_state
-                digit = nperiods-2
-                d_class = 0
-                while digit >= 0 :
-                    if rem >= 2**digit :
-                        rem = rem - 2**digit
-                        binary_rep[digit] = 1
-                        d_class += 1
-                    digit = digit - 1
+                d_class = self.my_tree.recombining_class(old_state)
                 sum_class[d_class] += 1
                 new_state[d_class, sum_class[d_class]-1 ] = old_state
 
             old_state = 0
-            prob_sum = np.zeros(nperiods)
-            for d_class in range(0, nperiods):
+            prob_sum = np.zeros(nclasses)
+            for d_class in range(0, nclasses):
                 for i in range(0, sum_class[d_class]):
                     prob_sum[d_class] += self.my_tree.probs[ old_state ]
                     old_state += 1
                     
             for period in range(0, nperiods):
                 for simul in range(0, self.dnum):
-                    d_sum = np.zeros(nperiods)
+                    d_sum = np.zeros(nclasses)
                     old_state = 0
-                    for d_class in range(0, nperiods):
+                    for d_class in range(0, nclasses):
                         for i in range(0, sum_class[d_class]):
                             d_sum[d_class] += self.my_tree.probs[ old_state ] * self.d[ old_state ][ period][simul]
                             old_state += 1
-                    for d_class in range(0, nperiods):
+                    for d_class in range(0, nclasses):
                         for i in range(0, sum_class[d_class]):
                             self.d[ new_state[d_class,i]][period][simul] = d_sum[d_class] / prob_sum[d_class]
             old_state = 0
-            for d_class in range(0, nperiods):
+            for d_class in range(0, nclasses):
                 for i in range(0, sum_class[d_class]):
                     self.my_tree.probs[new_state[d_class,i]] = temp_prob[old_state]
                     old_state += 1
@@ -543,6 +622,40 @@ class damage_model(object):
                         sum_probs += self.my_tree.probs[ns]
                     self.my_tree.node_probs[self.my_tree.node_map[nperiods-2-p][self.my_tree.node_mapping[nperiods-2-p][n][0]]] = sum_probs
         
+    def damage_from_finer_tree(self, fine_damage_model):
+        '''Sets the damage matrix from the simulation of a tree with more periods instead of simulating it,
+            for the coarser trees of a coarse-to-fine optimization (see tree_model.coarse_decision_times)
+            the damage at the end of each period is the damage of the fine tree at the same time, and each state takes the
+            probability weighted damage of the fine states its range of cumulative probability overlaps (the states of both trees
+            are ordered by damage); the fine damage model must have been through initialize_tree, this model then goes through it
+
+        Parameters
+        ----------
+        fine_damage_model : damage_model object
+            the damage model of the finer tree, with the same total time
+        '''
+        if fine_damage_model.simulated_d is None :
+            raise ValueError('the fine damage model has no damage matrix, run initialize_tree first')
+        fine_tree = fine_damage_model.my_tree
+        fine_times = list(fine_tree.decision_times[1:fine_tree.nperiods+1])
+        periods = []
+        for p in range(0, self.my_tree.nperiods):
+            if self.my_tree.decision_times[p+1] not in fine_times :
+                raise ValueError('period %i of the tree does not end at a decision time of the fine tree' % p)
+            periods.append( fine_times.index(self.my_tree.decision_times[p+1]) )
+
+        fine_edges = np.concatenate( [ [0.], np.cumsum(fine_damage_model.simulated_probs) ] )
+        fine_edges /= fine_edges[-1]
+        edges = np.concatenate( [ [0.], np.cumsum(self.my_tree.probs) ] )
+        edges /= edges[-1]
+        overlap = np.maximum( np.minimum(edges[1:,None], fine_edges[None,1:]) - np.maximum(edges[:-1,None], fine_edges[None,:-1]), 0. )
+        weights = overlap / overlap.sum(axis=1)[:,None]
+
+        self.set_simulation_levels()
+        for simul in range(0, self.dnum):
+            self.d[:,:,simul] = np.dot( weights, fine_damage_model.simulated_d[:,periods,simul] )
+        log.log_it('damage matrix of %i states from the simulation of a tree of %i states' % (self.my_tree.final_states, fine_tree.final_states))
+
     def gammaArray(self, shape, rate, dimension):
         scale = 1/rate
         y = np.random.gamma(shape, scale, dimension)
@@ -620,21 +733,8 @@ class damage_model(object):
         log.log_it('  Creating damage coefficients using %i simulations' % (self.draws * self.over * self.monte_loops))
         log.log_it('  Damage coefficients are written to the file: dlw_damage_matrix')
 
-        f = open('\\Users\\Bob Litterman\\Dropbox\\EZ Climate calibration paper\\dlw code\\dlw_damage_matrix', 'w')
-        f.write(str('\n'))
-        f.write( '%15i' % self.my_tree.nperiods + ' ' + '%15i' % self.my_tree.x_dim + ' ' + '%15i' % self.my_tree.final_states)
-        f.write(str('\n'))
-        f.write( '%15i' % self.monte_loops + ' ' + '%15i' % self.draws + ' ' + '%15i' % self.over + ' ' + '%15i' % self.tip_on)
-        f.write(str('\n'))
-        f.write( '%15f' % self.disaster_tail + ' ' + '%15f' % self.peak_temp + ' ' + '%15f' % self.temp_map + ' ' + '%15f' % self.my_tree.growth)
-        f.write(str('\n'))
-        for i in range(0, self.my_tree.final_states):
-            f.write( '%12f' % self.my_tree.probs[i])
-        f.write(str('\n'))
-        for i in range(0, self.my_tree.nperiods+1):
-            f.write( '%12f' % self.my_tree.decision_times[i])
-            
-        f.write(str('\n'))
+        f = open(damage_matrix_file, 'w')
+        self.write_damage_header(f)
 
         '''  loop over Monte Carlo monte_loops times, if it is desired to generate multiple sets of
           damage coefficient results on one file 
@@ -644,25 +744,9 @@ class damage_model(object):
             '''  there are self.dnum simulations for different paths of GHG, eg leading to 450, 650, and 1000 ppm
              the damage coefficients along these paths are interpolated in the optimization
              in order to determine the damage along any given mitigation policy
-             begin by allocating space for simulation results
+             the draws are simulated in batches of self.draws, see simulation_batch
             '''
             for rb in range(0, self.dnum):
-                consump = np.zeros([self.draws,self.my_tree.nperiods])
-                tmp = np.zeros([self.draws,self.my_tree.nperiods])
-                damage = np.zeros([self.draws,self.my_tree.nperiods])
-                temp_at_h = np.zeros([self.my_tree.nperiods])
-
-                '''   create exogenous path for consumption before damages
-                '''
-                peak_con = []
-
-                for p in range(self.my_tree.nperiods):
-                    peak_con.append( math.exp( self.my_tree.growth * self.my_tree.decision_times[p+1] ) )
-
-                    '''   to minimize overall memory allocation, the total number of simulations:  self.loops * self.over * self.draws
-                        is created in random simulations with self.draws each time through the inner loop
-                    '''
-
                 for lp in range(0,self.loops):
                     log.log_it('loop: %i  simul with GHG level = %f' % (lp, self.ww_ghg[rb]))
                     d = np.zeros([self.my_tree.final_states,self.my_tree.nperiods])
@@ -670,121 +754,165 @@ class damage_model(object):
                     ''' loop over the Monte Carlo over times, in order to increase accuracy
                     '''
                     for redraw in tqdm(range(0,self.over)):
-        
-                        '''  draw random outcomes for temperature and economic impact per Pindyck paper
-                        '''    
-                        #print(' percent done so far ', (100. * redraw) / float(self.over))
-                        if (self.temp_map == 0):
-                            temperature = self.gammaArray(self.pindyck_temp_k[rb], self.pindyck_temp_theta[rb],self.draws)+self.pindyck_temp_displace[rb]
-                        elif (self.temp_map == 1):
-                            temperature = self.normalArray(self.ww_temp_ave[rb], self.ww_temp_stddev[rb],self.draws)
-                        else :
-                            temperature = self.normalArray(self.rb_fbar[rb], self.rb_sigf[rb], self.draws)
-
-                        '''   start with the Pindyck gamma distribution mapping temperature into damages
-                        '''
-                        impact = (self.gammaArray(self.pindyck_impact_k, self.pindyck_impact_theta, self.draws)+self.pindyck_impact_displace )
-    
-                        ''' disaster is a random variable allowing for a tipping point to occur                      
-                           with a given probability, leading to a disaster and a "disaster_tail" impact on consumption
-                        '''
-                        disaster = self.uniformArray([self.draws,self.my_tree.nperiods])
-                        ''' disaster consumption gives consumption conditional on disaster, based on the parameter pd.disaster_tail
-                        '''
-                        disaster_consumption = self.gammaArray(1.0,self.disaster_tail,self.draws)
-
-                        for counter in np.arange(0,self.draws):
-                            if (self.temp_map == 1):        
-                                temperature[counter] = math.exp(temperature[counter])
-                            if (self.temp_map == 2):
-                                temperature[counter] = 1.0 / (1.0 - temperature[counter]) - self.rb_theta[rb]
-    
-                            '''    first_bp is a flag indicating whether a tipping point has already occurred (true if first_bp == 1)
-                            '''
-                            first_bp = 0
-    
-                            for p in np.arange(0,self.my_tree.nperiods):
-                                ''' implementation of the temperature and economic impacts from Pindyck[2012] page 6
-                                '''
-                                temperature[counter] = max( 0.0, temperature[counter] )
-                                temp_at_h[p] = 2. * temperature[counter] * ( 1. - .5**(self.my_tree.decision_times[p+1]/self.maxh) )
-                                tmp[counter,p] = temp_at_h[p]
-    
-                                ''' Now calculate the economic impact  Pindyck[2009]
-                                '''
-                                end_time = self.my_tree.decision_times[p+1]
-                                ''' Pindyck equation 4
-                                '''
-                                term1 = -2.0 * impact[counter] * self.maxh * temperature[counter] / -0.693147181
-                                term2 = (self.my_tree.growth - 2.0 * impact[counter] * temperature[counter]) * end_time
-                                term3 = ( 2.0 * impact[counter] * self.maxh * temperature[counter] * .5**(end_time/self.maxh) ) / -0.693147181
-                                growthcon = math.exp( term1 + term2 + term3)
-                                consump[counter,p] = growthcon
-      
-                                '''  now add the tipping points
-                                '''
-                            period_length = self.my_tree.decision_times[1]
-                            for p in np.arange(0,self.my_tree.nperiods):
-                                ave_prob_of_survival = 1. - (temp_at_h[p] / max( temp_at_h[p], self.peak_temp ) )**2
-                                if p>0 :
-                                    period_length= self.my_tree.decision_times[p+1]-self.my_tree.decision_times[p]
-                                else :
-                                    period_length = self.my_tree.decision_times[1]
-                                prob_of_survival_this_period = ave_prob_of_survival**( period_length / self.my_tree.peak_temp_interval )
-                                disaster_bar = prob_of_survival_this_period
-                                '''    set disaster_bar = 1.0 to turn off tipping points
-                                '''
-                                if (self.tip_on == 0) :
-                                    disaster_bar = 1.0
-                                '''   determine whether a tipping point has occurred,  if so hit consumption for all periods after this date
-                                '''
-                                if( disaster[counter,p] > disaster_bar and first_bp == 0 ):
-                                    for pp in range(p,self.my_tree.nperiods):
-                                        consump[counter,pp] = consump[counter,pp] * math.exp(-disaster_consumption[counter])
-                                        first_bp = 1
-                            '''   sort on last column
-                            '''
-                        consump = consump[ consump[:,self.my_tree.nperiods-1].argsort()]
-                        tmp = tmp[ tmp[:,self.my_tree.nperiods-1].argsort()]
-
-                        for counter in np.arange(0,self.draws):
-                            for p in np.arange(0,self.my_tree.nperiods):
-                                damage[counter,p] = 1. - consump[counter,p]/peak_con[p]
-
-                        firstob = 0
-                        lastob = int(self.my_tree.probs[0]*(self.draws-1))
-                        for n in np.arange(0,self.my_tree.final_states):
-      
-                            ''' associate the average damage in the range firstob->lastob with state n
-                            '''
-      
-                            for p in np.arange(0,self.my_tree.nperiods):
-                                d[n,p] = d[n,p] + damage[range(firstob,lastob),p].mean()
-                            firstob = lastob + 1
-                            if( n < self.my_tree.final_states-1 ):
-                                lastob = int(sum(self.my_tree.probs[0:n+2]) * (self.draws-1)-1)
+                        d = d + self.simulation_batch(rb)
                     d = d / self.over
+                    self.write_damage_block(f, d)
+        f.close()
 
-                    ''' put the d matrix on a file
-                    '''
+    def simulation_batch(self, rb):
+        '''Simulates one batch of self.draws outcomes at the GHG level self.ww_ghg[rb]
 
-                    f.write(str('\n'))
-                    for n in range(0,self.my_tree.final_states):
-                        for p in range(0,self.my_tree.nperiods):
-                            f.write( '%15f' % d[n,p] + ' ' )
-                        f.write(str('\n'))
-                    f.write(str('\n'))
-        f.close()
+        Returns
+        -------
+        d : float array
+            the average damage of the draws of each final state (row) at the end of each period (column), see damage_simulation
+        '''
+        d = np.zeros([self.my_tree.final_states,self.my_tree.nperiods])
+        consump = np.zeros([self.draws,self.my_tree.nperiods])
+        tmp = np.zeros([self.draws,self.my_tree.nperiods])
+        damage = np.zeros([self.draws,self.my_tree.nperiods])
+        temp_at_h = np.zeros([self.my_tree.nperiods])
 
-    def damage_function_initialization(self):
-        '''Reads the monte carlo simulation from a file,
-            if neccessary, runs a new monte carlo simulation
-            and puts the results on a file
+        '''   create exogenous path for consumption before damages
+        '''
+        peak_con = []
+
+        for p in range(self.my_tree.nperiods):
+            peak_con.append( math.exp( self.my_tree.growth * self.my_tree.decision_times[p+1] ) )
+
+            '''   to minimize overall memory allocation, the total number of simulations:  self.loops * self.over * self.draws
+                is created in random simulations with self.draws each time through the inner loop
+            '''
+
+
+        '''  draw random outcomes for temperature and economic impact per Pindyck paper
+        '''    
+        #print(' percent done so far ', (100. * redraw) / float(self.over))
+        if (self.temp_map == 0):
+            temperature = self.gammaArray(self.pindyck_temp_k[rb], self.pindyck_temp_theta[rb],self.draws)+self.pindyck_temp_displace[rb]
+        elif (self.temp_map == 1):
+            temperature = self.normalArray(self.ww_temp_ave[rb], self.ww_temp_stddev[rb],self.draws)
+        else :
+            temperature = self.normalArray(self.rb_fbar[rb], self.rb_sigf[rb], self.draws)
+
+        '''   start with the Pindyck gamma distribution mapping temperature into damages
+        '''
+        impact = (self.gammaArray(self.pindyck_impact_k, self.pindyck_impact_theta, self.draws)+self.pindyck_impact_displace )
+
+        ''' disaster is a random variable allowing for a tipping point to occur                      
+           with a given probability, leading to a disaster and a "disaster_tail" impact on consumption
+        '''
+        disaster = self.uniformArray([self.draws,self.my_tree.nperiods])
+        ''' disaster consumption gives consumption conditional on disaster, based on the parameter pd.disaster_tail
+        '''
+        disaster_consumption = self.gammaArray(1.0,self.disaster_tail,self.draws)
+
+        for counter in np.arange(0,self.draws):
+            if (self.temp_map == 1):        
+                temperature[counter] = math.exp(temperature[counter])
+            if (self.temp_map == 2):
+                temperature[counter] = 1.0 / (1.0 - temperature[counter]) - self.rb_theta[rb]
+
+            '''    first_bp is a flag indicating whether a tipping point has already occurred (true if first_bp == 1)
+            '''
+            first_bp = 0
+
+            for p in np.arange(0,self.my_tree.nperiods):
+                ''' implementation of the temperature and economic impacts from Pindyck[2012] page 6
+                '''
+                temperature[counter] = max( 0.0, temperature[counter] )
+                temp_at_h[p] = 2. * temperature[counter] * ( 1. - .5**(self.my_tree.decision_times[p+1]/self.maxh) )
+                tmp[counter,p] = temp_at_h[p]
+
+                ''' Now calculate the economic impact  Pindyck[2009]
+                '''
+                end_time = self.my_tree.decision_times[p+1]
+                ''' Pindyck equation 4
+                '''
+                term1 = -2.0 * impact[counter] * self.maxh * temperature[counter] / -0.693147181
+                term2 = (self.my_tree.growth - 2.0 * impact[counter] * temperature[counter]) * end_time
+                term3 = ( 2.0 * impact[counter] * self.maxh * temperature[counter] * .5**(end_time/self.maxh) ) / -0.693147181
+                growthcon = math.exp( term1 + term2 + term3)
+                consump[counter,p] = growthcon
+
+                '''  now add the tipping points
+                '''
+            period_length = self.my_tree.decision_times[1]
+            for p in np.arange(0,self.my_tree.nperiods):
+                ave_prob_of_survival = 1. - (temp_at_h[p] / max( temp_at_h[p], self.peak_temp ) )**2
+                if p>0 :
+                    period_length= self.my_tree.decision_times[p+1]-self.my_tree.decision_times[p]
+                else :
+                    period_length = self.my_tree.decision_times[1]
+                prob_of_survival_this_period = ave_prob_of_survival**( period_length / self.my_tree.peak_temp_interval )
+                disaster_bar = prob_of_survival_this_period
+                '''    set disaster_bar = 1.0 to turn off tipping points
+                '''
+                if (self.tip_on == 0) :
+                    disaster_bar = 1.0
+                '''   determine whether a tipping point has occurred,  if so hit consumption for all periods after this date
+                '''
+                if( disaster[counter,p] > disaster_bar and first_bp == 0 ):
+                    for pp in range(p,self.my_tree.nperiods):
+                        consump[counter,pp] = consump[counter,pp] * math.exp(-disaster_consumption[counter])
+                        first_bp = 1
+            '''   sort on last column
+            '''
+        consump = consump[ consump[:,self.my_tree.nperiods-1].argsort()]
+        tmp = tmp[ tmp[:,self.my_tree.nperiods-1].argsort()]
+
+        for counter in np.arange(0,self.draws):
+            for p in np.arange(0,self.my_tree.nperiods):
+                damage[counter,p] = 1. - consump[counter,p]/peak_con[p]
+
+        firstob = 0
+        lastob = int(self.my_tree.probs[0]*(self.draws-1))
+        for n in np.arange(0,self.my_tree.final_states):
+
+            ''' associate the average damage in the range firstob->lastob with state n
+            '''
+
+            for p in np.arange(0,self.my_tree.nperiods):
+                d[n,p] = d[n,p] + damage[range(firstob,lastob),p].mean()
+            firstob = lastob + 1
+            if( n < self.my_tree.final_states-1 ):
+                lastob = int(sum(self.my_tree.probs[0:n+2]) * (self.draws-1)-1)
+        return d
+
+    def write_damage_header(self, f):
+        '''    write the tree, Monte Carlo and damage parameters that head the damage matrix file, damage_function_initialization checks them
+        '''
+        f.write(str('\n'))
+        f.write( '%15i' % self.my_tree.nperiods + ' ' + '%15i' % self.my_tree.x_dim + ' ' + '%15i' % self.my_tree.final_states)
+        f.write(str('\n'))
+        f.write( '%15i' % self.monte_loops + ' ' + '%15i' % self.draws + ' ' + '%15i' % self.over + ' ' + '%15i' % self.tip_on)
+        f.write(str('\n'))
+        f.write( '%15f' % self.disaster_tail + ' ' + '%15f' % self.peak_temp + ' ' + '%15f' % self.temp_map + ' ' + '%15f' % self.my_tree.growth)
+        f.write(str('\n'))
+        for i in range(0, self.my_tree.final_states):
+            f.write( '%12f' % self.my_tree.probs[i])
+        f.write(str('\n'))
+        for i in range(0, self.my_tree.nperiods+1):
+            f.write( '%12f' % self.my_tree.decision_times[i])
+            
+        f.write(str('\n'))
+
+    def write_damage_block(self, f, d):
+        '''    write the damage matrix of one GHG level to the damage matrix file
+        '''
+        f.write(str('\n'))
+        for n in range(0,self.my_tree.final_states):
+            for p in range(0,self.my_tree.nperiods):
+                f.write( '%15f' % d[n,p] + ' ' )
+            f.write(str('\n'))
+        f.write(str('\n'))
+
+    def set_simulation_levels(self):
+        '''    the GHG levels of the simulations and the fraction of business-as-usual emissions each of them implies
 
             bau_emissions is the business-as-usual amount of emissions
             that is the emissions from time 0 to time T with no mitigation
         '''
-        
         self.bau_emissions = self.bau_ghg - 400.
         log.log_it('business-as-usual increase in CO2 ppm: %f' % self.bau_emissions)
         ''' For now we hardwire 3 simulations at ghg levels of 450, 650, and 1000 to calculate damages
@@ -799,13 +927,67 @@ class damage_model(object):
           self.emit_percentage[simul] = 1 - float(self.ww_ghg[simul]-400.0)/self.bau_emissions
         log.log_it('simulations emissions percentages: %s' % str(self.emit_percentage))
 
+    def start_batches(self, nbatches):
+        '''Starts a damage matrix simulated in batches, for an optimization that refines the damages as the plan converges
+            the matrix is the average of nbatches batches of self.draws draws at every GHG level, recombined and interpolated
+            (initialize_tree and damage_function_interpolation), add_batches refines it; once it holds self.over batches it has
+            the accuracy of damage_function_initialization and it is written to the damage matrix file
+        '''
+        if self.monte_loops != 1 or self.loops != 1 :
+            raise ValueError('a damage matrix simulated in batches needs monte_loops = loops = 1')
+        self.set_simulation_levels()
+        ''' initialize_tree reorders the state probabilities, the draws are assigned to states with the original ones '''
+        self.state_probs = list(self.my_tree.probs)
+        self.batch_sum = np.zeros( [self.my_tree.final_states,self.my_tree.nperiods,self.dnum] )
+        self.batches = 0
+        self.add_batches(nbatches)
+
+    def simulate_batches(self, nbatches):
+        '''    the sum of nbatches batches at every GHG level (see simulation_batch), shaped like self.d,
+            the model is not changed otherwise so the batches can be simulated in a worker process on a copy of it
+        '''
+        self.my_tree.probs[:] = self.state_probs
+        batch_sum = np.zeros( [self.my_tree.final_states,self.my_tree.nperiods,self.dnum] )
+        for rb in range(0, self.dnum):
+            for batch in range(0, nbatches):
+                batch_sum[:,:,rb] += self.simulation_batch(rb)
+        return batch_sum
+
+    def add_batches(self, nbatches, batch_sum=None):
+        '''Refines a damage matrix started by start_batches with nbatches more batches
+            batch_sum is the sum of the nbatches batches when they were simulated elsewhere (see simulate_batches), None simulates them here
+            the recombined damage matrix, the tree probabilities and the interpolation coefficients are recomputed
+        '''
+        if batch_sum is None :
+            batch_sum = self.simulate_batches(nbatches)
+        self.batch_sum += batch_sum
+        self.batches += nbatches
+        self.my_tree.probs[:] = self.state_probs
+        self.d = self.batch_sum / self.batches
+        if self.batches == self.over :
+            f = open(damage_matrix_file, 'w')
+            self.write_damage_header(f)
+            for rb in range(0, self.dnum):
+                self.write_damage_block(f, self.d[:,:,rb])
+            f.close()
+        self.initialize_tree()
+        self.dfc = self.damage_function_interpolation()
+        log.log_it('damage matrix from %i of %i batches of %i draws' % (self.batches, self.over, self.draws))
+
+    def damage_function_initialization(self):
+        '''Reads the monte carlo simulation from a file,
+            if neccessary, runs a new monte carlo simulation
+            and puts the results on a file
+        '''
+        self.set_simulation_levels()
+
         if( self.force_simul == 1 ):
             self.damage_simulation()
             self.force_simul = 0 
         else:
             log.log_it("Checking match between monte carlo file parameters and current run parameters")
 
-        f = open('\\Users\\Bob Litterman\\Dropbox\\EZ Climate calibration paper\\dlw code\\dlw_damage_matrix', 'r')
+        f = open(damage_matrix_file, 'r')
         line = f.readline()
         nperiods, x_dim, final_states = [int(x) for x in f.readline().split()]
         if (nperiods == self.my_tree.nperiods) :
@@ -867,26 +1049,13 @@ class damage_model(object):
             log.log_it("PROGRAM HALT: parmameter on Monte Carlo file does not match current run -- set force_simul = 1 to create new monte carlo file")
             sys.exit(0)
 
-        if self.my_tree.nperiods <= 5 :
-            for simul in range(0, self.dnum):
-              line = f.readline()
-              for n in range(0,self.my_tree.final_states):
-                  self.d[n][0][simul], self.d[n][1][simul], self.d[n][2][simul], self.d[n][3][simul], self.d[n][4][simul] = [float(x) for x in f.readline().split()]
-              '''  if needed for more periods use something like this
-                 d[n][0][simul], d[n][1][simul], d[n][2][simul], d[n][3][simul], d[n][4][simul], d[n][5][simul] = [float(x) for x in f.readline().split()]
-              '''   
-              line = f.readline()
-            f.close()
-        else :
-            for simul in range(0, self.dnum):
-              line = f.readline()
-              for n in range(0,self.my_tree.final_states):
-                  self.d[n][0][simul], self.d[n][1][simul], self.d[n][2][simul], self.d[n][3][simul], self.d[n][4][simul], self.d[n][5][simul] = [float(x) for x in f.readline().split()]
-                  '''  if needed for more periods use something like this
-                     d[n][0][simul], d[n][1][simul], d[n][2][simul], d[n][3][simul], d[n][4][simul], d[n][5][simul] = [float(x) for x in f.readline().split()]
-                  '''   
-              line = f.readline()
-            f.close()      
+        for simul in range(0, self.dnum):
+          line = f.readline()
+          for n in range(0,self.my_tree.final_states):
+              '''  one value per period '''
+              self.d[n, :, simul] = [float(x) for x in f.readline().split()]
+          line = f.readline()
+        f.close()
 
         return(self.d)
 
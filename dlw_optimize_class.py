@@ -1,7 +1,14 @@
+import os
 import configparser # For loading in job settings.
 import numpy as np
 import random
+from scipy.optimize import fmin_l_bfgs_b, brentq
 import dlw_utility as fm
+import dlw_report
+import dlw_parallel
+from dlw_tree_class import tree_model
+from dlw_damage_class import damage_model
+from dlw_cost_class import cost_model
 from tqdm import tqdm # For timer bar.
 from dlw_log import LogUtil # For logging. Currently DEBUG use only.
 
@@ -75,11 +82,82 @@ class optimize_plan(object):
             guess[ip], guess[ip+1], guess[ip+2], guess[ip+3], guess[ip+4], guess[ip+5] = [float(x) for x in f.readline().split()]
             
         guess[rest], guess[rest+1], guess[rest+2], guess[rest+3], guess[rest+4], guess[rest+5], guess[rest+6], guess[rest+7], guess[rest+8]  = [float(x) for x in f.readline().split()]
+        f.close()
+        self.guess = self.randomize_guess(guess)
+
+    def randomize_guess(self, guess):
+        '''    if randomize is greater than 0, introduce a random term to the initial guess
+        '''
         if self.randomize > 0 :
             for ip in range(0, self.my_tree.x_dim):
                 guess[ip] = max(0, guess[ip]*(1.0+random.normalvariate(0., self.randomize)))
-        f.close()
-        self.guess = guess
+        return guess
+
+    def multi_start(self, my_damage_model, my_cost_model, nstarts=8, spread=.1, sequence='halton', processes=None):
+        '''    optimize from nstarts perturbations of the initial guess in parallel worker processes and keep the best plan
+                set_constraints must be called first, the first start is the initial guess itself
+
+        Parameters
+        ----------
+        my_damage_model : damage_class object
+            the damage model used in the optimization
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        nstarts : integer
+            number of starting plans
+
+        spread : float
+            size of the perturbations, each mitigation is scaled by a factor in [1-spread, 1+spread] ('halton')
+            or by 1 + a normal draw with standard deviation spread ('random')
+
+        sequence : string
+            'halton' for quasi-random starts, 'random' for random starts
+
+        processes : integer
+            number of worker processes, None uses every core
+
+        Returns
+        -------
+        result : dict
+            best 'plan' and 'fit' plus the spread of the objective over the starts, see dlw_parallel.multi_start
+        '''
+        x_dim = self.my_tree.x_dim
+        lower = np.array([ bound[0] for bound in self.xbounds ])
+        upper = np.array([ bound[1] for bound in self.xbounds ])
+        if sequence == 'halton' :
+            factors = 1. + spread * (2. * dlw_parallel.halton(nstarts-1, x_dim, shift=np.random.random(x_dim)) - 1.)
+        else :
+            factors = 1. + np.random.normal(0., spread, [nstarts-1, x_dim])
+        starts = np.vstack( [ self.guess, self.guess * factors ] )
+        starts = np.minimum( np.maximum( starts, lower ), upper )
+        result = dlw_parallel.multi_start( self.my_tree, my_damage_model, my_cost_model, starts, self.xbounds, processes=processes )
+        log.log_it('multi start: best fit %f from start %i, spread of converged fits %f std %f, %i converged %i cancelled'
+                   % (result['fit'], result['start'], result['spread'], result['std'], result['converged'], result['cancelled']))
+        return result
+
+    def get_warm_start(self, store, params):
+        '''    get the initial mitigation guess from the plans solved at the nearest parameters in a warm start store
+                if the store is empty read the guess from the file, as in get_initial_guess or get_initial_guess6
+
+        Parameters
+        ----------
+        store : warm_start_store object
+            the store of solved plans for this tree shape
+
+        params : dict
+            the model parameters of this run, see dlw_warm_start.model_parameters
+        '''
+        guess, distance = store.nearest(params)
+        if guess is None :
+            if self.my_tree.nperiods <= 5 :
+                self.get_initial_guess()
+            else :
+                self.get_initial_guess6()
+            return
+        log.log_it("getting mitigation guess from the warm start store, parameter distance %f" % distance)
+        self.guess = self.randomize_guess(guess)
 
     def put_optimal_plan(self, plan):
         '''    write optimal mitigation plan to a file
@@ -139,8 +217,11 @@ class optimize_plan(object):
 
         return
 
-    def create_output(self, best_mitigation_plan, best_fit, my_damage_model, my_cost_model, my_tree):
-        '''   writes the output of the optimization to the console
+    def create_output(self, best_mitigation_plan, best_fit, my_damage_model, my_cost_model, my_tree, job=None):
+        '''   writes the output of the optimization to the log and, for a job, the node tables to one report file
+            the tables are built as arrays by dlw_report: the decision tree nodes (price, consumption, cost, damage, GHG level,
+            marginal utilities and SDF up/down), the final states, the utility tree nodes (consumption, SDF) and the utility periods
+            (bond prices, yields and, for analysis 2, the decomposition of the SCC into expected damages and risk premium)
         Parameters
         ----------
 
@@ -156,286 +237,68 @@ class optimize_plan(object):
         my_cost_model : cost_class object
             the cost model used in the optimization
 
+        job : string
+            name of the job (see dlw_trace.job_name), the report is written to report_<job>.npz in the output path; None writes no report
+
+        Returns
+        -------
+        price : float
+            the social cost of carbon
         '''
-        '''
-        TODO: Determine if these print statements are required for production runs.
-        if my_tree.analysis >= 1 :
-            if my_tree.print_options[0] == 1:
-                print('Print_Option[0] Maximized_utility_=', -best_fit)
-        if my_tree.analysis >= 1 :
-            if my_tree.print_options[1] == 1:
-                print('Print_Option[1] Optimized_mitigation_plan_=')
-                lines = int(my_tree.x_dim/6)-1
-                for line in range(0, lines) :
-                    for i in range(0,5) :
-                        print(best_mitigation_plan[line*6+i]) #,
-                    print(best_mitigation_plan[line*6+5])
-                for i in range(lines*6,my_tree.x_dim-1) :
-                        print(best_mitigation_plan[i]) #,
-                print(best_mitigation_plan[my_tree.x_dim-1])
-        '''            
         price = my_cost_model.price_by_state( best_mitigation_plan[0],0.,0.)
 
         if my_tree.analysis >= 1 :
+            if my_tree.print_options[0] == 1:
+                log.log_it('Print_Option[0] Maximized_utility_=%f' % -best_fit)
             if my_tree.print_options[2] == 1:
                 log.log_it('Print_Option[2] Social_Cost_of_Carbon_=%f' % price)
 
-        if my_tree.print_options[3] == 1:
-            log.log_it("dlw_optimize: my_tree.print_options[3] == 1")
-            emissions_to_bau = my_tree.emissions_to_ghg[my_tree.nperiods-1] / my_tree.emissions_per_period[my_tree.nperiods-1]
-            bau_path = 400
-            for p in tqdm(range(0, my_tree.nperiods)):
-                ave_price = 0.
-                first_node = my_tree.decision_period_pointer[p]
-                this_period_time = my_tree.decision_times[p+1] - my_tree.decision_times[p]
-                for n in range(0, my_tree.decision_nodes[p]):
-                    average_mitigation = best_mitigation_plan[0] * my_tree.decision_times[1]
-                    for pp in range(1, p):
-                        j = int(n / 2**(p-pp))
-                        average_mitigation += best_mitigation_plan[ my_tree.node_map[pp-1][ my_tree.node_mapping[pp-1][j][0] ]] * (my_tree.decision_times[pp+1]-my_tree.decision_times[pp])
-                    price = my_cost_model.g * my_cost_model.a * best_mitigation_plan[first_node+n]**(my_cost_model.a-1.)
-                    if p == 0 :
-                        consump = 1.
-                        average_mitigation = 0.
-                    else :
-                        consump = self.my_tree.potential_consumption[p]
-                        average_mitigation = average_mitigation / my_tree.decision_times[p]
-                        price = my_cost_model.price_by_state( best_mitigation_plan[first_node+n], average_mitigation, my_tree.decision_times[p] )
-                    ave_price += my_tree.node_probs[first_node+n] * price
-                    average_mitigation = my_tree.ave_mitigation[first_node+n]
-                    average_emissions = my_tree.additional_emissions_by_state[first_node+n] / (this_period_time*emissions_to_bau)
-                    #print('Print_Option[3] Period', p, 'time', int(2015+my_tree.decision_times[p]), 'node', first_node+n, 'has_prob', my_tree.node_probs[first_node+n], 'Emission_mitigation_of', best_mitigation_plan[first_node+n], 'Price', price, 'Consumption', consump*(1.-my_tree.damage_by_state[first_node+n])*(1.-my_tree.cost_by_state[first_node+n]),'Average_mitigation', average_mitigation, 'Cost', my_tree.cost_by_state[first_node+n], 'Damage', my_tree.damage_by_state[first_node+n],' GHG_level_in_state', my_tree.ghg_by_state[first_node+n], 'Average_annual_emissions_in_state', average_emissions)
-                bau_path += emissions_to_bau * my_tree.emissions_per_period[p]
-                #print('Print_Option[3] Period', p, 'time', int(2015+my_tree.decision_times[p]), 'Average_price', ave_price, 'BAU_average_annual_emissions_in_period', my_tree.emissions_per_period[p]/this_period_time, 'end_of_period_bau_ghg_level', bau_path)
-
-            #print('Print_Option[3] Final_period_consumption_and_damage')
-            '''
-            TODO: Determine if these print statements are required for production runs.
-            for state in range(0, my_tree.final_states):
-                print('Print_Option[3] Period', my_tree.nperiods, 'time', int(2015+my_tree.decision_times[my_tree.nperiods]), 'final_state', state, 'consumption', my_tree.potential_consumption[my_tree.nperiods]*(1.-my_tree.final_damage_by_state[state]), 'forward_damage', my_tree.final_damage_by_state[state])
-            '''
-                
-        ''' use root finder and the function "find_term_structure" to find the bond price (and yield) that reflects the value of a fixed $1 payment in all nodes at time np '''
-        from scipy.optimize import brentq        
-        np = my_tree.utility_nperiods-2
-        utility = fm.utility_function( best_mitigation_plan, self.my_tree, my_damage_model, my_cost_model )
-        res = brentq( self.find_term_structure, 0., .9999, args=( my_tree, my_damage_model, self, my_cost_model, np))
-        res = max( .00000000001, res)        
-        my_tree.discount_prices[np] = res
-        years_to_maturity = my_tree.utility_times[np]
+        ''' the bond prices (and yields) that reflect the value of a fixed $1 payment in all nodes at each utility period, from the stochastic discount factors
+            this also evaluates the utility of the plan, which sets the tree arrays the node tables are built from '''
+        bond_maturities, bond_prices, bond_yields, perp_yield = self.term_structure( best_mitigation_plan, my_damage_model, my_cost_model )
+        u_period = my_tree.utility_nperiods-2
+        res = max( .00000000001, bond_prices[u_period])
+        years_to_maturity = my_tree.utility_times[u_period]
 
         if my_tree.print_options[4] == 1:
             log.log_it("dlw_optimize: my_tree.print_options[4] == 1")
-            log.log_it('Print_Option[4] Zero_coupon_bond_maturing_at_time %i has_price_=%f and_yield_=%f' % ((2015+5*np), res, 100. * (1./(res**(1./years_to_maturity))-1.)))
-                
+            log.log_it('Print_Option[4] Zero_coupon_bond_maturing_at_time %i has_price_=%f and_yield_=%f' % ((2015+5*u_period), res, 100. * (1./(res**(1./years_to_maturity))-1.)))
+            log.log_it('Print_Option[4] Perpetuity_yield_=%f' % perp_yield)
+
+        report = { 'scc' : price, 'fit' : best_fit, 'perp_yield' : perp_yield, 'plan' : np.array(best_mitigation_plan, dtype=float),
+                   'decision' : dlw_report.decision_table(my_tree, best_mitigation_plan, my_cost_model),
+                   'final' : dlw_report.final_table(my_tree), 'utility' : dlw_report.utility_table(my_tree),
+                   'period' : { 'year' : 2015 + bond_maturities, 'years_to_maturity' : bond_maturities, 'bond_price' : bond_prices, 'yield' : bond_yields } }
+
         '''
             output for the decomposition of SCC into expected damage and risk premium
         '''
-        # TODO: Determine if/how 'utility' and 'base_grad' should be used.
-        utility = fm.utility_function( best_mitigation_plan, self.my_tree, my_damage_model, my_cost_model )
-        base_grad = fm.analytic_utility_gradient(best_mitigation_plan, self.my_tree, my_damage_model, my_cost_model )
-        d_cost_sum = 0.0
-        discounted_expected_damages = 0.0
-        net_discounted_expected_damages = 0.0
-        risk_premium = 0.0
-
         if my_tree.analysis == 2 :
             consumption_cost = my_tree.d_consumption_by_state[0]
             if my_tree.print_options[5] == 1:
                 log.log_it('Print_Option[5] Period_0_delta_consumption: %f' % consumption_cost)
             if my_tree.print_options[6] == 1:
-                log.log_it('Print_Option[6] Period_0_marginal_utility_wrt_c(0): %i  Period_0_marginal_utility_wrt_c(node1)_up_node: %i  Period_0_marginal_utility_wrt_c(node2)_down_node: %i' % (my_tree.marginal_utility_by_state[0][0], my_tree.marginal_utility_by_state[0][1],my_tree.marginal_utility_by_state[0][2]))
-
-            '''
-                in this loop calculate and print the expected damage and the risk premium term at each point in time
-            '''
-            my_tree.sdf_in_tree[0] = 1.0
-
-            log.log_it("dlw_optimize: my_tree.analysis == 2")
-            for time_period in tqdm(range(1, self.my_tree.utility_nperiods)):
-                '''  for a given time_period in the utility_tree, tree_node points to the first node in the period of the last decision in the decision tree'''
-                tree_node = my_tree.decision_period_pointer[ min( my_tree.nperiods-1, my_tree.utility_decision_period[time_period-1]+1) ]
-                ''' first_node points to the first node in period time_period of the utility tree '''
-                first_node = my_tree.utility_period_pointer[time_period]
-                expected_damages = 0.0
-                expected_sdf = 0.0
-                cross_product_sdf_damages = 0.0
-                '''
-                    Now loop over all the nodes in the utility tree in period time_period
-                    find the expected damages, the expected Stochastic Discount Factor, and the Covariance term
-                '''
-                for period_node in range(0, my_tree.utility_period_nodes[time_period]):
-                    '''
-                        d_consumption_by_state holds the change in consumption per unit change in emissions mitigation
-                        in all periods except the first this "damage_in_node" equals the damage in the node caused by additional emissions
-                        note however, in the first period this change also reflects the change in cost, the d_cost term, from reducing the mitigation
-                        calculate the expected damage by probability weighting the damage in each node
-                    '''
-                    damage_in_node = (my_tree.d_consumption_by_state[first_node+period_node])
-                    expected_damages += damage_in_node * my_tree.node_probs[tree_node+period_node]
-                    
-                    '''
-                    TODO: Determine if these print statements are required for production runs.
-                    if time_period <= my_tree.print_options[7] :
-                        # if this is a risk decomposition and utility sub-interval output is desired.
-                        print('Print_Option[7] Period', time_period, 'node', first_node+period_node, 'delta_consumption', my_tree.d_consumption_by_state[first_node+period_node], ' consumption_level', my_tree.consumption_by_state[first_node+period_node])
-                    '''
-                    # from_node is the node from the previous period that leads to period_node.
-                    if my_tree.information_period[time_period-1] == 1 :
-                        from_node = my_tree.utility_period_pointer[time_period-1] + int(period_node/2)
-                    else :
-                        from_node = my_tree.utility_period_pointer[time_period-1] + period_node
-
-                    if my_tree.information_period[time_period-1] == 1 :
-                        '''
-                            information_period = 1 when there is a branch in the tree
-                            first if (even values of period_node) considers upper branch nodes, second if considers lower branch nodes
-                        '''
-                        if int(period_node/2)*2 == period_node :
-                            ''' total_prob is the sum of the probabilities in the up and down nodes reached from "from_node" '''
-                            total_prob = my_tree.node_probs[tree_node+period_node] + my_tree.node_probs[tree_node+period_node+1]
-                            ''' sdf is the stochastic discount factor required to discount consumption in period_node back to from_node '''
-                            sdf = (total_prob/my_tree.node_probs[tree_node+period_node]) * my_tree.marginal_utility_by_state[from_node][1]/my_tree.marginal_utility_by_state[from_node][0]
-                            '''
-                            TODO: Determine if these print statements are required for production runs.
-                            if time_period <= my_tree.print_options[7] :
-                                print('Print_Option[7] Branch_from_node', from_node, 'MU_wrt_c(t)', my_tree.marginal_utility_by_state[from_node][0])
-                                print('Print_Option[7] Node:', tree_node+period_node,'SDF',sdf,'MU_wrt_c(t+1)_in_node', my_tree.marginal_utility_by_state[from_node][1])
-                                print('Print_Option[7] Probs:_up_node', tree_node+period_node, 'down_node', tree_node+period_node+1, 'probs', my_tree.node_probs[tree_node+period_node], my_tree.node_probs[tree_node+period_node+1])
-                            '''
-                        else:
-                            total_prob = my_tree.node_probs[tree_node+period_node] + my_tree.node_probs[tree_node+period_node-1]
-                            sdf = (total_prob/my_tree.node_probs[tree_node+period_node]) * my_tree.marginal_utility_by_state[from_node][2]/my_tree.marginal_utility_by_state[from_node][0]
-                            '''
-                            TODO: Determine if these print statements are required for production runs.
-                            if time_period <= my_tree.print_options[7] :
-                                print('Print_Option[7] Branch_from_node', from_node, 'MU_wrt_c(t)', my_tree.marginal_utility_by_state[from_node][0])
-                                print('Print_Option[7] Node:', tree_node+period_node, 'SDF', sdf, 'MU_wrt_c(t+1)_in_node', my_tree.marginal_utility_by_state[from_node][2], 'MU_wrt_c(t)', my_tree.marginal_utility_by_state[from_node][0])
-                                print('Print_Option[7] Probs:_down_node', tree_node+period_node, 'up_node', tree_node+period_node-1, 'probs', my_tree.node_probs[tree_node+period_node], my_tree.node_probs[tree_node+period_node-1])
-                            '''
-                    else:
-                        # if no branching occurs this period then the probability of reaching period_node is 1
-                        sdf = my_tree.marginal_utility_by_state[from_node][1]/my_tree.marginal_utility_by_state[from_node][0]
-                        mu_next = my_tree.marginal_utility_by_state[from_node][1]
-                        # in the final period the marginal utility is with respect to the steady-state continuation value
-                        if time_period == my_tree.utility_nperiods-1 :
-                            sdf = my_tree.final_total_derivative_term[period_node]/my_tree.marginal_utility_by_state[from_node][0]
-                            mu_next = my_tree.final_total_derivative_term[period_node]
-                        '''
-                        TODO: Determine if these print statements are required for production runs.
-                        if time_period <= my_tree.print_options[7] :
-                            print('Print_Option[7] No_branch_from_node', from_node, 'SDF', sdf, 'MU_wrt_c(t)', my_tree.marginal_utility_by_state[from_node][0], 'MU_wrt_c(t+1)_in_next_node', mu_next)
-                        '''
-                    # sdf_in_tree is the discount factor used to present value consumption in node period_node (at time time_period)
-                    my_tree.sdf_in_tree[first_node+period_node] = my_tree.sdf_in_tree[ from_node ] * sdf
-                    # the expected_sdf is the probability weighted discount factors in the nodes at time time_period
-                    expected_sdf += my_tree.sdf_in_tree[first_node+period_node] * my_tree.node_probs[tree_node+period_node]
-                    # cross_product_sdf_damages is the expected cross_product of sdf's and damages at time time_period
-                    cross_product_sdf_damages += my_tree.sdf_in_tree[first_node+period_node] * damage_in_node * my_tree.node_probs[tree_node+period_node]
-                # store the expected sdf, which is the present value at time 0 of $1 received at time time_period.
-                my_tree.discount_prices[time_period] = expected_sdf
-                # cov_term is the cross_product minus the product of the expected SDF and the expected damage at time time_period.
-                cov_term = cross_product_sdf_damages - expected_sdf * expected_damages
-
-                ''' now calculated the components of net discounted damage and the risk premium which arise in period time_period per $ spent on mitigation at time 0 (consumption_cost) '''
-                ''' if sub_interval time_period occurs during the first decision period we need to account for the impact of the cost of increased marginal mitigation
-                    on consumption during this interval in order to be left with only the marginal damage impact on consumption '''
-                if my_tree.utility_decision_period[ time_period] == 0 :
-                    net_discounted_damage = -(expected_damages+my_tree.d_cost_by_state[time_period,1])*expected_sdf/consumption_cost
-                    '''
-                    TODO: Determine if these print statements are required for production runs.
-                    if my_tree.print_options[10] == 1 :
-                        print('Print_Option[10] Period', time_period, 'expected_damages', -expected_damages/consumption_cost, 'discount_price', expected_sdf, 'cross_product', -cross_product_sdf_damages/consumption_cost, 'cov_term', -cov_term/consumption_cost, 'net_discounted_damage', net_discounted_damage,'d_cost', -my_tree.d_cost_by_state[time_period,1]/consumption_cost)
-                    '''
-                    # sum the present value of the costs of mitigation throughout the first decision period per $ spent on mitigation at time 0
-                    d_cost_sum += -my_tree.d_cost_by_state[time_period,1] * expected_sdf / consumption_cost
-                else :
-                    net_discounted_damage = -expected_damages*expected_sdf/consumption_cost
-                    '''
-                    TODO: Determine if these print statements are required for production runs.
-                    if my_tree.print_options[10] == 1 :
-                        print('Print_Option[10] Period', time_period, 'expected_damages', -expected_damages/consumption_cost, 'discount_price', expected_sdf, 'cross_product', -cross_product_sdf_damages/consumption_cost, 'cov_term', -cov_term/consumption_cost, 'net_discounted_damage', net_discounted_damage)
-                    '''
-                my_tree.net_expected_damages[time_period] = net_discounted_damage
-                my_tree.risk_premium[time_period] = -cov_term/consumption_cost
-                ''' sum (over time) the components of the present value of expected damages and the risk premium'''
-                discounted_expected_damages += -expected_damages * expected_sdf / consumption_cost
-                ''' the net discounted damages nets out the cost associated with increasing mitigation throughout the first period '''
-                net_discounted_expected_damages += net_discounted_damage
-                risk_premium += -cov_term / consumption_cost
-
-        ''' if desired, print out the SDF's and Marginal Utilities for the decision tree nodes'''
-        for p in range(0, self.my_tree.nperiods):
-            first_node = self.my_tree.decision_period_pointer[p]
-            for n in range(0, self.my_tree.decision_nodes[p]):
-                ''' no branching in the last period '''
-                if p == self.my_tree.nperiods-1 :
-                    '''
-                    TODO: Determine if these print statements are required for production runs.
-                    if my_tree.print_options[6] == 1 :
-                        print('Print_Option[6] Period', p,'time', int(2015+my_tree.decision_times[p]), 'node', first_node+n, 'SDF=', my_tree.marginal_utility_in_tree[first_node+n,1] / my_tree.marginal_utility_in_tree[ first_node+n, 0 ]) #,
-                        print('Print_Option[6] Marginal_utility(c(t)) ', my_tree.marginal_utility_in_tree[first_node+n, 0], 'Marginal_utility(c(t+1))', self.my_tree.marginal_utility_in_tree[first_node+n, 1])
-                    '''
-                else :
-                    if my_tree.print_options[6] == 1 :
-                        to_node = self.my_tree.next_node[first_node+n][0]
-                        prob_up = self.my_tree.node_probs[to_node]
-                        prob_down = self.my_tree.node_probs[to_node+1]
-                        total_prob = prob_up + prob_down
-                        '''
-                        TODO: Determine if these print statements are required for production runs.
-                        print('Print_Option[6] Period', p, 'time', int(2015+my_tree.decision_times[p]), 'node', first_node+n, 'SDF_up=  ', (total_prob/prob_up) * self.my_tree.marginal_utility_in_tree[first_node+n,1] / self.my_tree.marginal_utility_in_tree[ first_node+n, 0 ]) #,
-                        print('Print_Option[6] SDF_down=', (total_prob/prob_down) * self.my_tree.marginal_utility_in_tree[first_node+n,2] / self.my_tree.marginal_utility_in_tree[ first_node+n, 0 ], 'MU ', self.my_tree.marginal_utility_in_tree[first_node+n, 0], 'Marginal_utility(c(t+1))_up ', self.my_tree.marginal_utility_in_tree[first_node+n, 1]) #,
-                        print('Print_Option[6] Marginal_utility(c(t+1))_down ', self.my_tree.marginal_utility_in_tree[first_node+n, 2])
-                        '''
-
-        ''' if desired, print out the levels of GHG in each node '''
-        if my_tree.print_options[8] == 1 :
-            for p in range(0, my_tree.nperiods):
-                first_node = my_tree.decision_period_pointer[p]
-                '''
-                TODO: Determine if these print statements are required for production runs.
-                for n in range(0, my_tree.decision_nodes[p]):
-                    print('Print_Option[8] Period', p, 'time', int(2015+my_tree.decision_times[p]), 'node', first_node+n, 'GHG_level=', my_tree.ghg_by_state[first_node+n])
-                '''
-                
-            first_node = my_tree.x_dim
-            '''
-            TODO: Determine if these print statements are required for production runs.
-            for n in range(0, my_tree.final_states):
-                print('Print_Option[8] Period', my_tree.nperiods, 'time', int(2015+my_tree.decision_times[my_tree.nperiods]), 'node', first_node+n, 'GHG_level= ', my_tree.ghg_by_state[first_node+n])
-            '''
-        if my_tree.analysis == 2 :
+                log.log_it('Print_Option[6] Period_0_marginal_utility_wrt_c(0): %f  Period_0_marginal_utility_wrt_c(node1)_up_node: %f  Period_0_marginal_utility_wrt_c(node2)_down_node: %f' % (my_tree.marginal_utility_by_state[0][0], my_tree.marginal_utility_by_state[0][1],my_tree.marginal_utility_by_state[0][2]))
+
+            decomposition = dlw_report.scc_decomposition(my_tree, consumption_cost)
+            my_tree.net_expected_damages[:my_tree.utility_nperiods] = decomposition['net_discounted_damage']
+            my_tree.risk_premium[:my_tree.utility_nperiods] = decomposition['risk_premium']
+            ''' the net discounted damages net out the cost associated with increasing mitigation throughout the first period '''
+            net_discounted_expected_damages = decomposition['net_discounted_damage'].sum()
+            risk_premium = decomposition['risk_premium'].sum()
             total = net_discounted_expected_damages + risk_premium
-            #  decompose the Social Cost of Carbon into the expected damages component versus the risk premium.
-            '''
-            TODO: Determine if these print statements are required for production runs.
-            print('Social_cost_of_carbon', my_cost_model.price_by_state( best_mitigation_plan[0],0.,0.))
-            print('Discounted_expected_damages', (net_discounted_expected_damages/total) * my_cost_model.price_by_state( best_mitigation_plan[0],0.,0.))
-            print('Risk_premium', (risk_premium/total) * my_cost_model.price_by_state( best_mitigation_plan[0],0.,0.))
-            '''
-            # print the decomposition of expected damages and risk premium over time.
+            log.log_it('Social_cost_of_carbon %f Discounted_expected_damages %f Risk_premium %f' % (price, (net_discounted_expected_damages/total) * price, (risk_premium/total) * price))
+            # scale the decomposition over time so it sums to the SCC.
             if my_tree.print_options[9] == 1:
-                damage_scale = my_cost_model.price_by_state( best_mitigation_plan[0],0.,0.)/(net_discounted_expected_damages+risk_premium)
-                for np in range(1, my_tree.utility_nperiods):
-                    my_tree.net_expected_damages[np] *= damage_scale
-                    my_tree.risk_premium[np] *= damage_scale
-                    # TODO: Determine if these print statements are required for production runs.
-                    #print('Print_Option[9] Period', np, 'Year', 2015+np*my_tree.sub_interval_length, 'Net_discounted_expected_damage', my_tree.net_expected_damages[np], 'Risk_premium', my_tree.risk_premium[np])
-                
-        ''' if desired, print out the yield curve '''
-        if my_tree.print_options[4] == 1 :
-            if my_tree.analysis == 2 :
-                for np in range(1, my_tree.utility_nperiods-1):
-                    years_to_maturity = self.my_tree.utility_times[ np ]
-                    # TODO: Determine if these print statements are required for production runs.
-                    #print('Print_Option[4] Period', np, 'years-to-maturity', years_to_maturity, 'price of bond', self.my_tree.discount_prices[np], ' yield ', 100. * (1./(self.my_tree.discount_prices[np]**(1./years_to_maturity))-1.))
-                ''' find the yield on a perpetuity that begins paying at the time of the steady state continuation term '''
-                np = my_tree.utility_nperiods-1
-                years_to_maturity = self.my_tree.utility_times[ np ]
-                perp_yield = brentq( self.perpetuity_yield, 0.1, 10., args=( np*5, self.my_tree.discount_prices[np]))
-                # TODO: Determine if these print statements are required for production runs.
-                #print('Print_Option[4] Period', my_tree.utility_nperiods-1, 'years-to-maturity', years_to_maturity, 'price of bond', self.my_tree.discount_prices[np], ' yield ', perp_yield)
+                damage_scale = price/total
+                my_tree.net_expected_damages[1:my_tree.utility_nperiods] *= damage_scale
+                my_tree.risk_premium[1:my_tree.utility_nperiods] *= damage_scale
+            report['period'].update(decomposition)
+            report['period']['net_expected_damages'] = my_tree.net_expected_damages[:my_tree.utility_nperiods].copy()
+            report['period']['risk_premium'] = my_tree.risk_premium[:my_tree.utility_nperiods].copy()
+
+        if job is not None :
+            dlw_report.write_report(os.path.join(self.output_path, 'report_%s.npz' % job), report)
         return price
     
     '''
@@ -506,6 +369,564 @@ class optimize_plan(object):
 
         return(distance)
     
+    def find_bec_newton(self, my_tree, my_damage_model, my_cost_model, lower=-.1, upper=.99, xtol=2.0e-12, maxiter=50):
+        '''Finds the break-even consumption, the root of find_bec, by safeguarded Newton steps
+            the base utility is computed once, and the derivative of time 0 utility with respect to first_period_epsilon
+            is the marginal utility of time 0 consumption, my_tree.marginal_utility_by_state[0,0], computed by every utility evaluation
+            a step that leaves the bracket [lower, upper] is replaced by bisection, the bracket shrinks using the sign of find_bec,
+            which decreases with delta_con; as with brentq, find_bec must change sign over the bracket
+
+        Parameters
+        ----------
+        my_tree, my_damage_model, my_cost_model : model objects
+            as passed to find_bec
+
+        lower, upper : float
+            bracket of the root, as given to brentq, lower < 0 < upper
+
+        xtol : float
+            convergence tolerance on delta_con
+
+        maxiter : integer
+            maximum number of utility evaluations after the base
+
+        Returns
+        -------
+        delta_con : float
+            change in first period consumption such that find_bec(delta_con) = 0
+
+        Raises
+        ------
+        ValueError
+            if find_bec has the same sign at both ends of the bracket
+
+        RuntimeError
+            if the root is not found within maxiter evaluations
+        '''
+        if not lower < 0. < upper :
+            raise ValueError('the bracket [%f, %f] of the break even consumption must contain 0' % (lower, upper))
+        base_case = self.guess
+        my_tree.first_period_epsilon = 0.0
+        base_utility = fm.utility_function(base_case, my_tree, my_damage_model, my_cost_model )
+        '''     at delta_con = 0 the distance and its derivative come from the base evaluation
+        '''
+        delta_con = 0.0
+        distance = -self.constraint_cost
+        slope = -my_tree.marginal_utility_by_state[0,0]
+        ends = []
+        for end in [ lower, upper ] :
+            my_tree.first_period_epsilon = end
+            ends.append( fm.utility_function(base_case, my_tree, my_damage_model, my_cost_model ) - base_utility - self.constraint_cost )
+        my_tree.first_period_epsilon = 0.0
+        if ends[0] * ends[1] > 0. :
+            raise ValueError('find_bec does not change sign over [%f, %f] (%e, %e), no break even consumption' % (lower, upper, ends[0], ends[1]))
+        for iteration in range(0, maxiter):
+            if distance > 0. :
+                lower = delta_con
+            else :
+                upper = delta_con
+            step = -distance / slope
+            if not lower < delta_con + step < upper :
+                step = .5*(lower+upper) - delta_con
+            delta_con += step
+            my_tree.first_period_epsilon = delta_con
+            distance = fm.utility_function(base_case, my_tree, my_damage_model, my_cost_model ) - base_utility - self.constraint_cost
+            slope = -my_tree.marginal_utility_by_state[0,0]
+            if distance == 0. or abs(step) <= xtol :
+                break
+        else :
+            my_tree.first_period_epsilon = 0.0
+            raise RuntimeError('break even consumption not found in %i utility evaluations, residual %e' % (maxiter, distance))
+        my_tree.first_period_epsilon = 0.0
+        log.log_it('break even consumption %f after %i utility evaluations, residual %e' % (delta_con, iteration+4, distance))
+        return delta_con
+
+    def set_model_parameter(self, name, value, my_cost_model):
+        '''Sets one model parameter, see scc_sensitivities
+
+        Parameters
+        ----------
+        name : string
+            a utility parameter of the tree ('ra', 'eis', 'time_pref', 'growth') or a cost parameter ('g', 'a', 'join', 'max_price', 'teconst', 'tescale')
+
+        value : float
+            the new value
+
+        my_cost_model : cost_class object
+            the current cost model
+
+        Returns
+        -------
+        my_cost_model : cost_class object
+            the cost model to use from now on, a new one when a cost parameter changed
+        '''
+        if name in [ 'ra', 'eis', 'time_pref', 'growth' ] :
+            setattr(self.my_tree, name, value)
+            if name == 'growth' :
+                ''' potential consumption is set from growth when the tree is built '''
+                for p in range(0, self.my_tree.nperiods+1):
+                    self.my_tree.potential_consumption[p] = (1.0+self.my_tree.growth)**self.my_tree.decision_times[p]
+            return my_cost_model
+        cost_parameters = { 'g' : my_cost_model.g, 'a' : my_cost_model.a, 'join' : my_cost_model.join, 'max_price' : my_cost_model.max_price,
+                            'teconst' : my_cost_model.teconst, 'tescale' : my_cost_model.tescale,
+                            'consat0' : my_cost_model.consperton0 * self.my_tree.bau_emit_level[0] }
+        if name not in cost_parameters :
+            raise ValueError('unknown model parameter %s' % name)
+        cost_parameters[name] = value
+        return cost_model(tree=self.my_tree, **cost_parameters)
+
+    def free_variables(self, x, active_tolerance=.000001):
+        '''    indices of the variables of the plan x that are not at a bound of self.xbounds
+        '''
+        lower = np.array([ bound[0] for bound in self.xbounds ])
+        upper = np.array([ bound[1] for bound in self.xbounds ])
+        return np.where( (x > lower + active_tolerance) & (x < upper - active_tolerance) )[0]
+
+    def reduced_hessian(self, x, free, my_damage_model, my_cost_model):
+        '''    the hessian of the objective at x restricted to the variables in free,
+            assembled from hessian-vector products with their unit vectors (two gradients each) and symmetrized
+        '''
+        hessian = np.zeros([len(free), len(free)])
+        for i in tqdm(range(0, len(free))):
+            v = np.zeros(len(x))
+            v[free[i]] = 1.
+            hessian[:, i] = fm.hessian_vector_product(x, v, self.my_tree, my_damage_model, my_cost_model)[free]
+        return .5 * (hessian + hessian.T)
+
+    def first_period_response(self, best_mitigation_plan, my_damage_model, my_cost_model, active_tolerance=.000001):
+        '''Tangent-linear response of the optimal plan to a constraint on first period mitigation
+            when x[0] is pinned the gradient stays zero in the other free variables F, so H_FF dx_F = -H_F0 dx_0,
+            and the response per unit of x[0] comes from one solve of this Newton system; variables at a bound do not move
+            this is the limit of re-optimizing with x[0] constrained to x[0] + delta_x, as analysis 2 used to do
+            set_constraints must be called with the bounds of the unconstrained optimization first
+
+        Parameters
+        ----------
+        best_mitigation_plan : float
+            the optimal plan
+
+        my_damage_model : damage_class object
+            the damage model used in the optimization
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        active_tolerance : float
+            distance to a bound under which a variable is treated as active
+
+        Returns
+        -------
+        direction : float vector
+            derivative of the optimal plan with respect to first period mitigation, direction[0] = 1
+        '''
+        x = np.array(best_mitigation_plan, dtype=float)
+        free = self.free_variables(x, active_tolerance)
+        free = free[ free != 0 ]
+        hessian = self.reduced_hessian(x, np.concatenate([ [0], free ]), my_damage_model, my_cost_model)
+        direction = np.zeros(len(x))
+        direction[0] = 1.
+        direction[free] = -np.linalg.solve(hessian[1:, 1:], hessian[1:, 0])
+        fm.utility_function(x, self.my_tree, my_damage_model, my_cost_model)
+        return direction
+
+    def scc_sensitivities(self, best_mitigation_plan, my_damage_model, my_cost_model, parameters=[ 'ra', 'eis', 'time_pref', 'growth', 'g' ],
+                          relative_step=.0001, active_tolerance=.000001, job=None):
+        '''Derivatives of the optimal plan and of the social cost of carbon with respect to model parameters
+            by the implicit function theorem: at the optimum the gradient of the objective is zero in the variables that are not at a bound,
+            so d plan / d parameter = -H^-1 d gradient / d parameter on those variables, where H is the hessian restricted to them,
+            and the variables at a bound do not move
+            H is assembled from hessian-vector products with the unit vectors of the free variables (two gradients each),
+            then each parameter costs two gradients, so the whole table costs about 2 * (free variables + parameters) gradients
+            the damage matrix is held fixed, so the growth sensitivity does not include the change of the simulated damages
+            set_constraints must be called with the bounds of the optimization first
+
+        Parameters
+        ----------
+        best_mitigation_plan : float
+            the optimal plan
+
+        my_damage_model : damage_class object
+            the damage model used in the optimization
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        parameters : list of strings
+            the parameters, see set_model_parameter
+
+        relative_step : float
+            relative size of the parameter bumps
+
+        active_tolerance : float
+            distance to a bound under which a variable is treated as active
+
+        job : string
+            name of the job (see dlw_trace.job_name), the sensitivities are written to report_<job>.npz in the output path
+            (see dlw_report.sensitivity_report); None writes no report
+
+        Returns
+        -------
+        sensitivities : dict
+            parameter -> { 'd_plan' : derivative of the plan, 'd_scc' : derivative of the SCC, 'elasticity' : d log SCC / d log parameter }
+            plus 'scc', the SCC at the optimum, and 'free', the indices of the free variables
+        '''
+        x = np.array(best_mitigation_plan, dtype=float)
+        free = self.free_variables(x, active_tolerance)
+        args = (self.my_tree, my_damage_model, my_cost_model)
+        hessian = self.reduced_hessian(x, free, my_damage_model, my_cost_model)
+
+        def scc(cost):
+            return cost.price_by_state( x[0], 0., 0.)
+
+        delta_m = .000001
+        d_price_d_m = ( my_cost_model.price_by_state( x[0]+delta_m, 0., 0.) - my_cost_model.price_by_state( x[0]-delta_m, 0., 0.) ) / (2.*delta_m)
+        sensitivities = { 'scc' : scc(my_cost_model), 'free' : free }
+        for name in parameters :
+            if name in [ 'ra', 'eis', 'time_pref', 'growth' ] :
+                value = getattr(self.my_tree, name)
+            else :
+                value = getattr(my_cost_model, name)
+            step = relative_step * max( abs(value), 1. )
+            cost_plus = self.set_model_parameter(name, value + step, my_cost_model)
+            fm.utility_function(x, self.my_tree, my_damage_model, cost_plus)
+            grad_plus = fm.analytic_utility_gradient(x, self.my_tree, my_damage_model, cost_plus).copy()
+            cost_minus = self.set_model_parameter(name, value - step, my_cost_model)
+            fm.utility_function(x, self.my_tree, my_damage_model, cost_minus)
+            grad_minus = fm.analytic_utility_gradient(x, self.my_tree, my_damage_model, cost_minus).copy()
+            self.set_model_parameter(name, value, my_cost_model)
+            d_grad = (grad_plus - grad_minus) / (2.*step)
+            d_plan = np.zeros(len(x))
+            d_plan[free] = -np.linalg.solve(hessian, d_grad[free])
+            d_scc = d_price_d_m * d_plan[0] + ( scc(cost_plus) - scc(cost_minus) ) / (2.*step)
+            sensitivities[name] = { 'd_plan' : d_plan, 'd_scc' : d_scc, 'elasticity' : d_scc * value / sensitivities['scc'] }
+            log.log_it('SCC sensitivity to %s: %f per unit, elasticity %f' % (name, d_scc, sensitivities[name]['elasticity']))
+        fm.utility_function(x, *args)
+        if job is not None :
+            dlw_report.write_report(os.path.join(self.output_path, 'report_%s.npz' % job), dlw_report.sensitivity_report(sensitivities, parameters))
+        return sensitivities
+
+    def pruned_optimization(self, my_damage_model, my_cost_model, threshold=.01, maxfun=600, newton_steps=5, active_tolerance=.000001):
+        '''Approximate optimization of a skewed tree with its low probability subtrees frozen
+            every decision node whose probability is below threshold takes the mitigation of its parent (see tree_model.pruned_representatives),
+            so the optimizer only sees one mitigation per group of tied nodes and the gradient computes one column per group,
+            differentiating along the group (see fm.tied_utility_gradient); the utility itself is still evaluated on the full tree
+            the SCC error introduced is estimated from a truncated Newton step of the full problem at the pruned plan:
+            newton_steps conjugate gradient iterations on the hessian of the variables not at a bound (two gradients each),
+            and the change of the time 0 price when first period mitigation moves by the step
+            the start is self.guess and the bounds self.xbounds, set_constraints must be called first
+
+        Parameters
+        ----------
+        my_damage_model : damage_class object
+            the damage model used in the optimization
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        threshold : float
+            probability below which a node is tied to its parent
+
+        maxfun : integer
+            maximum number of function evaluations
+
+        newton_steps : integer
+            conjugate gradient iterations of the error estimate, 0 skips the estimate
+
+        active_tolerance : float
+            distance to a bound under which a variable is treated as active in the error estimate
+
+        Returns
+        -------
+        result : dict
+            'plan' (the full plan), 'fit', 'converged', 'funcalls', 'tied' (the number of tied nodes), 'columns' (the number of
+            gradient columns), 'scc' and 'scc_error', the estimated difference between the SCC of the full optimization and 'scc'
+        '''
+        args = (self.my_tree, my_damage_model, my_cost_model)
+        lower = np.array([ bound[0] for bound in self.xbounds ], dtype=float)
+        upper = np.array([ bound[1] for bound in self.xbounds ], dtype=float)
+        representative = self.my_tree.pruned_representatives(threshold)
+        ''' a tied node pinned by its bounds keeps its own bound '''
+        pinned = np.where( lower == upper )[0]
+        representative[pinned] = pinned
+        directions, groups = fm.tied_directions(representative)
+        tied = self.my_tree.x_dim - len(groups)
+        log.log_it('pruned optimization: %i of %i nodes tied to their parent at probability threshold %f' % (tied, self.my_tree.x_dim, threshold))
+
+        res = fmin_l_bfgs_b( fm.tied_utility_function, np.asarray(self.guess, dtype=float)[groups], fprime=fm.tied_utility_gradient,
+                             factr=1., pgtol=1.0e-5, bounds=[ self.xbounds[g] for g in groups ], maxfun=maxfun, args=(directions,)+args)
+        x = np.dot(directions, res[0])
+        scc = my_cost_model.price_by_state( x[0], 0., 0.)
+
+        step = np.zeros(len(x))
+        free = self.free_variables(x, active_tolerance)
+        if newton_steps > 0 and tied > 0 and len(free) > 0 :
+            fm.utility_function(x, *args)
+            residual = -fm.analytic_utility_gradient(x, *args)[free]
+            search = residual.copy()
+            for k in range(0, newton_steps):
+                v = np.zeros(len(x))
+                v[free] = search
+                curvature_product = fm.hessian_vector_product(x, v, *args)[free]
+                curvature = np.dot(search, curvature_product)
+                if curvature <= 0. :
+                    break
+                alpha = np.dot(residual, residual) / curvature
+                step[free] += alpha * search
+                new_residual = residual - alpha * curvature_product
+                search = new_residual + ( np.dot(new_residual, new_residual) / np.dot(residual, residual) ) * search
+                residual = new_residual
+        x_full = np.clip(x + step, lower, upper)
+        scc_error = abs( my_cost_model.price_by_state( x_full[0], 0., 0.) - scc )
+        fm.utility_function(x, *args)
+        log.log_it('pruned optimization: fit %f scc %f estimated scc error %f with %i gradient columns' % (res[1], scc, scc_error, len(groups)))
+        return { 'plan' : x, 'fit' : res[1], 'converged' : res[2]['warnflag'] == 0, 'funcalls' : res[2]['funcalls'], 'tied' : tied,
+                 'columns' : len(groups), 'scc' : scc, 'scc_error' : scc_error }
+
+    def coarse_models(self, my_damage_model, my_cost_model):
+        '''    the optimization, damage and cost models of the tree with one period less (see tree_model.coarse_decision_times),
+            with the same utility, damage and cost parameters and the constraints of this optimization; the coarse damage matrix is
+            aggregated from the simulation of this tree (see damage_model.damage_from_finer_tree), nothing is simulated or written
+        '''
+        tree = self.my_tree
+        nperiods = tree.nperiods - 1
+        coarse_tree = tree_model(tp1=tree.decision_times[1], analysis=tree.analysis, final_states=tree.branching**(nperiods-1), nperiods=nperiods,
+                                 peak_temp_interval=tree.peak_temp_interval, x_dim=sum([ tree.branching**p for p in range(0, nperiods) ]),
+                                 sub_interval_length=tree.sub_interval_length, prob_scale=tree.prob_scale, growth=tree.growth, eis=tree.eis,
+                                 ra=tree.ra, time_pref=tree.time_pref, branching=tree.branching, decision_times=tree.coarse_decision_times(),
+                                 utility_steps=None if tree.utility_steps is None else tree.utility_steps[:2] + tree.utility_steps[3:],
+                                 print_options=tree.print_options)
+        coarse_damage_model = damage_model(my_tree=coarse_tree, peak_temp=my_damage_model.peak_temp, disaster_tail=my_damage_model.disaster_tail,
+                                           tip_on=my_damage_model.tip_on, temp_map=my_damage_model.temp_map, bau_ghg=my_damage_model.bau_ghg,
+                                           draws=my_damage_model.draws, over=my_damage_model.over, force_simul=0)
+        coarse_damage_model.damage_from_finer_tree(my_damage_model)
+        coarse_damage_model.initialize_tree()
+        coarse_damage_model.dfc = coarse_damage_model.damage_function_interpolation()
+        coarse_cost_model = cost_model(tree=coarse_tree, g=my_cost_model.g, a=my_cost_model.a, join=my_cost_model.join, max_price=my_cost_model.max_price,
+                                       teconst=my_cost_model.teconst, tescale=my_cost_model.tescale,
+                                       consat0=my_cost_model.consperton0 * tree.bau_emit_level[0])
+        coarse_optimization = optimize_plan(my_tree=coarse_tree)
+        coarse_optimization.set_constraints(constrain=self.constrain)
+        return coarse_optimization, coarse_damage_model, coarse_cost_model
+
+    def multilevel_optimization(self, my_damage_model, my_cost_model, levels=1, maxfun=600, coarse_pgtol=1.0e-3, pgtol=1.0e-5, guard=True):
+        '''Coarse-to-fine optimization: the optimal plan of a coarser tree is the starting point of the optimization of this tree
+            the coarse tree has one period less (see coarse_models) and is itself solved the same way over levels-1 coarser trees,
+            its optimal plan is prolonged onto this tree by giving every node the mitigation of the coarse node it maps to
+            (see tree_model.prolongation); the coarsest tree starts from self.guess restricted to it, the probability weighted average
+            of the nodes that map to each coarse node
+            the coarse trees can lead the fine optimization to a worse local optimum than a direct start: with guard, a result worse
+            than the objective at self.guess (the warm start) is rejected and this tree is solved from self.guess instead
+            set_constraints must be called first, and self.guess set
+
+        Parameters
+        ----------
+        my_damage_model : damage_class object
+            the damage model used in the optimization
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        levels : integer
+            number of coarser trees, a tree of three periods is not coarsened further
+
+        maxfun : integer
+            maximum number of function evaluations at every level
+
+        coarse_pgtol : float
+            projected gradient tolerance of the coarser trees, their plans are only starting points
+
+        pgtol : float
+            projected gradient tolerance of this tree
+
+        guard : boolean
+            if True, solve this tree from self.guess when the coarse-to-fine result is worse than the objective at self.guess
+
+        Returns
+        -------
+        result : dict
+            'plan', 'fit', 'converged', 'funcalls' (of this tree, with the solve from self.guess if there was one), 'rejected' (True
+            when the guard replaced the coarse-to-fine result) and 'levels', a list from the coarsest tree to this one of dicts
+            with the 'nodes', 'funcalls', 'fit' and 'scc' of every level
+        '''
+        args = (self.my_tree, my_damage_model, my_cost_model)
+        lower = np.array([ bound[0] for bound in self.xbounds ], dtype=float)
+        upper = np.array([ bound[1] for bound in self.xbounds ], dtype=float)
+        guess = np.asarray(self.guess, dtype=float)
+        coarse_levels = []
+        if levels > 0 and self.my_tree.nperiods > 3 :
+            coarse_optimization, coarse_damage_model, coarse_cost_model = self.coarse_models(my_damage_model, my_cost_model)
+            coarse_node = self.my_tree.prolongation(coarse_optimization.my_tree)
+            weights = np.bincount(coarse_node, self.my_tree.node_probs, coarse_optimization.my_tree.x_dim)
+            restricted = np.bincount(coarse_node, self.my_tree.node_probs * guess, coarse_optimization.my_tree.x_dim)
+            coarse_optimization.guess = np.where( weights > 0., restricted / np.maximum(weights, 1.0e-300), guess.mean() )
+            coarse_result = coarse_optimization.multilevel_optimization(coarse_damage_model, coarse_cost_model, levels-1, maxfun,
+                                                                         coarse_pgtol, coarse_pgtol, guard=False)
+            coarse_levels = coarse_result['levels']
+            guess = np.clip( coarse_result['plan'][coarse_node], lower, upper )
+
+        res = fmin_l_bfgs_b( fm.utility_function, guess, fprime=fm.analytic_utility_gradient, factr=1., pgtol=pgtol, bounds=self.xbounds,
+                             maxfun=maxfun, args=args)
+        funcalls = res[2]['funcalls']
+        rejected = False
+        if guard and coarse_levels :
+            start_fit = fm.utility_function(np.asarray(self.guess, dtype=float), *args)
+            if res[1] > start_fit :
+                log.log_it('multilevel optimization: fit %f is worse than %f at the warm start, solving from the warm start' % (res[1], start_fit))
+                direct = fmin_l_bfgs_b( fm.utility_function, np.asarray(self.guess, dtype=float), fprime=fm.analytic_utility_gradient, factr=1.,
+                                        pgtol=pgtol, bounds=self.xbounds, maxfun=maxfun, args=args)
+                funcalls += direct[2]['funcalls']
+                if direct[1] < res[1] :
+                    res = direct
+                    rejected = True
+        fm.utility_function(res[0], *args)
+        scc = my_cost_model.price_by_state( res[0][0], 0., 0.)
+        coarse_levels.append( { 'nodes' : self.my_tree.x_dim, 'funcalls' : funcalls, 'fit' : res[1], 'scc' : scc } )
+        log.log_it('multilevel optimization: %i nodes fit %f scc %f in %i function calls' % (self.my_tree.x_dim, res[1], scc, funcalls))
+        return { 'plan' : res[0], 'fit' : res[1], 'converged' : res[2]['warnflag'] == 0, 'funcalls' : funcalls, 'rejected' : rejected,
+                 'levels' : coarse_levels }
+
+    def nested_optimization(self, my_damage_model, my_cost_model, maxfun=600, pgtol=1.0e-5):
+        '''Nested optimization: the last decision period, with one node per final state, is solved inside the objective
+            after the last decision there is no branching, each of its nodes only affects the utility of its own final state, so given
+            the mitigation of the earlier periods its nodes are independent one dimensional problems, solved for all nodes at once
+            by a grid scan and a golden section search (see dlw_utility.solve_leaves); L-BFGS runs on the mitigation of the earlier
+            periods only, with the gradient of the objective at the nested plan (envelope theorem, see dlw_utility.nested_utility_and_gradient)
+            set_constraints must be called first, and self.guess set
+
+        Parameters
+        ----------
+        my_damage_model : damage_class object
+            the damage model used in the optimization
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        maxfun : integer
+            maximum number of function evaluations
+
+        pgtol : float
+            projected gradient tolerance of the outer optimization
+
+        Returns
+        -------
+        result : dict
+            'plan', 'fit', 'converged', 'funcalls' and 'outer_nodes', the number of variables of the outer optimization
+        '''
+        args = (self.my_tree, my_damage_model, my_cost_model)
+        outer_nodes = self.my_tree.decision_period_pointer[self.my_tree.nperiods-1]
+        lower = np.array([ bound[0] for bound in self.xbounds[outer_nodes:] ], dtype=float)
+        upper = np.array([ bound[1] for bound in self.xbounds[outer_nodes:] ], dtype=float)
+        guess = np.asarray(self.guess, dtype=float)[:outer_nodes]
+        res = fmin_l_bfgs_b( fm.nested_utility_and_gradient, guess, factr=1., pgtol=pgtol,
+                             bounds=self.xbounds[:outer_nodes], maxfun=maxfun, args=(lower, upper) + args)
+        plan = fm.nested_plan(res[0], lower, upper, *args)
+        fit = fm.utility_function(plan, *args)
+        log.log_it('nested optimization: %i outer nodes fit %f in %i function calls' % (outer_nodes, fit, res[2]['funcalls']))
+        return { 'plan' : plan, 'fit' : fit, 'converged' : res[2]['warnflag'] == 0, 'funcalls' : res[2]['funcalls'], 'outer_nodes' : outer_nodes }
+
+    def multi_fidelity_optimization(self, my_damage_model, my_cost_model, schedule=[ 3 ], pgtols=[ 1.0e-3, 1.0e-4 ], maxfun=600, background=False, processes=1):
+        '''Optimization on a damage matrix refined as the plan converges
+            the damage model holds a matrix of a few Monte Carlo batches (see damage_model.start_batches); the plan is optimized on it
+            to a loose tolerance, the matrix is topped up to the next number of batches in schedule and the optimization continues
+            from the plan reached, and the last stage runs on all my_damage_model.over batches, the accuracy of damage_function_initialization;
+            with background the batches of the next stage are simulated in worker processes while the current stage is optimized
+            set_constraints must be called first, and self.guess set
+
+        Parameters
+        ----------
+        my_damage_model : damage_class object
+            the damage model used in the optimization, started with start_batches
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        schedule : list of integers
+            numbers of batches of the intermediate stages, increasing and below my_damage_model.over
+
+        pgtols : list of floats
+            projected gradient tolerance of the stages before the last one, the current matrix first, the last stage uses 1.0e-5
+
+        maxfun : integer
+            maximum number of function evaluations of each stage
+
+        background : boolean
+            if True, simulate the next batches in a pool of worker processes created for the optimization, only worth it
+            with spare cores and a simulation that takes a large part of the run
+
+        processes : integer
+            number of worker processes the batches of a stage are split over
+
+        Returns
+        -------
+        result : dict
+            'plan', 'fit', 'converged', 'funcalls' (of all the stages) and 'stages', a list of dicts with the 'batches',
+            'funcalls', 'fit' and 'scc' of every stage
+        '''
+        batches = [ my_damage_model.batches ] + list(schedule) + [ my_damage_model.over ]
+        if any( batches[stage+1] <= batches[stage] for stage in range(0, len(batches)-1) ) :
+            raise ValueError('the numbers of batches %s must increase up to over = %i' % (str(batches), my_damage_model.over))
+        if len(pgtols) != len(batches)-1 :
+            raise ValueError('%i stages before the last one need %i tolerances, not %i' % (len(batches)-1, len(batches)-1, len(pgtols)))
+        pgtols = list(pgtols) + [ 1.0e-5 ]
+        args = (self.my_tree, my_damage_model, my_cost_model)
+        pool = dlw_parallel.create_pool(self.my_tree, my_damage_model, my_cost_model, processes=processes) if background else None
+        x = np.asarray(self.guess, dtype=float)
+        funcalls = 0
+        stages = []
+        try:
+            for stage in range(0, len(batches)):
+                if pool is not None and stage < len(batches)-1 :
+                    shares = np.diff( np.linspace(batches[stage], batches[stage+1], min(processes, batches[stage+1]-batches[stage])+1).astype(int) )
+                    pending = [ pool.apply_async(dlw_parallel.simulate_batches, (share, np.random.randint(2**31))) for share in shares ]
+                res = fmin_l_bfgs_b( fm.utility_function, x, fprime=fm.analytic_utility_gradient, factr=1., pgtol=pgtols[stage], bounds=self.xbounds,
+                                     maxfun=maxfun, args=args)
+                x = res[0]
+                funcalls += res[2]['funcalls']
+                stages.append( { 'batches' : batches[stage], 'funcalls' : res[2]['funcalls'], 'fit' : res[1],
+                                 'scc' : my_cost_model.price_by_state( x[0], 0., 0.) } )
+                log.log_it('multi-fidelity optimization: %i batches fit %f scc %f in %i function calls'
+                           % (batches[stage], res[1], stages[-1]['scc'], res[2]['funcalls']))
+                if stage < len(batches)-1 :
+                    my_damage_model.add_batches( batches[stage+1]-batches[stage], sum([ task.get() for task in pending ]) if pool is not None else None )
+            if pool is not None :
+                pool.close()
+        finally:
+            if pool is not None :
+                pool.terminate()
+                pool.join()
+        fm.utility_function(x, *args)
+        return { 'plan' : x, 'fit' : res[1], 'converged' : res[2]['warnflag'] == 0, 'funcalls' : funcalls, 'stages' : stages }
+
+    def utility_grid_error(self, best_mitigation_plan, my_damage_model, my_cost_model):
+        '''Checks the utility periods of the tree against the uniform grid of sub_interval_length periods
+            a tree with utility_steps aggregates the sub-intervals of its longer utility periods (see dlw_utility.consumption_aggregation),
+            the objective and gradient of the plan are computed on both grids, with the same damage and cost models
+            the tree holds the state of the plan afterwards
+
+        Returns
+        -------
+        error : dict
+            'utility_error' (the objective on the tree less the objective on the uniform grid), 'gradient_error' (the largest
+            difference of the gradients), 'utility_nodes' and 'uniform_utility_nodes' (the size of the utility tree of both grids)
+        '''
+        tree = self.my_tree
+        uniform_tree = tree_model(tp1=tree.decision_times[1], analysis=tree.analysis, final_states=tree.final_states, nperiods=tree.nperiods,
+                                  peak_temp_interval=tree.peak_temp_interval, x_dim=tree.x_dim, sub_interval_length=tree.sub_interval_length,
+                                  prob_scale=tree.prob_scale, growth=tree.growth, eis=tree.eis, ra=tree.ra, time_pref=tree.time_pref,
+                                  branching=tree.branching, decision_times=list(tree.decision_times), print_options=tree.print_options)
+        ''' the damage model sets the probabilities of the tree it was initialized with '''
+        uniform_tree.probs[:] = tree.probs
+        uniform_tree.node_probs[:] = tree.node_probs
+        uniform_fit = fm.utility_function(best_mitigation_plan, uniform_tree, my_damage_model, my_cost_model)
+        uniform_gradient = fm.analytic_utility_gradient(best_mitigation_plan, uniform_tree, my_damage_model, my_cost_model).copy()
+        fit = fm.utility_function(best_mitigation_plan, tree, my_damage_model, my_cost_model)
+        gradient = fm.analytic_utility_gradient(best_mitigation_plan, tree, my_damage_model, my_cost_model)
+        error = { 'utility_error' : fit - uniform_fit, 'gradient_error' : np.abs(gradient - uniform_gradient).max(),
+                  'utility_nodes' : tree.utility_full_tree, 'uniform_utility_nodes' : uniform_tree.utility_full_tree }
+        log.log_it('utility grid check: %i utility nodes against %i, utility error %e gradient error %e'
+                   % (error['utility_nodes'], error['uniform_utility_nodes'], error['utility_error'], error['gradient_error']))
+        return error
+
     def find_term_structure(self, price, *var_args):
         '''    
           Function called by a zero root finder which is used
@@ -549,6 +970,85 @@ class optimize_plan(object):
     
         return(distance)
 
+    def term_structure(self, best_mitigation_plan, my_damage_model, my_cost_model):
+        '''Computes the term structure of risk free rates in one pass over the utility tree
+            the price at time 0 of $1 paid in every node at time t is the probability weighted sum of the stochastic discount factors
+            at time t, and the discount factors are products of the ratios of marginal utilities along the path to each node,
+            so one utility evaluation prices the bonds of every maturity (compare find_term_structure, which needs a root search per maturity)
+
+        Parameters
+        ----------
+        best_mitigation_plan : float
+            vector of degrees of mitigation
+
+        my_damage_model : damage_class object
+            the damage model used in the optimization
+
+        my_cost_model : cost_class object
+            the cost model used in the optimization
+
+        Returns
+        -------
+        years_to_maturity : float array
+            maturity of the bond paying at each utility period, element 0 is time 0
+
+        prices : float array
+            price of the zero coupon bonds, also stored in my_tree.discount_prices
+
+        yields : float array
+            annual yields in percent, element 0 is 0
+
+        perp_yield : float
+            yield of a perpetuity starting at the final utility period, see perpetuity_yield
+        '''
+        my_tree = self.my_tree
+        fm.utility_function( best_mitigation_plan, my_tree, my_damage_model, my_cost_model )
+        mu = my_tree.marginal_utility_by_state
+        years_to_maturity = np.array(my_tree.utility_times[:my_tree.utility_nperiods], dtype=float)
+        prices = np.ones(my_tree.utility_nperiods)
+        my_tree.sdf_in_tree[0] = 1.0
+        for time_period in range(1, my_tree.utility_nperiods):
+            ''' same indexing as the SCC decomposition in create_output: node probabilities are those of the next decision period '''
+            tree_node = my_tree.decision_period_pointer[ min( my_tree.nperiods-1, my_tree.utility_decision_period[time_period-1]+1) ]
+            first_node = my_tree.utility_period_pointer[time_period]
+            period_nodes = np.arange(my_tree.utility_period_nodes[time_period])
+            probs = my_tree.node_probs[tree_node+period_nodes]
+            if my_tree.information_period[time_period-1] == 1 :
+                from_nodes = my_tree.utility_period_pointer[time_period-1] + period_nodes // my_tree.branching
+                branch = period_nodes % my_tree.branching
+                total_prob = np.repeat( probs.reshape(-1, my_tree.branching).sum(axis=1), my_tree.branching )
+                sdf = (total_prob/probs) * mu[from_nodes,1+branch] / mu[from_nodes,0]
+            else :
+                from_nodes = my_tree.utility_period_pointer[time_period-1] + period_nodes
+                if time_period == my_tree.utility_nperiods-1 :
+                    sdf = my_tree.final_total_derivative_term[period_nodes] / mu[from_nodes,0]
+                else :
+                    sdf = mu[from_nodes,1] / mu[from_nodes,0]
+            ''' the marginal utilities of an aggregated utility period (see tree_model utility_steps) are per unit of its aggregated consumption,
+                the discount factors price a payment at the start of the period '''
+            sdf *= my_tree.payment_weight[first_node+period_nodes] / my_tree.payment_weight[from_nodes]
+            my_tree.sdf_in_tree[first_node+period_nodes] = my_tree.sdf_in_tree[from_nodes] * sdf
+            prices[time_period] = np.dot( my_tree.sdf_in_tree[first_node+period_nodes], probs )
+        my_tree.discount_prices[:my_tree.utility_nperiods] = prices
+        yields = np.zeros(my_tree.utility_nperiods)
+        yields[1:] = 100. * (1./(prices[1:]**(1./years_to_maturity[1:]))-1.)
+        perp_yield = brentq( self.perpetuity_yield, 0.1, 10., args=( years_to_maturity[-1], prices[-1]))
+        return years_to_maturity, prices, yields, perp_yield
+
+    def check_term_structure(self, best_mitigation_plan, my_damage_model, my_cost_model):
+        '''    compare the bond prices of term_structure with the root search on find_term_structure at every maturity
+                returns the two price arrays, the root search is slow and only meant for checking
+        '''
+        years_to_maturity, prices, yields, perp_yield = self.term_structure( best_mitigation_plan, my_damage_model, my_cost_model )
+        guess = self.guess
+        self.guess = best_mitigation_plan
+        brentq_prices = np.ones(self.my_tree.utility_nperiods)
+        for u_period in range(1, self.my_tree.utility_nperiods):
+            brentq_prices[u_period] = brentq( self.find_term_structure, 0., .9999, args=( self.my_tree, my_damage_model, self, my_cost_model, u_period))
+        self.guess = guess
+        log.log_it('term structure: largest difference from the root search %e' % np.abs(prices-brentq_prices).max())
+        return prices, brentq_prices
+
     def create_consumption(self, best_mitigation_plan, best_fit, my_damage_model, my_cost_model, my_tree):
         '''   writes the output of consumption to the console
         Parameters
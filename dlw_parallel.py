@@ -0,0 +1,499 @@
+'''
+   Process pool helpers for the dlw climate model
+   the tree, damage and cost models are handed to each worker process once by the pool initializer,
+   tasks then only carry mitigation plans and bounds
+'''
+import multiprocessing
+import queue
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+import dlw_utility as fm
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+'''  the (tree, damage model, cost model) of the worker process, set by init_worker '''
+worker_model = None
+'''  event shared by the pool, once set the optimizations still running stop at their next function evaluation '''
+worker_cancel = None
+
+class optimization_cancelled(Exception):
+    '''Raised inside a worker optimization when the pool's cancel event is set
+    '''
+    pass
+
+def init_worker(my_tree, my_damage_model, my_cost_model, cancel=None):
+    '''    pool initializer: keep the models for all the tasks run by this worker
+    '''
+    global worker_model, worker_cancel
+    worker_model = (my_tree, my_damage_model, my_cost_model)
+    worker_cancel = cancel
+
+def create_pool(my_tree, my_damage_model, my_cost_model, processes=None, cancel=None):
+    '''Creates a pool of worker processes, each holding its own copy of the models
+
+    Parameters
+    ----------
+    my_tree, my_damage_model, my_cost_model : model objects
+        the loaded models, copied to each worker once
+
+    processes : integer
+        number of worker processes, None uses every core
+
+    cancel : multiprocessing Event
+        if given, setting it stops the optimizations running in the pool
+
+    Returns
+    -------
+    pool : multiprocessing Pool
+    '''
+    return multiprocessing.Pool(processes, initializer=init_worker, initargs=(my_tree, my_damage_model, my_cost_model, cancel))
+
+def halton(points, dimension, shift=None):
+    '''Creates a Halton quasi-random sequence in the unit cube
+
+    Parameters
+    ----------
+    points : integer
+        number of points
+
+    dimension : integer
+        dimension of the cube
+
+    shift : float vector
+        random shift applied modulo 1 to every point (Cranley-Patterson rotation), None for no shift
+
+    Returns
+    -------
+    sequence : float array
+        [points] x [dimension] array of points in [0, 1)
+    '''
+    primes = []
+    candidate = 2
+    while len(primes) < dimension :
+        if all( candidate % prime != 0 for prime in primes ):
+            primes.append(candidate)
+        candidate += 1
+    sequence = np.zeros([points, dimension])
+    for d in range(0, dimension):
+        for i in range(0, points):
+            f = 1.
+            n = i+1
+            while n > 0 :
+                f /= primes[d]
+                sequence[i, d] += f * (n % primes[d])
+                n //= primes[d]
+    if shift is not None :
+        sequence = (sequence + shift) % 1.
+    return sequence
+
+def optimize_start(start, guess, xbounds, maxfun=600, trace=None):
+    '''Runs one L-BFGS optimization in a worker process, see init_worker
+
+    Parameters
+    ----------
+    start : integer or string
+        index of the starting point, or name of the task, returned with the result
+
+    guess : float vector
+        the starting mitigation plan
+
+    xbounds : list
+        the bounds on mitigation, as set by optimize_plan.set_constraints
+
+    maxfun : integer
+        maximum number of function evaluations
+
+    trace : optimization_trace object
+        if given, the optimization is traced and checkpointed, see dlw_trace
+
+    Returns
+    -------
+    result : dict
+        'start', 'plan' (the full plan, pinned variables included), 'fit', 'converged', 'cancelled' and 'funcalls'
+        a cancelled optimization returns the best plan it evaluated
+    '''
+    my_tree, my_damage_model, my_cost_model = worker_model
+    ''' the variables pinned by the bounds are mapped out, the optimizer only sees (and the gradient only computes) the free ones '''
+    free, template = fm.reduced_plan(guess, xbounds)
+    free_bounds = [ xbounds[i] for i in free ]
+    args = (free, template, my_tree, my_damage_model, my_cost_model)
+    best = [ np.inf, template.copy() ]
+    funcalls = [ 0 ]
+
+    def objective(x_free, *var_args):
+        if worker_cancel is not None and worker_cancel.is_set() :
+            raise optimization_cancelled()
+        fit = fm.reduced_utility_function(x_free, *var_args)
+        funcalls[0] += 1
+        if fit < best[0] :
+            best[0] = fit
+            best[1] = fm.expand_plan(x_free, free, template)
+        return fit
+
+    try:
+        if trace is not None :
+            res = trace.minimize( objective, template[free], fm.reduced_utility_gradient, free_bounds, factr=1., pgtol=1.0e-5, maxfun=maxfun,
+                                  args=args)
+        else :
+            res = fmin_l_bfgs_b( objective, template[free], fprime=fm.reduced_utility_gradient, factr=1., pgtol=1.0e-5, bounds=free_bounds, maxfun=maxfun,
+                                 args=args)
+        return { 'start' : start, 'plan' : fm.expand_plan(res[0], free, template), 'fit' : res[1], 'converged' : res[2]['warnflag'] == 0,
+                 'cancelled' : False, 'funcalls' : res[2]['funcalls'] }
+    except optimization_cancelled :
+        return { 'start' : start, 'plan' : best[1], 'fit' : best[0], 'converged' : False,
+                 'cancelled' : True, 'funcalls' : funcalls[0] }
+
+def optimize_start_args(args):
+    '''    unpack the arguments of optimize_start for Pool.imap_unordered
+    '''
+    return optimize_start(*args)
+
+def multi_start(my_tree, my_damage_model, my_cost_model, starts, xbounds, processes=None, agree=2, tolerance=1.0e-7, maxfun=600):
+    '''Optimizes from several starting plans in a process pool and keeps the best result
+        once "agree" converged optimizations reach the best objective (within tolerance) the winner is clear
+        and the optimizations still running are cancelled
+
+    Parameters
+    ----------
+    my_tree, my_damage_model, my_cost_model : model objects
+        the loaded models, copied once to each worker
+
+    starts : float array
+        [nstarts] x [x_dim] starting plans
+
+    xbounds : list
+        the bounds on mitigation
+
+    processes : integer
+        number of worker processes, None uses every core
+
+    agree : integer
+        number of converged optimizations that must agree on the best objective before stragglers are cancelled
+
+    tolerance : float
+        relative difference in objective within which two optimizations agree
+
+    maxfun : integer
+        maximum number of function evaluations per start
+
+    Returns
+    -------
+    result : dict
+        'plan' and 'fit' of the best start, 'fits' of every start (best so far for cancelled starts),
+        'spread' (max - min) and 'std' of the converged objectives, 'converged' and 'cancelled' counts
+    '''
+    cancel = multiprocessing.Event()
+    pool = create_pool(my_tree, my_damage_model, my_cost_model, processes=processes, cancel=cancel)
+    results = []
+    try:
+        tasks = [ (start, starts[start], xbounds, maxfun) for start in range(0, len(starts)) ]
+        for result in pool.imap_unordered(optimize_start_args, tasks):
+            results.append(result)
+            log.log_it('multi start %i: fit %f converged %i cancelled %i' % (result['start'], result['fit'], result['converged'], result['cancelled']))
+            converged = np.array([ r['fit'] for r in results if r['converged'] ])
+            if not cancel.is_set() and len(converged) >= agree :
+                best = converged.min()
+                if np.sum( converged - best <= tolerance * abs(best) ) >= agree :
+                    log.log_it('multi start: %i starts agree on fit %f, cancelling the rest' % (agree, best))
+                    cancel.set()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    results.sort(key=lambda r: r['start'])
+    fits = np.array([ r['fit'] for r in results ])
+    best = int(np.argmin(fits))
+    converged = np.array([ r['fit'] for r in results if r['converged'] ])
+    if len(converged) == 0 :
+        converged = fits
+    return { 'plan' : results[best]['plan'], 'fit' : fits[best], 'fits' : fits, 'start' : results[best]['start'],
+             'spread' : converged.max() - converged.min(), 'std' : converged.std(),
+             'converged' : sum( r['converged'] for r in results ), 'cancelled' : sum( r['cancelled'] for r in results ) }
+
+def task_ready(task, results):
+    '''    a task can start once every task it comes after is complete
+    '''
+    return all( name in results for name in task.get('after', []) )
+
+def task_arguments(task, results, maxfun):
+    '''    the optimize_start arguments of a task, guess and bounds given as functions are evaluated on the completed results
+    '''
+    guess = task['guess'](results) if callable(task['guess']) else task['guess']
+    xbounds = task['bounds'](results) if callable(task['bounds']) else task['bounds']
+    return ( task['name'], np.array(guess, dtype=float), xbounds, maxfun, task.get('trace') )
+
+def run_task_graph(my_tree, my_damage_model, my_cost_model, tasks, processes=None, maxfun=600):
+    '''Runs a graph of optimizations, each task starts as soon as the tasks it depends on are complete
+        so independent optimizations run at the same time in separate worker processes
+
+    Parameters
+    ----------
+    my_tree, my_damage_model, my_cost_model : model objects
+        the loaded models, copied once to each worker
+
+    tasks : list of dict
+        'name' of the task, starting 'guess' and 'bounds' (see optimize_plan.set_constraints),
+        and optionally 'after', the names of the tasks it depends on, and 'trace', an optimization_trace (see dlw_trace)
+        guess and bounds can be functions of the dict of completed results, so a dependent task
+        is warm-started from (and constrained by) the plans of the tasks it comes after
+
+    processes : integer
+        number of worker processes, at most one per task; None or 1 runs the tasks one after the other in this process,
+        so a caller that cannot start child processes (eg a Celery worker) never creates a pool unless it asks for one
+
+    maxfun : integer
+        maximum number of function evaluations per task
+
+    Returns
+    -------
+    results : dict
+        task name -> result of optimize_start ('plan', 'fit', 'converged', 'funcalls')
+    '''
+    results = {}
+    pending = list(tasks)
+    if processes is None or processes <= 1 or len(tasks) <= 1 :
+        init_worker(my_tree, my_damage_model, my_cost_model)
+        while pending :
+            ready = [ task for task in pending if task_ready(task, results) ]
+            if len(ready) == 0 :
+                raise ValueError('task graph has tasks that depend on tasks not in the graph: %s' % [ task['name'] for task in pending ])
+            task = ready[0]
+            pending.remove(task)
+            results[ task['name'] ] = optimize_start( *task_arguments(task, results, maxfun) )
+            log.log_it('task %s: fit %f converged %i' % (task['name'], results[task['name']]['fit'], results[task['name']]['converged']))
+        return results
+
+    completed = queue.Queue()
+    pool = create_pool(my_tree, my_damage_model, my_cost_model, processes=min(processes, len(tasks)))
+    try:
+        running = 0
+        while pending or running :
+            for task in [ task for task in pending if task_ready(task, results) ] :
+                pending.remove(task)
+                pool.apply_async( optimize_start, task_arguments(task, results, maxfun), callback=completed.put, error_callback=completed.put )
+                running += 1
+            if running == 0 :
+                raise ValueError('task graph has tasks that depend on tasks not in the graph: %s' % [ task['name'] for task in pending ])
+            result = completed.get()
+            running -= 1
+            if isinstance(result, Exception) :
+                raise result
+            results[ result['start'] ] = result
+            log.log_it('task %s: fit %f converged %i' % (result['start'], result['fit'], result['converged']))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def gradient_shard(x, coordinates, delta, stencil):
+    '''Utility of the plan x perturbed in each of a shard of coordinates, run in a worker process, see init_worker
+
+    Returns
+    -------
+    values : float array
+        [coordinates] x 2 array, the objective at x + delta and at x - delta in each coordinate
+        (only the side the stencil uses is evaluated, the other is 0)
+    '''
+    my_tree, my_damage_model, my_cost_model = worker_model
+    values = np.zeros([len(coordinates), 2])
+    for i, n in enumerate(coordinates) :
+        for side, sign in [ (0, 1.), (1, -1.) ] :
+            if (stencil == 'forward' and side == 1) or (stencil == 'backward' and side == 0) :
+                continue
+            x_n = np.array(x, dtype=float)
+            x_n[n] += sign * delta
+            values[i, side] = fm.utility_function(x_n, my_tree, my_damage_model, my_cost_model)
+    return values
+
+def gradient_shard_args(args):
+    '''    unpack the arguments of gradient_shard for Pool.map_async
+    '''
+    return gradient_shard(*args)
+
+def simulate_batches(nbatches, seed):
+    '''    Monte Carlo batches of the damage model of the worker process, seeded by the caller so every task draws new outcomes,
+        see damage_model.simulate_batches
+    '''
+    my_tree, my_damage_model, my_cost_model = worker_model
+    np.random.seed(seed)
+    return my_damage_model.simulate_batches(nbatches)
+
+'''  the tree arrays written by the utility recursion, held in shared memory by a subtree evaluation '''
+shared_tree_arrays = [ 'ave_mitigation', 'cost_by_state', 'damage_by_state', 'final_damage_by_state', 'consumption_by_state', 'utility_by_state',
+                       'cert_equiv_utility', 'ce_term', 'marginal_utility_by_state', 'marginal_utility_in_tree', 'final_total_derivative_term',
+                       'consumption_aggregation', 'payment_weight' ]
+'''  the plan of the subtree evaluation of the worker process, in shared memory, set by init_subtree_worker '''
+worker_plan = None
+
+def shared_array(buffer, shape):
+    '''    numpy view of a shared memory buffer of doubles
+    '''
+    return np.frombuffer(buffer, dtype=float).reshape(shape)
+
+def init_subtree_worker(my_tree, my_damage_model, my_cost_model, buffers, plan_buffer):
+    '''    pool initializer of a subtree evaluation: keep the models, with the recursion arrays of the tree and the plan in shared memory
+    '''
+    global worker_model, worker_plan
+    for name in shared_tree_arrays :
+        setattr(my_tree, name, shared_array(buffers[name], getattr(my_tree, name).shape))
+    worker_model = (my_tree, my_damage_model, my_cost_model)
+    worker_plan = shared_array(plan_buffer, (my_tree.x_dim,))
+
+def subtree_utility_task(args):
+    '''    the utility recursion of one subtree at the shared plan, see dlw_utility.subtree_utility
+    '''
+    split_period, subtree = args
+    fm.subtree_utility(worker_plan, split_period, subtree, *worker_model)
+
+def subtree_gradient_task(columns):
+    '''    the columns of the analytic gradient at the shared plan, the tree arrays must hold the utility evaluation of the plan
+    '''
+    return fm.analytic_utility_gradient(worker_plan, *worker_model, columns=columns)[columns].copy()
+
+class subtree_evaluation(object):
+    '''Utility and analytic gradient of deep trees evaluated in parallel over the subtrees the tree splits into at decision period split_period
+        the subtrees are independent: each worker runs the utility recursion of a subtree (see dlw_utility.subtree_utility) into
+        the tree arrays, which are held in shared memory, and this process completes the periods before split_period (dlw_utility.root_utility);
+        the gradient is split by columns, each task differentiates with respect to the mitigations of one subtree and a share of the nodes
+        before split_period
+        the models are copied to the workers when the object is created and must not change while it is open, close it when done;
+        utility and gradient can be passed as func and fprime to fmin_l_bfgs_b, gradient must follow utility at the same plan
+    '''
+    def __init__(self, my_tree, my_damage_model, my_cost_model, split_period=None, processes=None):
+        '''Initializes the evaluation
+
+        Parameters
+        ----------
+        my_tree, my_damage_model, my_cost_model : model objects
+            the loaded models
+
+        split_period : integer
+            decision period the tree is split at, from 1 to nperiods-2, None uses the first period with at least one subtree per process
+
+        processes : integer
+            number of worker processes, None uses every core
+        '''
+        self.models = (my_tree, my_damage_model, my_cost_model)
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        if split_period is None :
+            split_period = 1
+            while my_tree.branching**split_period < self.processes and split_period < my_tree.nperiods-2 :
+                split_period += 1
+        if split_period < 1 or split_period > my_tree.nperiods-2 :
+            raise ValueError('a tree of %i periods is split at decision periods 1 to %i, not %i' % (my_tree.nperiods, my_tree.nperiods-2, split_period))
+        self.split_period = split_period
+        self.nsubtrees = my_tree.branching**split_period
+        ''' the arrays of this tree are replaced by views of the shared buffers, the workers get views of the same buffers '''
+        self.buffers = {}
+        for name in shared_tree_arrays :
+            array = getattr(my_tree, name)
+            self.buffers[name] = multiprocessing.RawArray('d', array.size)
+            shared = shared_array(self.buffers[name], array.shape)
+            shared[...] = array
+            setattr(my_tree, name, shared)
+        self.plan_buffer = multiprocessing.RawArray('d', my_tree.x_dim)
+        self.plan = shared_array(self.plan_buffer, (my_tree.x_dim,))
+        self.pool = multiprocessing.Pool(self.processes, initializer=init_subtree_worker,
+                                         initargs=(my_tree, my_damage_model, my_cost_model, self.buffers, self.plan_buffer))
+        self.columns = [ list(my_tree.subtree_nodes(split_period, subtree)[1]) for subtree in range(0, self.nsubtrees) ]
+        for node in range(0, my_tree.decision_period_pointer[split_period]):
+            self.columns[node % self.nsubtrees].append(node)
+        log.log_it('subtree evaluation: %i subtrees at decision period %i over %i processes' % (self.nsubtrees, split_period, self.processes))
+
+    def utility(self, x, *var_args):
+        '''    the objective at x, as dlw_utility.utility_function, var_args are ignored (the workers hold the models)
+        '''
+        self.plan[:] = x
+        self.pool.map(subtree_utility_task, [ (self.split_period, subtree) for subtree in range(0, self.nsubtrees) ])
+        return fm.root_utility(np.array(x, dtype=float), self.split_period, *self.models)
+
+    def gradient(self, x, *var_args):
+        '''    the analytic gradient at x, as dlw_utility.analytic_utility_gradient, utility must have been evaluated at x
+        '''
+        self.plan[:] = x
+        my_tree = self.models[0]
+        for columns, grad in zip(self.columns, self.pool.map(subtree_gradient_task, self.columns)) :
+            my_tree.grad[columns] = grad
+        return my_tree.grad
+
+    def close(self):
+        '''    shut down the worker processes and give the tree back arrays of its own
+        '''
+        if self.pool is not None :
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            my_tree = self.models[0]
+            for name in shared_tree_arrays :
+                setattr(my_tree, name, np.array(getattr(my_tree, name)))
+
+class finite_difference_gradient(object):
+    '''Finite difference gradient of the objective with the coordinates sharded over a pool of worker processes
+        the models are copied to each worker once, when the pool is created, so each gradient only sends the plan;
+        with one shard per core a gradient takes about the time of x_dim / processes utility evaluations
+        used to validate the analytic gradient, and where the objective is not smooth (where the damage function
+        switches pieces at emit_percentage[1], or mitigation above 1.) to choose a one-sided stencil
+        an instance can be passed as fprime to fmin_l_bfgs_b; close the pool when done
+    '''
+    def __init__(self, my_tree, my_damage_model, my_cost_model, processes=None, stencil='central', delta=None):
+        '''Initializes the gradient
+
+        Parameters
+        ----------
+        my_tree, my_damage_model, my_cost_model : model objects
+            the loaded models
+
+        processes : integer
+            number of worker processes, None uses every core, 1 evaluates in this process
+
+        stencil : string
+            'central' (x + delta and x - delta), 'forward' (x and x + delta) or 'backward' (x - delta and x)
+
+        delta : float
+            step, None uses 1e-5 for the central stencil and 1e-7 for the one-sided stencils, as numerical_utility_gradient
+        '''
+        if stencil not in [ 'central', 'forward', 'backward' ] :
+            raise ValueError('unknown finite difference stencil %s' % stencil)
+        self.models = (my_tree, my_damage_model, my_cost_model)
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.stencil = stencil
+        self.delta = delta if delta is not None else ( .00001 if stencil == 'central' else .0000001 )
+        self.pool = create_pool(my_tree, my_damage_model, my_cost_model, processes=self.processes) if self.processes > 1 else None
+
+    def __call__(self, x, *var_args):
+        '''Computes the gradient at x, var_args are ignored (the workers hold the models)
+
+        Returns
+        -------
+        grad : float vector
+            derivative of the objective with respect to each element of x
+        '''
+        x = np.array(x, dtype=float)
+        shards = [ (x, coordinates, self.delta, self.stencil) for coordinates in np.array_split(np.arange(len(x)), max(self.processes, 1)) if len(coordinates) ]
+        if self.pool is None :
+            init_worker(*self.models)
+            pending = None
+            values = [ gradient_shard(*shard) for shard in shards ]
+        else :
+            pending = self.pool.map_async(gradient_shard_args, shards)
+        ''' the base objective is evaluated here while the workers evaluate the perturbed plans '''
+        base = fm.utility_function(x, *self.models) if self.stencil != 'central' else 0.
+        if pending is not None :
+            values = pending.get()
+        values = np.vstack(values)
+        if self.stencil == 'central' :
+            return (values[:,0] - values[:,1]) / (2.*self.delta)
+        if self.stencil == 'forward' :
+            return (values[:,0] - base) / self.delta
+        return (base - values[:,1]) / self.delta
+
+    def close(self):
+        '''    shut down the worker processes
+        '''
+        if self.pool is not None :
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,230 @@
+'''
+   Stage-cached pipeline for the dlw climate model
+   a run is split into stages -- topology, damage matrix, interpolation coefficients, optimal plan and analysis outputs --
+   each identified by a hash of its own inputs and the hash of the stage before it, and each stage's artifact is kept on disk
+   a run whose upstream inputs are unchanged (for example only ra changed) loads the artifacts of the unchanged stages
+   and computes from the first affected stage on
+'''
+import os
+import json
+import pickle
+import hashlib
+import configparser
+import dlw_utility as fm
+from dlw_damage_class import damage_model
+from dlw_optimize_class import optimize_plan
+from dlw_warm_start import warm_start_store, model_parameters
+from dlw_trace import optimization_trace, job_name
+import dlw_sweep
+from dlw_sweep import point_parameters, build_tree, set_utility_parameters, build_cost_model
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+'''  changing the version invalidates every cached artifact, raise it when a stage computes something different '''
+pipeline_version = 1
+'''  the stages in run order, and the parameters each stage reads (besides the output of the stage before it) '''
+stage_names = [ 'topology', 'damage', 'interpolation', 'plan', 'analysis' ]
+stage_parameters = { 'topology' : [ 'tp1', 'final_states', 'growth' ],
+                     'damage' : [ 'peak_temp', 'disaster_tail', 'draws' ],
+                     'interpolation' : [],
+                     'plan' : [ 'ra', 'eis', 'time_pref', 'g', 'a', 'join', 'max_price', 'teconst', 'tescale' ],
+                     'analysis' : [ 'analysis' ] }
+
+def stage_keys(params):
+    '''Computes the content hash of every stage, each hash covers the stage's parameters and the hash of the stage before it
+
+    Parameters
+    ----------
+    params : dict
+        full parameter dict, see dlw_sweep.point_parameters, plus 'analysis'
+
+    Returns
+    -------
+    keys : dict
+        stage name -> hash
+    '''
+    keys = {}
+    previous = str(pipeline_version)
+    for stage in stage_names :
+        inputs = [ stage, previous ] + [ [name, params[name]] for name in stage_parameters[stage] ]
+        previous = hashlib.md5( json.dumps(inputs, default=float).encode() ).hexdigest()[:16]
+        keys[stage] = previous
+    return keys
+
+class stage_cache(object):
+    '''On-disk store of stage artifacts, one pickle file per stage and hash
+    '''
+    def __init__(self, cache_path):
+        '''    cache_path is the directory of the artifact files, created if needed
+        '''
+        self.cache_path = cache_path
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+
+    def filename(self, stage, key):
+        '''    the artifact file of a stage
+        '''
+        return os.path.join(self.cache_path, '%s_%s.pkl' % (stage, key))
+
+    def get(self, stage, key):
+        '''    the artifact of a stage, None if it has not been computed
+        '''
+        if not os.path.exists(self.filename(stage, key)):
+            return None
+        with open(self.filename(stage, key), 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, stage, key, artifact):
+        '''    write the artifact of a stage, through a temporary file so concurrent jobs never read a partial artifact
+        '''
+        temp_filename = self.filename(stage, key) + '.%i.tmp' % os.getpid()
+        with open(temp_filename, 'wb') as f:
+            pickle.dump(artifact, f)
+        os.replace(temp_filename, self.filename(stage, key))
+
+    def run(self, stage, key, compute, report):
+        '''    load the artifact of a stage, or compute and store it; report records whether it was 'reused' or 'computed'
+        '''
+        artifact = self.get(stage, key)
+        if artifact is None :
+            artifact = compute()
+            self.put(stage, key, artifact)
+            report[stage] = 'computed'
+        else :
+            report[stage] = 'reused'
+        log.log_it('pipeline stage %s %s: %s' % (stage, key, report[stage]))
+        return artifact
+
+def default_cache_path():
+    '''    the pipeline directory under the output path of settings.config
+    '''
+    config = configparser.ConfigParser()
+    config.read('settings.config')
+    return os.path.join(config['DEFAULT']['output_path'], 'pipeline')
+
+def prepare_models(params, keys, cache, report):
+    '''Runs the topology, damage and interpolation stages
+
+    Parameters
+    ----------
+    params : dict
+        full parameter dict, see dlw_sweep.point_parameters, plus 'analysis'
+
+    keys : dict
+        stage hashes, see stage_keys
+
+    cache : stage_cache object
+        the artifact store
+
+    report : dict
+        stage name -> 'reused' or 'computed', filled in
+
+    Returns
+    -------
+    my_tree, my_damage_model : model objects
+        ready for the utility function
+    '''
+    my_tree = cache.run('topology', keys['topology'], lambda: build_tree(params, params['analysis']), report)
+    my_tree.analysis = params['analysis']
+    set_utility_parameters(my_tree, params)
+    my_damage_model = damage_model(my_tree=my_tree, peak_temp=params['peak_temp'], disaster_tail=params['disaster_tail'], draws=params['draws'])
+
+    def compute_damage():
+        ''' the damage simulation goes through one file, worker processes take turns (see dlw_sweep.init_sweep_worker) '''
+        if dlw_sweep.damage_lock is not None :
+            with dlw_sweep.damage_lock :
+                my_damage_model.damage_function_initialization()
+        else :
+            my_damage_model.damage_function_initialization()
+        return { 'd' : my_damage_model.d.copy(), 'emit_percentage' : my_damage_model.emit_percentage,
+                 'bau_emissions' : my_damage_model.bau_emissions, 'ww_ghg' : my_damage_model.ww_ghg }
+
+    damage = cache.run('damage', keys['damage'], compute_damage, report)
+    my_damage_model.d = damage['d'].copy()
+    my_damage_model.emit_percentage = damage['emit_percentage']
+    my_damage_model.bau_emissions = damage['bau_emissions']
+    my_damage_model.ww_ghg = damage['ww_ghg']
+
+    def compute_interpolation():
+        my_damage_model.initialize_tree()
+        return { 'd' : my_damage_model.d, 'probs' : my_tree.probs, 'node_probs' : my_tree.node_probs,
+                 'dfc' : my_damage_model.damage_function_interpolation() }
+
+    interpolation = cache.run('interpolation', keys['interpolation'], compute_interpolation, report)
+    my_damage_model.d = interpolation['d']
+    my_tree.probs[:] = interpolation['probs']
+    my_tree.node_probs[:] = interpolation['node_probs']
+    my_damage_model.damage_function_interpolation_coefficients = interpolation['dfc']
+    my_damage_model.dfc = interpolation['dfc']
+    my_damage_model.compress_states()
+    return my_tree, my_damage_model
+
+def run_pipeline(point=None, analysis=4, processes=None, cache_path=None):
+    '''Runs the model as a pipeline of cached stages
+        topology: the tree, before the damage model adjusts its probabilities
+        damage: the Monte Carlo damage matrix
+        interpolation: the recombined damage matrix, the tree probabilities and the damage interpolation coefficients
+        plan: the unconstrained optimal plan, solved for every analysis and used as the starting point of analysis 3 and 4
+        analysis: the outputs of run_analysis
+
+    Parameters
+    ----------
+    point : dict
+        the parameters that differ from dlw_sweep.default_parameters, eg { 'ra' : 5. }
+
+    analysis : integer
+        the analysis run on the optimal plan, see run_model
+
+    processes : integer
+        number of worker processes for the independent optimizations of the analysis
+
+    cache_path : string
+        directory of the artifacts, None uses the pipeline directory under the output path
+
+    Returns
+    -------
+    outputs : dict
+        'cost_per_ton', 'delta_emissions_gigatons', 'scc', 'plan' and 'fit'
+
+    report : dict
+        stage name -> 'reused' or 'computed'
+    '''
+    from dlw_run import run_analysis
+    params = point_parameters(point or {})
+    params['analysis'] = analysis
+    keys = stage_keys(params)
+    if cache_path is None :
+        cache_path = default_cache_path()
+    cache = stage_cache(cache_path)
+    report = {}
+    my_tree, my_damage_model = prepare_models(params, keys, cache, report)
+
+    my_cost_model = build_cost_model(my_tree, params)
+    my_optimization = optimize_plan(my_tree=my_tree)
+    my_warm_start = warm_start_store(my_optimization.output_path, my_tree.nperiods, my_tree.final_states, my_tree.x_dim)
+    run_parameters = model_parameters(my_tree, my_damage_model, my_cost_model)
+
+    def compute_plan():
+        my_optimization.get_warm_start(my_warm_start, run_parameters)
+        my_optimization.set_constraints(constrain=0)
+        trace = optimization_trace(my_optimization.output_path, job_name(run_parameters, 'optimal', my_damage_model))
+        res = trace.minimize( fm.utility_function, my_optimization.guess, fm.analytic_utility_gradient, my_optimization.xbounds, factr=1., pgtol=1.0e-5,
+                              maxfun=600, args=([my_tree, my_damage_model, my_cost_model]))
+        my_warm_start.add(run_parameters, res[0], res[1])
+        return { 'plan' : res[0], 'fit' : res[1] }
+
+    plan = cache.run('plan', keys['plan'], compute_plan, report)
+    my_optimization.guess = plan['plan'].copy()
+
+    def compute_analysis():
+        cost_per_ton, delta_emissions_gigatons = run_analysis(my_tree, my_damage_model, my_cost_model, my_optimization, my_warm_start,
+                                                              run_parameters, plan['plan'].copy(), plan['fit'], processes=processes)
+        return { 'cost_per_ton' : cost_per_ton, 'delta_emissions_gigatons' : delta_emissions_gigatons }
+
+    outputs = dict( cache.run('analysis', keys['analysis'], compute_analysis, report) )
+    outputs['scc'] = my_cost_model.price_by_state( plan['plan'][0], 0., 0.)
+    outputs['plan'] = plan['plan']
+    outputs['fit'] = plan['fit']
+    log.log_it('pipeline: %s' % ', '.join([ '%s %s' % (stage, report[stage]) for stage in stage_names ]))
+    return outputs, report
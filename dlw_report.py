@@ -0,0 +1,168 @@
+'''
+   Reports of a mitigation plan of the dlw climate model
+   the node outputs of create_output are computed as arrays: a table of the decision tree nodes, a table of the utility tree nodes
+   and a table of the utility periods (term structure and SCC decomposition), and each report is written to one npz file
+'''
+import os
+import numpy as np
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+def path_average_mitigation(my_tree, best_mitigation_plan):
+    '''    the average mitigation along the path to every decision node, weighted by period length, as used to price the node
+    '''
+    average_mitigation = np.zeros(my_tree.x_dim)
+    for p in range(1, my_tree.nperiods):
+        period_nodes = np.arange(my_tree.decision_nodes[p])
+        total = np.zeros(my_tree.decision_nodes[p]) + best_mitigation_plan[0] * my_tree.decision_times[1]
+        for pp in range(1, p):
+            total += best_mitigation_plan[ my_tree.decision_period_pointer[pp] + period_nodes // my_tree.branching**(p-pp) ] * (my_tree.decision_times[pp+1]-my_tree.decision_times[pp])
+        average_mitigation[ my_tree.decision_period_pointer[p] + period_nodes ] = total / my_tree.decision_times[p]
+    return average_mitigation
+
+def decision_table(my_tree, best_mitigation_plan, my_cost_model):
+    '''Node table of the decision tree, the tree arrays must hold the state of a utility evaluation of the plan
+
+    Returns
+    -------
+    table : dict of arrays
+        one element per decision node: 'node', 'period', 'year', 'prob', 'mitigation', 'price', 'consumption', 'cost', 'damage',
+        'ghg', 'average_mitigation', 'average_emissions', 'mu', 'mu_up', 'mu_down', 'sdf_up', 'sdf_down'
+        the last decision period does not branch, its 'sdf_up' is the discount factor of the next period and its 'sdf_down' is nan
+        in a tree branching more than two ways, up is the first branch and down the last
+    '''
+    nodes = np.arange(my_tree.x_dim)
+    period = np.array(my_tree.period_map[:my_tree.x_dim])
+    decision_times = np.array(my_tree.decision_times, dtype=float)
+    emissions_to_bau = my_tree.emissions_to_ghg[my_tree.nperiods-1] / my_tree.emissions_per_period[my_tree.nperiods-1]
+    period_length = decision_times[period+1] - decision_times[period]
+    mu = my_tree.marginal_utility_in_tree[nodes]
+
+    branch = period < my_tree.nperiods-1
+    up_node = np.array([ my_tree.next_node[n][0] if branch[n] else n for n in nodes ])
+    down_node = np.array([ my_tree.next_node[n][1] if branch[n] else n for n in nodes ])
+    prob_up = my_tree.node_probs[up_node]
+    prob_down = my_tree.node_probs[down_node]
+    total_prob = np.array([ my_tree.node_probs[up_node[n]:down_node[n]+1].sum() for n in nodes ])
+    sdf_up = np.where( branch, (total_prob/prob_up) * mu[:,1] / mu[:,0], mu[:,1] / mu[:,0] )
+    sdf_down = np.where( branch, (total_prob/prob_down) * mu[:,my_tree.branching] / mu[:,0], np.nan )
+
+    return { 'node' : nodes, 'period' : period, 'year' : 2015 + decision_times[period], 'prob' : my_tree.node_probs[nodes],
+             'mitigation' : np.array(best_mitigation_plan, dtype=float),
+             'price' : my_cost_model.price_by_state_array( best_mitigation_plan, path_average_mitigation(my_tree, best_mitigation_plan), my_cost_model.tc_years ),
+             'consumption' : np.array(my_tree.potential_consumption)[period] * (1.-my_tree.damage_by_state[nodes]) * (1.-my_tree.cost_by_state[nodes]),
+             'cost' : my_tree.cost_by_state[nodes].copy(), 'damage' : my_tree.damage_by_state[nodes].copy(), 'ghg' : my_tree.ghg_by_state[nodes].copy(),
+             'average_mitigation' : my_tree.ave_mitigation[nodes].copy(),
+             'average_emissions' : my_tree.additional_emissions_by_state[nodes] / (period_length*emissions_to_bau),
+             'mu' : mu[:,0].copy(), 'mu_up' : mu[:,1].copy(), 'mu_down' : mu[:,my_tree.branching].copy(), 'sdf_up' : sdf_up, 'sdf_down' : sdf_down }
+
+def final_table(my_tree):
+    '''    table of the final states: 'ghg', 'damage' (forward damage) and 'consumption'
+    '''
+    final_nodes = my_tree.x_dim + np.arange(my_tree.final_states)
+    return { 'ghg' : my_tree.ghg_by_state[final_nodes].copy(), 'damage' : my_tree.final_damage_by_state.copy(),
+             'consumption' : my_tree.potential_consumption[my_tree.nperiods] * (1.-my_tree.final_damage_by_state) }
+
+def utility_table(my_tree):
+    '''    node table of the utility tree: 'node', 'period', 'year', 'consumption', 'sdf' and, for analysis 2, 'd_consumption'
+    '''
+    period = np.repeat( np.arange(my_tree.utility_nperiods), np.array(my_tree.utility_period_nodes[:my_tree.utility_nperiods]) )
+    nodes = np.arange(len(period))
+    table = { 'node' : nodes, 'period' : period, 'year' : 2015 + np.array(my_tree.utility_times, dtype=float)[period],
+              'consumption' : my_tree.consumption_by_state[nodes].copy(), 'sdf' : my_tree.sdf_in_tree[nodes].copy() }
+    if my_tree.analysis == 2 :
+        table['d_consumption'] = my_tree.d_consumption_by_state[nodes].copy()
+    return table
+
+def scc_decomposition(my_tree, consumption_cost):
+    '''Decomposition of the SCC into the discounted expected damages and the risk premium of each utility period
+        the stochastic discount factors in my_tree.sdf_in_tree and the bond prices in my_tree.discount_prices must be set
+        (see optimize_plan.term_structure), and d_consumption_by_state and d_cost_by_state hold the response of consumption
+        to first period mitigation (analysis 2)
+
+    Parameters
+    ----------
+    my_tree : tree_model object
+        the tree
+
+    consumption_cost : float
+        the change of time 0 consumption per unit of first period mitigation
+
+    Returns
+    -------
+    decomposition : dict of arrays
+        one element per utility period (element 0 is 0): 'expected_damages', 'cross_product', 'cov_term', 'd_cost', 'net_discounted_damage'
+        and 'risk_premium', all per $ spent on mitigation at time 0
+    '''
+    nperiods = my_tree.utility_nperiods
+    expected_damages = np.zeros(nperiods)
+    cross_product = np.zeros(nperiods)
+    d_cost = np.zeros(nperiods)
+    for time_period in range(1, nperiods):
+        ''' node probabilities are those of the next decision period, see term_structure '''
+        tree_node = my_tree.decision_period_pointer[ min( my_tree.nperiods-1, my_tree.utility_decision_period[time_period-1]+1) ]
+        first_node = my_tree.utility_period_pointer[time_period]
+        period_nodes = np.arange(my_tree.utility_period_nodes[time_period])
+        probs = my_tree.node_probs[tree_node+period_nodes]
+        ''' the change of the aggregated consumption of a utility period as payments at its start, see tree_model utility_steps '''
+        damage_in_node = my_tree.d_consumption_by_state[first_node+period_nodes] / my_tree.payment_weight[first_node+period_nodes]
+        expected_damages[time_period] = np.dot( damage_in_node, probs )
+        cross_product[time_period] = np.dot( my_tree.sdf_in_tree[first_node+period_nodes] * damage_in_node, probs )
+        ''' during the first decision period the change in consumption includes the cost of the added mitigation, net it out '''
+        if my_tree.utility_decision_period[time_period] == 0 :
+            d_cost[time_period] = my_tree.d_cost_by_state[time_period,1]
+            if my_tree.utility_substeps[time_period] > 1 :
+                aggregation = my_tree.consumption_aggregation[first_node+period_nodes] / my_tree.payment_weight[first_node+period_nodes]
+                d_cost[time_period] *= np.dot( aggregation, probs ) / probs.sum()
+    expected_sdf = my_tree.discount_prices[:nperiods]
+    cov_term = cross_product - expected_sdf * expected_damages
+    return { 'expected_damages' : -expected_damages/consumption_cost, 'cross_product' : -cross_product/consumption_cost,
+             'cov_term' : -cov_term/consumption_cost, 'd_cost' : -d_cost*expected_sdf/consumption_cost,
+             'net_discounted_damage' : -(expected_damages+d_cost)*expected_sdf/consumption_cost, 'risk_premium' : -cov_term/consumption_cost }
+
+def sensitivity_report(sensitivities, parameters):
+    '''    report of optimize_plan.scc_sensitivities: 'scc', 'free' (the free variables), the table 'sensitivity' with one row per parameter
+        ('parameter', 'd_scc' and 'elasticity') and 'd_plan', the derivatives of the plan, one row per parameter
+    '''
+    return { 'scc' : sensitivities['scc'], 'free' : np.asarray(sensitivities['free']),
+             'sensitivity' : { 'parameter' : np.array(parameters), 'd_scc' : np.array([ sensitivities[name]['d_scc'] for name in parameters ]),
+                               'elasticity' : np.array([ sensitivities[name]['elasticity'] for name in parameters ]) },
+             'd_plan' : np.array([ sensitivities[name]['d_plan'] for name in parameters ]) }
+
+def write_report(filename, report):
+    '''Writes a report as one npz file, through a temporary file so a reader never sees a partial report
+
+    Parameters
+    ----------
+    filename : string
+        the npz file
+
+    report : dict
+        table name -> dict of arrays, or scalar name -> value; table columns are stored as table_column
+    '''
+    columns = {}
+    for name, value in report.items() :
+        if isinstance(value, dict) :
+            for column, array in value.items() :
+                columns['%s_%s' % (name, column)] = np.asarray(array)
+        else :
+            columns[name] = np.asarray(value)
+    temp_filename = filename + '.%i.tmp' % os.getpid()
+    with open(temp_filename, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(temp_filename, filename)
+    log.log_it('report with %i columns written to %s' % (len(columns), filename))
+
+def read_report(filename):
+    '''    a report written by write_report, as table name -> dict of arrays, scalars under their own name
+    '''
+    report = {}
+    with np.load(filename) as columns:
+        for name in columns.files :
+            table, _, column = name.partition('_')
+            if column and table in [ 'decision', 'final', 'utility', 'period', 'sensitivity' ] :
+                report.setdefault(table, {})[column] = columns[name]
+            else :
+                report[name] = columns[name][()] if columns[name].ndim == 0 else columns[name]
+    return report
@@ -16,8 +16,9 @@ from dlw_tree_class import tree_model
 from dlw_damage_class import damage_model
 from dlw_cost_class import cost_model
 from dlw_optimize_class import optimize_plan
-from scipy.optimize import fmin_l_bfgs_b
-from scipy.optimize import brentq
+from dlw_warm_start import warm_start_store, model_parameters
+from dlw_parallel import run_task_graph
+from dlw_trace import optimization_trace, job_name
 import pandas as pd # For loading in difference sceanrio configurations.
 from celery import Celery # For running from web app.
 from tqdm import tqdm # For timer bar.
@@ -36,7 +37,7 @@ app = Celery('run_model', broker='amqp://', backend='amqp://')
 '''
 
 @app.task # Celery decorator for making the run_model() distributed.
-def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11.0, damage_disaster_tail=18.0, draws=50):
+def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11.0, damage_disaster_tail=18.0, draws=50, starts=1, processes=None, levels=0, utility_steps=None, nested=False, sensitivities=False):
     print('These arguments set in batch mode')
     #print('growth rate = ', sys.argv[1]
     # Original 1st parm: print('period_1_years =', sys.argv[1])
@@ -53,7 +54,7 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
     #                            'status': 'Starting model tree'})    
     # TREE MODEL
     #Orig: my_tree = tree_model(tp1=int(sys.argv[1]))
-    my_tree = tree_model(tp1=tp1, analysis=tree_analysis, final_states=tree_final_states)
+    my_tree = tree_model(tp1=tp1, analysis=tree_analysis, final_states=tree_final_states, utility_steps=utility_steps)
     #my_tree = tree_model()
     print('tree nodes', my_tree.decision_period_pointer)
     print('horizon times', my_tree.decision_times)
@@ -66,10 +67,6 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
     print('u_nodes', my_tree.utility_period_nodes)
     print('u_tree_period', my_tree.utility_decision_period)
     
-    # The return parameters:
-    delta_emissions_gigatons = None
-    cost_per_ton = None
-    
     #self.update_state(state='PROGRESS',
     #                      meta={'current': 25, 'total': 99,
     #                            'status': 'Finished model tree'})
@@ -100,10 +97,13 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
     
     #     = optimize_plan(my_tree=my_tree,randomize=float(sys.argv[2]),alt_input=int(sys.argv[3]))
     my_optimization = optimize_plan(my_tree=my_tree)
-    if my_tree.nperiods <= 5 :
-      my_optimization.get_initial_guess()
-    else :
-      my_optimization.get_initial_guess6()    
+    '''
+      the initial guess is the plan solved at the nearest parameters in the warm start store,
+      or the plan on the bestparams file when nothing has been solved yet for this tree shape
+    '''
+    my_warm_start = warm_start_store(my_optimization.output_path, my_tree.nperiods, my_tree.final_states, my_tree.x_dim)
+    run_parameters = model_parameters(my_tree, my_damage_model, my_cost_model)
+    my_optimization.get_warm_start(my_warm_start, run_parameters)
     
     print("initial guess", my_optimization.guess)
     
@@ -139,27 +139,117 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
     
     if my_tree.analysis == 1 or my_tree.analysis == 2 :
       my_optimization.set_constraints(constrain=0)
-      res = fmin_l_bfgs_b( fm.utility_function,guess,fprime=fm.analytic_utility_gradient,factr=1.,pgtol=1.0e-5,bounds=(my_optimization.xbounds),maxfun=600,args=([my_tree, my_damage_model, my_cost_model]))
-      bestfit = res[1]
-      #print('best fit', bestfit)
-      bestparams = res[0]
-      #print('best parameters', bestparams)
-      retparam = res[2]
-      #print('gradient', retparam['grad'])
-      #print('function calls', retparam['funcalls'])
+      if starts > 1 :
+        '''
+          multi-start mode: optimize from several perturbed starts in parallel and keep the best plan,
+          then evaluate it here so the tree holds the values of the optimal plan
+        '''
+        multi_start_result = my_optimization.multi_start(my_damage_model, my_cost_model, nstarts=starts)
+        bestfit = multi_start_result['fit']
+        bestparams = multi_start_result['plan']
+        fm.utility_function( bestparams, my_tree, my_damage_model, my_cost_model )
+        full_fidelity = True
+      elif levels > 0 :
+        '''
+          coarse-to-fine mode: the plan is started from the optimal plan of trees with fewer periods, solved first
+        '''
+        multilevel_result = my_optimization.multilevel_optimization(my_damage_model, my_cost_model, levels=levels)
+        bestfit = multilevel_result['fit']
+        bestparams = multilevel_result['plan']
+        full_fidelity = False
+      elif nested :
+        '''
+          nested mode: the last decision period is solved inside the objective, the optimizer only sees the earlier periods
+        '''
+        nested_result = my_optimization.nested_optimization(my_damage_model, my_cost_model)
+        bestfit = nested_result['fit']
+        bestparams = nested_result['plan']
+        full_fidelity = False
+      else :
+        '''
+          the optimization is traced and checkpointed, a restarted job resumes from its last checkpoint
+        '''
+        trace = optimization_trace(my_optimization.output_path, job_name(run_parameters, 'optimal', my_damage_model))
+        res = trace.minimize( fm.utility_function,guess,fm.analytic_utility_gradient,my_optimization.xbounds,factr=1.,pgtol=1.0e-5,maxfun=600,args=([my_tree, my_damage_model, my_cost_model]))
+        bestfit = res[1]
+        #print('best fit', bestfit)
+        bestparams = res[0]
+        #print('best parameters', bestparams)
+        retparam = res[2]
+        #print('gradient', retparam['grad'])
+        #print('function calls', retparam['funcalls'])
+        full_fidelity = True
+      '''
+        only the plans of full-fidelity solves are stored as warm starts (and surrogate training data), the coarse-to-fine
+        and nested modes can end at a worse local optimum than a direct solve
+      '''
+      if full_fidelity :
+        my_warm_start.add(run_parameters, bestparams, bestfit)
+      if utility_steps is not None :
+        '''
+          the longer utility periods of utility_steps aggregate the 5 year periods in closed form, check the plan against the 5 year grid
+        '''
+        grid_error = my_optimization.utility_grid_error(bestparams, my_damage_model, my_cost_model)
+        print('utility grid check', grid_error)
+      if sensitivities :
+        '''
+          derivatives of the optimal plan and the SCC with respect to the utility and cost parameters, written to their own report
+        '''
+        scc_sensitivities = my_optimization.scc_sensitivities(bestparams, my_damage_model, my_cost_model, job=job_name(run_parameters, 'sensitivities'))
+        print('SCC elasticities', dict([ (name, scc_sensitivities[name]['elasticity']) for name in scc_sensitivities if name not in [ 'scc', 'free' ] ]))
     else :
       bestfit = base
       bestparams = guess
       
-    '''
-       if analysis = 1, then the only step is optimization: now print(output to the terminal
-    '''
-    if my_tree.analysis == 1:
-      my_optimization.create_output(bestparams, bestfit, my_damage_model, my_cost_model, my_tree)
     if my_tree.nperiods <= 5 :
       my_optimization.put_optimal_plan(bestparams)
     else :
       my_optimization.put_optimal_plan6(bestparams)
+    '''
+       the analysis specific steps start from the optimal plan
+    '''
+    return run_analysis(my_tree, my_damage_model, my_cost_model, my_optimization, my_warm_start, run_parameters, bestparams, bestfit, processes=processes)
+    '''
+       done
+    '''
+
+def run_analysis(my_tree, my_damage_model, my_cost_model, my_optimization, my_warm_start, run_parameters, bestparams, bestfit, processes=None):
+    '''Runs the analysis selected by my_tree.analysis, given the optimal plan (or the initial guess for analysis 3 and 4)
+
+    Parameters
+    ----------
+    my_tree, my_damage_model, my_cost_model : model objects
+        the loaded models
+
+    my_optimization : optimize_plan object
+        holds the initial guess, the starting point of the analysis 3 and 4 optimizations
+
+    my_warm_start : warm_start_store object
+        store of solved plans, the unconstrained plan of analysis 4 is added to it
+
+    run_parameters : dict
+        model parameters, see dlw_warm_start.model_parameters
+
+    bestparams, bestfit : float vector, float
+        the optimal plan and its objective
+
+    processes : integer
+        number of worker processes for the independent optimizations, None runs them one after the other in this process
+
+    Returns
+    -------
+    cost_per_ton, delta_emissions_gigatons : float
+        consumption per ton of emissions and the change in time 0 emissions (analysis 4), None otherwise
+    '''
+    # The return parameters:
+    delta_emissions_gigatons = None
+    cost_per_ton = None
+    guess = my_optimization.guess
+    '''
+       if analysis = 1, then the only step is optimization: now print(output to the terminal
+    '''
+    if my_tree.analysis == 1:
+      my_optimization.create_output(bestparams, bestfit, my_damage_model, my_cost_model, my_tree, job=job_name(run_parameters, 'optimal'))
     '''
        if my_tree.analysis = 2 then find the decomposition of the social cost of carbon
        into its risk premium and expected damage components and their decomposition over time
@@ -168,35 +258,38 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
        this is done so that in the next we can increment the mitigation at time 0 and to calculate the marginal changes in consumption and cost
     '''
     if my_tree.analysis == 2:
-      for node in tqdm(range(0, my_tree.utility_full_tree)):
-        my_tree.d_consumption_by_state[node] = my_tree.consumption_by_state[node]
-    
+      fm.utility_function( bestparams, my_tree, my_damage_model, my_cost_model )
       for sub_period in tqdm(range(0, my_tree.first_period_intervals)):
-        potential_consumption = (1.+my_tree.growth)**(my_tree.sub_interval_length * sub_period)
+        potential_consumption = (1.+my_tree.growth)**my_tree.utility_times[sub_period]
         my_tree.d_cost_by_state[sub_period,0] = potential_consumption * my_tree.cost_by_state[0]
       
-      delta_x = .01
-      bestparams[0] += delta_x
+      delta_x = .0001
       '''
-          next increment time 0 mitigation and run an optimization in which mitigation at time 0 is constained to = previous optimal mitigation + delta_x
+          next find the response of the optimal plan to a change of time 0 mitigation, from one Newton system solve at the optimal plan
+          (see optimize_plan.first_period_response), and evaluate consumption on both sides of the plan along that response
       '''
-      my_optimization.set_constraints(constrain=-1, node_0 = bestparams[0])
-      guess = bestparams
-      res = fmin_l_bfgs_b( fm.utility_function,guess,fprime=fm.analytic_utility_gradient,factr=1.,pgtol=1.0e-5,bounds=(my_optimization.xbounds),maxfun=600,args=([my_tree, my_damage_model, my_cost_model]))
+      my_optimization.set_constraints(constrain=0)
+      direction = my_optimization.first_period_response(bestparams, my_damage_model, my_cost_model)
+      fm.utility_function( bestparams + delta_x * direction, my_tree, my_damage_model, my_cost_model )
+      consumption_plus = my_tree.consumption_by_state.copy()
+      cost_plus = my_tree.cost_by_state[0]
+      fm.utility_function( bestparams - delta_x * direction, my_tree, my_damage_model, my_cost_model )
       '''
          now calculate the changes in consumption and the mitigation cost component of consumption per unit change in mitigation in the new optimal plan
       '''
-      for node in tqdm(range(0, my_tree.utility_full_tree)):
-        my_tree.d_consumption_by_state[node] = (my_tree.consumption_by_state[node]-my_tree.d_consumption_by_state[node])/delta_x
-    
+      my_tree.d_consumption_by_state[:] = (consumption_plus - my_tree.consumption_by_state)/(2.*delta_x)
+
       for sub_period in tqdm(range(0, my_tree.first_period_intervals)):
-        potential_consumption = (1.+my_tree.growth)**(my_tree.sub_interval_length * sub_period)
-        my_tree.d_cost_by_state[sub_period,1] = ( potential_consumption * my_tree.cost_by_state[0] - my_tree.d_cost_by_state[sub_period,0] )/delta_x
-      bestparams[0] -= delta_x
-      base = fm.utility_function( bestparams, my_tree, my_damage_model, my_cost_model )
+        potential_consumption = (1.+my_tree.growth)**my_tree.utility_times[sub_period]
+        my_tree.d_cost_by_state[sub_period,1] = potential_consumption * ( cost_plus - my_tree.cost_by_state[0] )/(2.*delta_x)
+      '''
+         evaluate the optimal plan again, to restore the tree state left by the finite-difference evaluations above
+      '''
+      fm.utility_function( bestparams, my_tree, my_damage_model, my_cost_model )
       '''
          create the output, including the decomposition of SCC into the time paths of the net present value contributions from expected damage and risk premium components
       '''
+      my_optimization.create_output(bestparams, bestfit, my_damage_model, my_cost_model, my_tree, job=job_name(run_parameters, 'optimal'))
     
       '''
          this section of code addresses the question: what is the cost of waiting to start mitigation untilt the end of the first period
@@ -219,54 +312,52 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
       increment = .025
       for ipass in range(0, 1):
         '''
-          first step is to calculate the optimal plan when mitigation is constrained to base_x for the first period
+          two optimizations: the optimal plan when mitigation is constrained to base_x for the first period ('base')
+          and the "new" plan, defined below, which does not depend on the base plan
+          the two are independent tasks of one graph, so with processes > 1 they run at the same time in separate worker processes
         '''
         lump_sum = .0
         my_tree.first_period_epsilon = lump_sum
         my_optimization.set_constraints(constrain=1, node_0 = base_x, node_1 = base_x, node_2 = base_x)
-        res = fmin_l_bfgs_b( fm.utility_function,guess,fprime=fm.analytic_utility_gradient,factr=1.,pgtol=1.0e-5,bounds=(my_optimization.xbounds),maxfun=600,args=([my_tree, my_damage_model, my_cost_model]))
+        tasks = [ { 'name' : 'base', 'guess' : guess, 'bounds' : my_optimization.xbounds,
+                    'trace' : optimization_trace(my_optimization.output_path, job_name(run_parameters, 'base%i' % my_tree.analysis, my_damage_model)) } ]
+        '''
+           when my_tree.analysis = 3 the "optimal" new plan is constrained so that current mitigation is equal to
+             base_x + delta_x
+           when my_tree.analysis = 4 the current mitigation is indeed from the unconstrained optimal plan
+        '''
+        if my_tree.analysis == 3 :
+          my_optimization.set_constraints(constrain=1, node_0 = base_x + delta_x)
+        else :
+          my_optimization.set_constraints(constrain=0)
+        tasks.append( { 'name' : 'new', 'guess' : guess, 'bounds' : my_optimization.xbounds,
+                        'trace' : optimization_trace(my_optimization.output_path, job_name(run_parameters, 'new%i' % my_tree.analysis, my_damage_model)) } )
+        results = run_task_graph(my_tree, my_damage_model, my_cost_model, tasks, processes=processes)
         '''
           save the parameters for the run with mitigation = base_x in baseparams
           save the utility value in basefit
           save the cost of emissions reductions when mitigation = base_x in marginal_cost
-          use the optimal mitigation parameters as the starting point for an optiization with first period
-            emissions reduction constrained to be base_x + delta_x
         '''
-        baseparams = res[0]
-        basefit = res[1]
+        baseparams = results['base']['plan']
+        basefit = results['base']['fit']
         marginal_cost = my_cost_model.price_by_state( baseparams[0],0.,0.)
-        newparams = baseparams
         '''
            create output for the optimal plan with current mitigation constrained to equal base_x (the optimal plan subject to no action in period 0)
         '''
-        my_optimization.create_output(baseparams, basefit, my_damage_model, my_cost_model, my_tree)
-        '''
-           next calculate the optimal plan 
-           when my_tree.analysis = 3 the "optimal" plan is constrained so that current mitigation is equal to
-             base_x + delta_x
-           when my_tree.analysis = 4 the current mitigation is indeed from the unconstrained optimal plan
-        '''
-        if my_tree.analysis == 3 :
-          #print('base_x', base_x, 'delta_x', delta_x)
-          newparams[0] += delta_x
-          my_tree.first_period_epsilon = lump_sum
-          my_optimization.set_constraints(constrain=1, node_0 = newparams[0], node_1 = newparams[1], node_2 = newparams[2])
-          res = fmin_l_bfgs_b( fm.utility_function,newparams,fprime=fm.analytic_utility_gradient,factr=1.,pgtol=1.0e-5,bounds=(my_optimization.xbounds),maxfun=600,args=([my_tree, my_damage_model, my_cost_model]))
-        else :
-          my_optimization.set_constraints(constrain=0)
-          res = fmin_l_bfgs_b( fm.utility_function,guess,fprime=fm.analytic_utility_gradient,factr=1.,pgtol=1.0e-5,bounds=(my_optimization.xbounds),maxfun=600,args=([my_tree, my_damage_model, my_cost_model]))
+        my_optimization.create_output(baseparams, basefit, my_damage_model, my_cost_model, my_tree, job=job_name(run_parameters, 'base%i' % my_tree.analysis))
         '''
-          save the parameters for the run with mitigation = base_x + delta_x in newparams
+          save the parameters for the new run in newparams
           save the utility value in newfit
         '''
-    
-        newparams = res[0]
-        newfit = res[1]
+        newparams = results['new']['plan']
+        newfit = results['new']['fit']
+        if my_tree.analysis == 4 :
+          my_warm_start.add(run_parameters, newparams, newfit)
     
         '''
          create output for the new optimal plan with either a marginal, or a fully optimal mitigation at time 0
         '''
-        my_optimization.create_output(newparams, newfit, my_damage_model, my_cost_model, my_tree)
+        my_optimization.create_output(newparams, newfit, my_damage_model, my_cost_model, my_tree, job=job_name(run_parameters, 'new%i' % my_tree.analysis))
     
         '''
          delta_util_x is the change in utility from base_x to base_x + delta_x
@@ -298,7 +389,7 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
         else:
           delta_x = newparams[0]
           #print('delta_x', delta_x)
-          # BRENTQ OPTIMIZATION
+          # BREAK EVEN CONSUMPTION
           '''
            my_optimization.constraint_cost is the utility cost of constraining first period mitigation to zero
           '''
@@ -306,12 +397,12 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
           for miti in range(0, my_tree.x_dim):
             my_optimization.guess[miti] = baseparams[miti]
           '''
-           when my_tree.analysis = 4, calculate deadweight loss by using the root finder routine to find a change in consumption
+           when my_tree.analysis = 4, calculate deadweight loss by using Newton steps on find_bec to find a change in consumption
            that increases the zero mitigation constrained optimization utility to equal that of the unconstrained plan plus a lump sum
            that is, find delta_con such that [ delta_utility - my_optimization.constraint_cost] = 0
            where delta_utility = util(constrained plan, consumption[today] + delta_con)-util(unconstrained plan, consumption[today])
           '''
-          delta_con = brentq( my_optimization.find_bec, -.1, .99, args=( my_tree, my_damage_model, my_optimization, my_cost_model))
+          delta_con = my_optimization.find_bec_newton( my_tree, my_damage_model, my_cost_model, lower=-.1, upper=.99 )
           #print('delta consumption to match unconstrained optimal plan', delta_con)
         cost_per_ton = my_cost_model.consperton0
         if my_tree.analysis == 3:
@@ -351,9 +442,14 @@ def run_model(tp1=30, tree_analysis=4, tree_final_states=32, damage_peak_temp=11
           #print(' period ', tree_period, ' year ', 2015+my_tree.utility_times[time_period], ' node ', tree_node+period_node, ' utility', new_util, ' marginal_utility ', marginal_utility  )
           
     return cost_per_ton, delta_emissions_gigatons
+
+@app.task # Celery task for the SCC queries the surrogate cannot answer, see dlw_surrogate and app.py
+def run_point(point):
+    '''    solves the model at a parameter point with the stage-cached pipeline,
+        the plan is added to the warm-start store so the surrogate is retrained on it at its next query
     '''
-       done
-    '''
+    from dlw_surrogate import run_job
+    return { 'result' : run_job(point) }
 
 if __name__ == '__main__':
     run_model()
\ No newline at end of file
@@ -0,0 +1,167 @@
+'''
+   Surrogate of the dlw climate model for fast SCC queries
+   a Gaussian process emulator is trained on the plans already solved -- every optimization adds its plan to the warm-start store
+   (run_model, the pipeline, sweeps and batches) -- and predicts first period mitigation and the SCC for new parameters,
+   with an error estimate, in a fraction of a millisecond; a query outside the region the emulator can be trusted in
+   falls back to a real model job, whose plan is added to the store and used at the next training
+'''
+import os
+import numpy as np
+from dlw_tree_class import tree_model
+from dlw_warm_start import warm_start_store, parameter_names, parameter_scales
+from dlw_sweep import point_parameters, build_cost_model
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+'''  the parameters users mostly vary, see app.py '''
+query_names = [ 'tp1', 'peak_temp', 'disaster_tail', 'ra', 'eis' ]
+'''  length scales (in units of the warm-start parameter scales) and noise levels tried when fitting the emulator '''
+length_scales = [ .25, .5, 1., 2., 4. ]
+noise_levels = [ 1.0e-6, 1.0e-4, 1.0e-2 ]
+
+def run_job(point):
+    '''    the fallback of a query: solve the model with the pipeline, see dlw_pipeline.run_pipeline
+    '''
+    import dlw_pipeline
+    outputs, report = dlw_pipeline.run_pipeline(point, analysis=1, processes=1)
+    return { 'scc' : float(outputs['scc']), 'mitigation' : float(outputs['plan'][0]) }
+
+class scc_surrogate(object):
+    '''Gaussian process emulator of first period mitigation and the log of the SCC, trained on the warm-start store
+    '''
+    def __init__(self, output_path, nperiods=6, final_states=32, x_dim=63, max_relative_error=.05, margin=.25):
+        '''Initializes the surrogate and trains it on the plans in the store
+
+        Parameters
+        ----------
+        output_path : string
+            directory of the warm-start store
+
+        nperiods, final_states, x_dim : integers
+            shape of the tree whose plans are used
+
+        max_relative_error : float
+            a prediction is trusted when the standard error of the SCC is below this fraction of the SCC
+
+        margin : float
+            a prediction is only trusted inside the box of the training parameters extended by this many parameter scales
+        '''
+        self.store = warm_start_store(output_path, nperiods, final_states, x_dim)
+        self.max_relative_error = max_relative_error
+        self.margin = margin
+        self.tree = None
+        self.cost_models = {}
+        self.store_time = None
+        self.refresh()
+
+    def cost_curve(self, params):
+        '''    the cost model of a parameter dict, cached; the time 0 price only depends on the cost parameters, not on the tree
+        '''
+        key = tuple( params[name] for name in [ 'g', 'a', 'join', 'max_price', 'teconst', 'tescale' ] )
+        if key not in self.cost_models :
+            if self.tree is None :
+                self.tree = tree_model(tp1=30, analysis=1, final_states=32, decision_times=[ 0, 15, 45, 85, 185, 285, 385])
+            self.cost_models[key] = build_cost_model(self.tree, params)
+        return self.cost_models[key]
+
+    def refresh(self):
+        '''    retrain when the store file changed since the last training
+        '''
+        store_time = os.path.getmtime(self.store.filename) if os.path.exists(self.store.filename) else None
+        if store_time != self.store_time :
+            self.store.load()
+            self.store_time = store_time
+            self.train()
+
+    def train(self):
+        '''Fits the emulator to the plans in the store
+            the inputs are the normalized parameter keys of the store, the targets first period mitigation and log SCC (standardized),
+            the kernel is a squared exponential in the normalized parameters with the length scale and noise level that maximize
+            the marginal likelihood of both targets
+        '''
+        self.inputs = self.store.keys.copy()
+        npoints = len(self.inputs)
+        if npoints < 2 :
+            self.trained = False
+            log.log_it('surrogate: %i plans in the store, not enough to train' % npoints)
+            return
+        scc = np.array([ self.cost_curve( dict(zip(parameter_names, key * parameter_scales)) ).price_by_state(plan[0], 0., 0.)
+                         for key, plan in zip(self.store.keys, self.store.plans) ])
+        targets = np.column_stack( [ self.store.plans[:,0], np.log(scc) ] )
+        self.target_mean = targets.mean(axis=0)
+        self.target_std = np.maximum( targets.std(axis=0), 1.0e-12 )
+        targets = (targets - self.target_mean) / self.target_std
+
+        distance = ((self.inputs[:,None,:] - self.inputs[None,:,:])**2).sum(axis=2)
+        best = None
+        for length_scale in length_scales :
+            for noise in noise_levels :
+                try:
+                    cholesky = np.linalg.cholesky( np.exp(-.5*distance/length_scale**2) + noise*np.eye(npoints) )
+                except np.linalg.LinAlgError:
+                    continue
+                alpha = np.linalg.solve( cholesky.T, np.linalg.solve(cholesky, targets) )
+                likelihood = -.5*(targets*alpha).sum() - 2.*np.log(np.diag(cholesky)).sum()
+                if best is None or likelihood > best[0] :
+                    best = ( likelihood, length_scale, noise, cholesky, alpha )
+        likelihood, self.length_scale, self.noise, self.cholesky, self.alpha = best
+        self.lower = self.inputs.min(axis=0) - self.margin
+        self.upper = self.inputs.max(axis=0) + self.margin
+        self.trained = True
+        log.log_it('surrogate trained on %i plans: length scale %f noise %e log likelihood %f' % (npoints, self.length_scale, self.noise, likelihood))
+
+    def predict(self, params):
+        '''Predicts first period mitigation and the SCC
+
+        Parameters
+        ----------
+        params : dict
+            model parameters, see dlw_sweep.point_parameters
+
+        Returns
+        -------
+        prediction : dict
+            'mitigation' and 'scc' with their standard errors 'mitigation_std' and 'scc_std',
+            and 'trusted', whether the prediction is inside the training region and accurate enough
+        '''
+        key = self.store.normalize(params)
+        weights = np.exp( -.5*((self.inputs - key)**2).sum(axis=1)/self.length_scale**2 )
+        mean = np.dot(weights, self.alpha) * self.target_std + self.target_mean
+        v = np.linalg.solve(self.cholesky, weights)
+        std = np.sqrt( max( 1. + self.noise - np.dot(v, v), 0. ) ) * self.target_std
+        scc = np.exp(mean[1])
+        inside = bool( np.all( (key >= self.lower) & (key <= self.upper) ) )
+        return { 'mitigation' : float(mean[0]), 'mitigation_std' : float(std[0]), 'scc' : float(scc), 'scc_std' : float(scc*std[1]),
+                 'trusted' : bool( inside and std[1] <= self.max_relative_error ) }
+
+    def query(self, point, fallback=run_job):
+        '''Answers a query for first period mitigation and the SCC
+
+        Parameters
+        ----------
+        point : dict
+            the parameters that differ from dlw_sweep.default_parameters, usually some of query_names, eg { 'ra' : 5. }
+
+        fallback : function
+            called with point when the prediction is not trusted, it returns a dict with 'scc' and 'mitigation'
+            (or anything to hand back to the caller, eg a job id); None returns the untrusted prediction
+
+        Returns
+        -------
+        answer : dict
+            the prediction (see predict) with 'source' 'surrogate', or the result of fallback with 'source' 'model'
+        '''
+        self.refresh()
+        params = point_parameters(point)
+        if self.trained :
+            answer = self.predict(params)
+            answer['source'] = 'surrogate'
+            if answer['trusted'] or fallback is None :
+                return answer
+            log.log_it('surrogate: query %s outside the trusted region (scc %f +- %f), running the model' % (point, answer['scc'], answer['scc_std']))
+        elif fallback is None :
+            return { 'source' : 'surrogate', 'trusted' : False }
+        answer = fallback(point)
+        answer['source'] = 'model'
+        return answer
@@ -0,0 +1,224 @@
+'''
+   Parameter sweeps of the dlw climate model solved by continuation
+   the grid points are ordered into chains of neighboring points, each optimization is warm-started
+   from the solution at the previous point of its chain, and the tree and damage objects are reused
+   as long as only utility or cost parameters change along the chain
+   independent chains run in parallel worker processes
+'''
+import multiprocessing
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+import dlw_utility as fm
+from dlw_tree_class import tree_model
+from dlw_damage_class import damage_model
+from dlw_cost_class import cost_model
+from dlw_optimize_class import optimize_plan
+from dlw_warm_start import warm_start_store, model_parameters, parameter_names, parameter_scales
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+'''  parameter values used for any parameter a sweep point does not set, as in run_model '''
+default_parameters = { 'tp1' : 30, 'final_states' : 32, 'ra' : 7.0, 'eis' : 0.9, 'growth' : .02, 'time_pref' : .005,
+                       'peak_temp' : 11.0, 'disaster_tail' : 18.0, 'draws' : 50,
+                       'g' : 92.08, 'a' : 3.413, 'join' : 2000., 'max_price' : 2500., 'teconst' : 1.5, 'tescale' : 0.0 }
+'''  changing any of these parameters requires a new tree and damage simulation '''
+structural_names = [ 'tp1', 'final_states', 'growth', 'peak_temp', 'disaster_tail', 'draws' ]
+'''  distance penalty for a change of structural parameters when ordering a chain '''
+structural_penalty = 10.
+'''  the damage simulation goes through one file, so worker processes take turns, see init_sweep_worker '''
+damage_lock = None
+
+def init_sweep_worker(lock):
+    '''    pool initializer: share the lock on the damage simulation file
+    '''
+    global damage_lock
+    damage_lock = lock
+
+def point_parameters(point):
+    '''    the full parameter dict of a sweep point, defaults filled in
+    '''
+    params = dict(default_parameters)
+    params.update(point)
+    return params
+
+def structural_key(params):
+    '''    the parameters that determine the tree and the damage simulation
+    '''
+    return tuple( params[name] for name in structural_names )
+
+def build_tree(params, analysis=1):
+    '''    the tree for a parameter dict, see run_model
+    '''
+    if params['final_states'] == 16 :
+        my_tree = tree_model(tp1=params['tp1'], analysis=analysis, final_states=16, nperiods=5, x_dim=31, growth=params['growth'],
+                             decision_times=[ 0., 35., 85., 185., 285., 385.])
+    else :
+        my_tree = tree_model(tp1=params['tp1'], analysis=analysis, final_states=params['final_states'], growth=params['growth'],
+                             decision_times=[ 0, 15, 45, 85, 185, 285, 385])
+    set_utility_parameters(my_tree, params)
+    return my_tree
+
+def build_tree_and_damages(params):
+    '''Builds the tree and the damage model for a parameter dict, see run_model
+
+    Returns
+    -------
+    my_tree, my_damage_model : model objects
+    '''
+    my_tree = build_tree(params)
+    my_damage_model = damage_model(my_tree=my_tree, peak_temp=params['peak_temp'], disaster_tail=params['disaster_tail'], draws=params['draws'])
+    if damage_lock is not None :
+        with damage_lock :
+            my_damage_model.damage_function_initialization()
+    else :
+        my_damage_model.damage_function_initialization()
+    my_damage_model.initialize_tree()
+    my_damage_model.dfc = my_damage_model.damage_function_interpolation()
+    return my_tree, my_damage_model
+
+def set_utility_parameters(my_tree, params):
+    '''    set the utility parameters of an existing tree, they do not change the tree structure
+    '''
+    my_tree.ra = params['ra']
+    my_tree.eis = params['eis']
+    my_tree.time_pref = params['time_pref']
+
+def build_cost_model(my_tree, params):
+    '''    the cost model for a parameter dict
+    '''
+    return cost_model(tree=my_tree, g=params['g'], a=params['a'], join=params['join'], max_price=params['max_price'],
+                      teconst=params['teconst'], tescale=params['tescale'])
+
+def normalized_point(params):
+    '''    the normalized position of a point, used to measure the distance between neighbors
+    '''
+    return np.array([ params[name] for name in parameter_names ], dtype=float) / parameter_scales
+
+def create_chains(points, nchains):
+    '''Orders the sweep points into continuation chains
+        a greedy nearest-neighbor path is built through all the points, with changes of structural parameters
+        penalized so the path changes tree and damages as rarely as possible, and the path is cut into nchains pieces
+
+    Parameters
+    ----------
+    points : list of dict
+        the sweep points
+
+    nchains : integer
+        number of chains
+
+    Returns
+    -------
+    chains : list of lists
+        indices of the points in each chain, in solution order
+    '''
+    params = [ point_parameters(point) for point in points ]
+    position = np.array([ normalized_point(p) for p in params ])
+    keys = [ structural_key(p) for p in params ]
+    remaining = list(range(1, len(points)))
+    path = [ 0 ]
+    while remaining :
+        last = path[-1]
+        distance = np.sqrt( ((position[remaining] - position[last])**2).sum(axis=1) )
+        distance += np.array([ structural_penalty * (keys[i] != keys[last]) for i in remaining ])
+        path.append( remaining.pop( int(np.argmin(distance)) ) )
+    nchains = max( 1, min(nchains, len(path)) )
+    cuts = np.linspace(0, len(path), nchains+1).astype(int)
+    return [ path[cuts[c]:cuts[c+1]] for c in range(0, nchains) ]
+
+def solve_chain(chain_points):
+    '''Solves the points of one chain in order, warm-starting each optimization from the previous solution
+
+    Parameters
+    ----------
+    chain_points : list of (index, dict)
+        the sweep points of the chain with their position in the sweep
+
+    Returns
+    -------
+    results : list of dict
+        for each point: 'index', 'params', 'plan', 'fit', 'scc', 'funcalls' and whether the tree was 'rebuilt'
+    '''
+    results = []
+    key = None
+    guess = None
+    for index, point in chain_points :
+        params = point_parameters(point)
+        rebuilt = structural_key(params) != key
+        if rebuilt :
+            my_tree, my_damage_model = build_tree_and_damages(params)
+            key = structural_key(params)
+            my_optimization = optimize_plan(my_tree=my_tree)
+            my_warm_start = warm_start_store(my_optimization.output_path, my_tree.nperiods, my_tree.final_states, my_tree.x_dim)
+        else :
+            set_utility_parameters(my_tree, params)
+        my_cost_model = build_cost_model(my_tree, params)
+        run_parameters = model_parameters(my_tree, my_damage_model, my_cost_model)
+        if guess is None or len(guess) != my_tree.x_dim :
+            my_optimization.get_warm_start(my_warm_start, run_parameters)
+            guess = my_optimization.guess
+        my_optimization.set_constraints(constrain=0)
+        res = fmin_l_bfgs_b( fm.utility_function, guess, fprime=fm.analytic_utility_gradient, factr=1., pgtol=1.0e-5, bounds=(my_optimization.xbounds),
+                             maxfun=600, args=([my_tree, my_damage_model, my_cost_model]))
+        guess = res[0].copy()
+        my_warm_start.add(run_parameters, res[0], res[1])
+        scc = my_cost_model.price_by_state( res[0][0], 0., 0.)
+        log.log_it('sweep point %i: fit %f scc %f funcalls %i rebuilt %i' % (index, res[1], scc, res[2]['funcalls'], rebuilt))
+        results.append( { 'index' : index, 'params' : params, 'plan' : res[0], 'fit' : res[1], 'scc' : scc,
+                          'funcalls' : res[2]['funcalls'], 'rebuilt' : rebuilt } )
+    return results
+
+def run_sweep(points, processes=None):
+    '''Solves a parameter sweep by continuation, chains in parallel
+
+    Parameters
+    ----------
+    points : list of dict
+        the sweep points, each a dict of the parameters that differ from default_parameters, eg { 'ra' : 5. }
+
+    processes : integer
+        number of worker processes (and chains), None uses every core
+
+    Returns
+    -------
+    results : list of dict
+        one result per point in the order of points, see solve_chain
+    '''
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    chains = create_chains(points, processes)
+    log.log_it('sweep of %i points in %i chains' % (len(points), len(chains)))
+    tasks = [ [ (index, points[index]) for index in chain ] for chain in chains ]
+    if len(tasks) == 1 :
+        chain_results = [ solve_chain(tasks[0]) ]
+    else :
+        pool = multiprocessing.Pool(len(tasks), initializer=init_sweep_worker, initargs=(multiprocessing.Lock(),))
+        try:
+            chain_results = pool.map(solve_chain, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    results = [ None ] * len(points)
+    for chain in chain_results :
+        for result in chain :
+            results[ result['index'] ] = result
+    return results
+
+def grid(**values):
+    '''Creates the points of a full grid sweep
+
+    Parameters
+    ----------
+    values : lists
+        the values of each swept parameter, eg grid(ra=[5., 7., 9.], eis=[.8, .9])
+
+    Returns
+    -------
+    points : list of dict
+    '''
+    points = [ {} ]
+    for name, name_values in values.items() :
+        points = [ dict(point, **{ name : value }) for point in points for value in name_values ]
+    return points
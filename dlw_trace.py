@@ -0,0 +1,183 @@
+'''
+   Optimizer telemetry for the dlw climate model
+   each L-BFGS iteration is recorded to a per-job trace file (one JSON line per iteration), and every few iterations
+   the iterate and the recent (s, y) pairs of the L-BFGS memory are checkpointed, so a restarted job resumes
+   from its last checkpoint instead of from the initial guess; a job that finishes removes its checkpoint
+'''
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+
+log = LogUtil() # Instanciate the logger utility.
+
+def job_name(params, task, my_damage_model=None):
+    '''    the name of an optimization job: the task and a hash of the model parameters (see dlw_warm_start.model_parameters)
+        and, when my_damage_model is given, of its number of draws and its damage matrix, which identifies the simulation
+    '''
+    digest = hashlib.md5( json.dumps(params, sort_keys=True, default=float).encode() )
+    if my_damage_model is not None :
+        digest.update( json.dumps([ my_damage_model.draws, my_damage_model.over ]).encode() )
+        digest.update( np.ascontiguousarray(my_damage_model.d, dtype=float).tobytes() )
+    return '%s_%s' % (task, digest.hexdigest()[:12])
+
+class optimization_trace(object):
+    '''Trace and checkpoints of one optimization job
+    '''
+    def __init__(self, output_path, job, checkpoint_every=10, memory=10):
+        '''Initializes the trace
+
+        Parameters
+        ----------
+        output_path : string
+            directory of the trace and checkpoint files
+
+        job : string
+            name of the job, see job_name
+
+        checkpoint_every : integer
+            number of iterations between checkpoints
+
+        memory : integer
+            number of (s, y) pairs kept in the checkpoint, as in the L-BFGS memory
+        '''
+        self.trace_filename = os.path.join(output_path, 'trace_%s.jsonl' % job)
+        self.checkpoint_filename = os.path.join(output_path, 'checkpoint_%s.npz' % job)
+        self.job = job
+        self.checkpoint_every = checkpoint_every
+        self.memory = memory
+
+    def resume(self, guess, xbounds):
+        '''Finds the starting plan of the job
+
+        Parameters
+        ----------
+        guess : float vector
+            the starting plan when there is no usable checkpoint
+
+        xbounds : list
+            the bounds on mitigation, a checkpoint written under other bounds is not used
+
+        Returns
+        -------
+        guess : float vector
+            the iterate of the last checkpoint, or guess
+        '''
+        self.iteration = 0
+        self.s = np.zeros([0, len(guess)])
+        self.y = np.zeros([0, len(guess)])
+        if os.path.exists(self.checkpoint_filename):
+            with np.load(self.checkpoint_filename) as checkpoint:
+                if checkpoint['x'].shape == np.shape(guess) and np.array_equal( checkpoint['xbounds'], np.array(xbounds, dtype=float) ):
+                    self.iteration = int(checkpoint['iteration'])
+                    self.s = checkpoint['s']
+                    self.y = checkpoint['y']
+                    log.log_it('job %s resumes from the checkpoint at iteration %i, fit %f' % (self.job, self.iteration, checkpoint['fit']))
+                    return checkpoint['x'].copy()
+        return np.array(guess, dtype=float)
+
+    def projected_gradient(self, x, grad):
+        '''    the gradient projected on the bounds, its largest element is the quantity L-BFGS-B compares with pgtol
+        '''
+        return np.minimum( np.maximum( x - grad, self.lower ), self.upper ) - x
+
+    def evaluated(self, x):
+        '''    the objective and gradient of the last evaluation at x, None if x was not evaluated
+        '''
+        return self.evaluations.get( x.tobytes() )
+
+    def record(self, x, final=False):
+        '''    write the trace line of the iterate x, update the (s, y) memory and checkpoint when due (never for the final line)
+        '''
+        fit, grad = self.evaluated(x) or ( np.nan, np.zeros(len(x)) )
+        step = np.sqrt( ((x - self.last_x)**2).sum() )
+        if self.last_grad is not None and step > 0. :
+            self.s = np.vstack( [self.s, x - self.last_x] )[-self.memory:]
+            self.y = np.vstack( [self.y, grad - self.last_grad] )[-self.memory:]
+        active = int( np.sum( (x <= self.lower) | (x >= self.upper) ) )
+        line = { 'iteration' : self.iteration, 'fit' : float(fit), 'pgnorm' : float( np.abs(self.projected_gradient(x, grad)).max() ),
+                 'step' : float(step), 'active' : active, 'funcalls' : self.funcalls, 'time' : round(time.time() - self.start_time, 4) }
+        if final :
+            line['final'] = True
+        self.trace_file.write( json.dumps(line) + '\n' )
+        self.trace_file.flush()
+        self.last_x = x.copy()
+        self.last_grad = grad
+        if not final and self.iteration % self.checkpoint_every == 0 :
+            self.checkpoint(x, fit)
+
+    def checkpoint(self, x, fit):
+        '''    write the iterate and the (s, y) memory to the checkpoint file
+        '''
+        temp_filename = self.checkpoint_filename + '.%i.tmp' % os.getpid()
+        with open(temp_filename, 'wb') as f:
+            np.savez(f, x=x, fit=fit, iteration=self.iteration, s=self.s, y=self.y, xbounds=np.array(self.xbounds, dtype=float))
+        os.replace(temp_filename, self.checkpoint_filename)
+
+    def minimize(self, func, guess, fprime, xbounds, args=(), **options):
+        '''Runs fmin_l_bfgs_b with telemetry, starting from the last checkpoint of the job when there is one
+            scipy does not accept an initial L-BFGS memory, so a resumed run restarts its memory from the checkpointed iterate;
+            the (s, y) pairs are kept in the checkpoint for diagnostics
+            a new run starts a new trace file, a resumed run continues the trace of the interrupted one; when fmin_l_bfgs_b
+            returns the checkpoint is removed, so a later job with the same name starts from its own guess
+
+        Parameters
+        ----------
+        func, fprime : functions
+            objective and gradient, as passed to fmin_l_bfgs_b
+
+        guess : float vector
+            the starting plan when there is no usable checkpoint
+
+        xbounds : list
+            the bounds on mitigation
+
+        args : tuple
+            extra arguments of func and fprime
+
+        options : keywords
+            passed on to fmin_l_bfgs_b (factr, pgtol, maxfun, ...)
+
+        Returns
+        -------
+        res : tuple
+            the result of fmin_l_bfgs_b
+        '''
+        guess = self.resume(guess, xbounds)
+        resumed = self.iteration > 0
+        self.xbounds = xbounds
+        self.lower = np.array([ bound[0] for bound in xbounds ], dtype=float)
+        self.upper = np.array([ bound[1] for bound in xbounds ], dtype=float)
+        self.evaluations = {}
+        self.funcalls = 0
+        self.last_x = guess.copy()
+        self.last_grad = None
+        self.start_time = time.time()
+
+        def objective(x, *var_args):
+            fit = func(x, *var_args)
+            self.funcalls += 1
+            self.evaluations = { x.tobytes() : ( fit, self.evaluations.get(x.tobytes(), (None, None))[1] ) }
+            return fit
+
+        def gradient(x, *var_args):
+            grad = np.array( fprime(x, *var_args) )
+            fit = self.evaluations.get(x.tobytes(), (np.nan, None))[0]
+            self.evaluations = { x.tobytes() : ( fit, grad ) }
+            return grad
+
+        def callback(x):
+            self.iteration += 1
+            self.record(x)
+
+        with open(self.trace_filename, 'a' if resumed else 'w') as self.trace_file:
+            res = fmin_l_bfgs_b( objective, guess, fprime=gradient, bounds=xbounds, args=args, callback=callback, **options )
+            self.evaluations[ res[0].tobytes() ] = ( res[1], res[2]['grad'] )
+            self.record(res[0], final=True)
+        if os.path.exists(self.checkpoint_filename):
+            os.remove(self.checkpoint_filename)
+        log.log_it('job %s: fit %f after %i iterations, %i function calls, trace in %s' % (self.job, res[1], self.iteration, res[2]['funcalls'], self.trace_filename))
+        return res
@@ -15,7 +15,7 @@ class tree_model():
     '''
     '''   six period initialization    '''
     def __init__(self,tp1=10,analysis=4,final_states=32,nperiods=6,peak_temp_interval=30.,x_dim=63,
-                 sub_interval_length=5,prob_scale=1.0,growth=.02,eis=0.9,ra=7.0,time_pref=.005,
+                 sub_interval_length=5,prob_scale=1.0,growth=.02,eis=0.9,ra=7.0,time_pref=.005,branching=2,utility_steps=None,
                  decision_times = [ 0, 15, 45, 85, 185, 285, 385],
                  print_options = [ 1, 1, 1, 1, 1,  1, 1, 0, 1, 1, 1 ] ):
 #                 print_options = [ 1, 1, 1, 1, 1,  1, 1, 0, 1, 1, 1 ] ):
@@ -53,6 +53,13 @@ class tree_model():
         sub_interval_length : integer
             the number of eqully spaced times in the utility tree between decision tree periods
 
+        utility_steps : float vector
+            None for utility periods of sub_interval_length years everywhere, else the longest utility period in each decision period
+            the first utility period of a decision period stays sub_interval_length years (it carries the branching), the rest of the
+            decision period, where consumption is interpolated between the decision times, is split in steps of at most this length
+            and the consumption of a step aggregates its sub_interval_length periods in closed form (see dlw_utility.consumption_aggregation)
+            eg [ 385 ]*nperiods makes every interpolated stretch a single utility period
+
         prob_scale : float
             parameter that determines the probabilities of the nodes (1 -> equal prob) (>1 implies explore the tail with more states)
 
@@ -68,6 +75,10 @@ class tree_model():
         time_pref : float
             pure rate of time discount of future utility
 
+        branching : integer
+            the number of nodes each node branches into at an information period, 2 for a binomial tree, 3 for a trinomial tree
+            the tree has branching**(nperiods-1) final states and x_dim = (branching**nperiods-1)/(branching-1) nodes
+
         decision_times :  float vector
             times of the tree in which decisions are made on mitigation
 
@@ -89,12 +100,19 @@ class tree_model():
         log.log_it("time_period_one %i " % tp1)
         self.final_states = final_states
         self.nperiods = nperiods
+        self.branching = branching
+        if final_states != branching**(nperiods-1) or x_dim != sum([ branching**p for p in range(0, nperiods) ]) :
+            raise ValueError('a tree of %i periods branching %i ways has %i final states and %i nodes, not %i and %i'
+                             % (nperiods, branching, branching**(nperiods-1), sum([ branching**p for p in range(0, nperiods) ]), final_states, x_dim))
         self.peak_temp_interval = peak_temp_interval
         self.x_dim = x_dim
 #
 #        self.utility_breaks = utility_breaks
 #
         self.sub_interval_length = sub_interval_length
+        if utility_steps is not None and len(utility_steps) != nperiods :
+            raise ValueError('utility_steps has %i elements, one per decision period (%i) is needed' % (len(utility_steps), nperiods))
+        self.utility_steps = utility_steps
         
         self.prob_scale = prob_scale
         self.growth = growth
@@ -118,11 +136,10 @@ class tree_model():
         log.log_it('utility_nperiods: %i' % self.utility_nperiods)
 
         for p in range(1, self.nperiods):
-            self.decision_nodes.append( 2**p )
+            self.decision_nodes.append( self.branching**p )
             self.decision_period_pointer.append( self.decision_period_pointer[p-1] + self.decision_nodes[p-1] )
 
         u_time = 0.
-        self.first_period_intervals = int(self.decision_times[1]/self.sub_interval_length)
         self.first_period_epsilon = 0.0
         self.utility_times = [ u_time ]
         self.decision_period = [ 1 ]
@@ -133,11 +150,24 @@ class tree_model():
         tree_period = 0
         self.utility_decision_period = [ tree_period ]
         self.breaks = [0]
+        '''
+           utility_substeps is the number of sub_interval_length periods in each utility period, interpolation_period the utility period
+           whose consumption the interpolated consumption of a utility period is interpolated to: the next one on the uniform grid,
+           the end of the interpolated stretch with utility_steps
+        '''
+        self.utility_substeps = [ 1 ]
+        stretch_end = []
 
         for p in range(0, self.nperiods):
             u_period = self.sub_interval_length
-            self.breaks.append( int( (self.decision_times[p+1]-self.decision_times[p])/self.sub_interval_length))
-                                                          
+            steps = [ 1 ] * int( (self.decision_times[p+1]-self.decision_times[p])/self.sub_interval_length)
+            if utility_steps is not None and len(steps) > 1 :
+                max_steps = max( 1, int( utility_steps[p]/self.sub_interval_length ) )
+                nstretch = -( -(len(steps)-1) // max_steps )
+                steps = [ 1 ] + [ (len(steps)-1)//nstretch + (1 if s < (len(steps)-1) % nstretch else 0) for s in range(0, nstretch) ]
+            self.breaks.append( len(steps) )
+            stretch = []
+
             for brk in range(0, self.breaks[p+1]):
                 if brk == 0 :
                     nodes = self.decision_nodes[p]
@@ -145,27 +175,39 @@ class tree_model():
                     nodes = self.decision_nodes[min(p+1, self.nperiods-1)]
                     self.decision_period.append( 0 )
                     self.information_period.append( 0 )
-                    u_time += u_period
+                    u_time += u_period * steps[brk-1]
                     self.utility_times.append( u_time )
+                    self.utility_substeps.append( steps[brk] )
+                    stretch.append( len(self.utility_times)-1 )
                 first_node += nodes
                 self.utility_period_pointer.append( first_node )
                 self.utility_period_nodes.append( nodes )
                 self.utility_decision_period.append( p )
 
 
-            u_time += u_period
+            u_time += u_period * (steps[-1] if steps else 1)
             self.utility_times.append(u_time)
+            self.utility_substeps.append( 1 )
+            stretch_end += [ (u, len(self.utility_times)-1) for u in stretch ]
             self.decision_period.append( 1 )
             if p < self.nperiods-2 :
                 self.information_period.append( 1 )
             else :
                 self.information_period.append( 0 )
+        if utility_steps is not None :
+            self.utility_nperiods = len(self.utility_times)
+            log.log_it('utility_nperiods with utility_steps %s: %i' % (utility_steps, self.utility_nperiods))
+        self.first_period_intervals = self.breaks[1]
+        self.interpolation_period = [ u+1 for u in range(0, len(self.utility_times)) ]
+        if utility_steps is not None :
+            for u, end in stretch_end :
+                self.interpolation_period[u] = end
         for p in range(0, self.utility_nperiods-2):
             self.utility_period_nodes[p] = self.utility_period_nodes[p+1]
             self.utility_decision_period[p] = self.utility_decision_period[p+1]
 
         if self.breaks[self.nperiods]==0:
-            self.utility_period_nodes[self.utility_nperiods-2] = self.utility_period_nodes[self.utility_nperiods-3]*2
+            self.utility_period_nodes[self.utility_nperiods-2] = self.utility_period_nodes[self.utility_nperiods-3]*self.branching
             self.utility_decision_period[self.utility_nperiods-2] = self.utility_decision_period[self.utility_nperiods-3]+1
             self.utility_period_pointer.append( self.utility_period_pointer[self.utility_nperiods-2] + self.utility_period_nodes[self.utility_nperiods-2] )
 
@@ -248,7 +290,7 @@ class tree_model():
         for p in range(0, self.nperiods-1):
             node_from = []
             for p_nodes in range(0, self.final_states):
-                add_n = int(p_nodes/(2**(self.nperiods-2-p)))
+                add_n = int(p_nodes/(self.branching**(self.nperiods-2-p)))
                 node_from.append( from_n+add_n )
             last_n = from_n+add_n+1
             for p_nodes in range(from_n, last_n):
@@ -298,8 +340,8 @@ class tree_model():
         for p in range(1, self.nperiods-1):
             node_range = []
             first_node = 0
-            for p_nodes in range(0,2**p):
-                last_node = first_node + 2**(self.nperiods-1-p)-1
+            for p_nodes in range(0,self.branching**p):
+                last_node = first_node + self.branching**(self.nperiods-1-p)-1
                 node_range.append( [first_node, last_node] )
                 first_node = last_node+1
             self.node_mapping.append(  node_range  )
@@ -323,8 +365,8 @@ class tree_model():
          next_node[n][1] 
                provides a pointer to the last node in the next period pointed to from node n
 
-         note that in this particular tree structure each node always points to 2 nodes, but this mapping
-           allows that constraint to be relaxed
+         note that in this particular tree structure each node always points to branching nodes (2 in the example),
+           but this mapping allows that constraint to be relaxed
 
                for example, with nperiods = 5
          next_node: [[1, 2], [3, 4], [5, 6], [7, 8], [9, 10], [11, 12], [13, 14], [15, 16], [17, 18], [19, 20],
@@ -332,17 +374,17 @@ class tree_model():
 
            also computed in this loop is node_num
            node_num provides, for each node, the number of nodes pointed to in the next period
-                 again in this construction node_num always = 2, but this can be relaxed
+                 again in this construction node_num always = branching, but this can be relaxed
 
            node_num: [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2]
         '''
         self.next_node = []
         self.node_num = []
         first_node = 1
-        for n in range(0, 2**(self.nperiods-1)-1):
-            self.next_node.append( [ first_node, first_node+1 ])
-            first_node += 2
-            self.node_num.append( 2 )
+        for n in range(0, self.x_dim-self.final_states):
+            self.next_node.append( [ first_node, first_node+self.branching-1 ])
+            first_node += self.branching
+            self.node_num.append( self.branching )
 
         return
 
@@ -400,6 +442,102 @@ class tree_model():
         return
 
 
+    def recombining_class(self, state):
+        '''  the damage class of a final state in the recombining tree: the sum of the branch indices along the path to the state,
+             that is of its digits in base branching (for a binomial tree the number of up moves), see damage_model.initialize_tree
+        '''
+        d_class = 0
+        while state > 0 :
+            d_class += state % self.branching
+            state = state // self.branching
+        return d_class
+
+    def pruned_representatives(self, threshold):
+        '''  ties the decision nodes whose probability is below threshold to their parent, for an approximate optimization of skewed trees
+
+           a node with node_probs below threshold takes the mitigation of its parent, and the nodes of its subtree, whose
+           probabilities are smaller still, follow it, so every low probability subtree is frozen at the mitigation of the
+           nearest ancestor whose probability is at least threshold
+
+        Parameters
+        ----------
+        threshold : float
+            probability below which a node is tied to its parent
+
+        Returns
+        -------
+        representative : integer array
+            for each decision node, the node whose mitigation it takes (itself if it is not tied)
+        '''
+        representative = np.arange(self.x_dim)
+        for n in range(0, len(self.next_node)):
+            for child in range( self.next_node[n][0], self.next_node[n][1]+1):
+                if child < self.x_dim and self.node_probs[child] < threshold :
+                    representative[child] = representative[n]
+        return representative
+
+    def coarse_decision_times(self):
+        '''  the decision times of the tree with one period less used by a coarse-to-fine optimization:
+             the second decision time after the first period is dropped, so first period mitigation covers the same years
+             and the later, long periods are kept, eg [ 0, 15, 45, 85, 185, 285, 385] -> [ 0, 15, 85, 185, 285, 385]
+        '''
+        return [ self.decision_times[0], self.decision_times[1] ] + list(self.decision_times[3:self.nperiods+1])
+
+    def prolongation(self, coarse_tree):
+        '''  maps every decision node of this tree to the node of a coarser tree (fewer periods and/or final states) whose
+             mitigation it starts from in a coarse-to-fine optimization
+
+           the node of a period takes the coarse decision in force at the start of the period, in the last coarse period
+           that starts no later; within that period the states of both trees are ordered the same way (by damage),
+           so the node takes the coarse node whose range of cumulative probability contains the middle of its own range
+           the node probabilities of both trees must be set (see damage_model.initialize_tree)
+
+        Parameters
+        ----------
+        coarse_tree : tree_model object
+            the coarse tree, with the same total time
+
+        Returns
+        -------
+        coarse_node : integer array
+            for each decision node of this tree, the coarse node it is mapped to
+        '''
+        coarse_node = np.zeros(self.x_dim, dtype=int)
+        for p in range(0, self.nperiods):
+            q = max([ qq for qq in range(0, coarse_tree.nperiods) if coarse_tree.decision_times[qq] <= self.decision_times[p] ])
+            nodes = self.decision_period_pointer[p] + np.arange(self.decision_nodes[p])
+            coarse_nodes = coarse_tree.decision_period_pointer[q] + np.arange(coarse_tree.decision_nodes[q])
+            middle = np.cumsum(self.node_probs[nodes]) - .5*self.node_probs[nodes]
+            coarse_end = np.cumsum(coarse_tree.node_probs[coarse_nodes])
+            coarse_node[nodes] = coarse_nodes[ np.minimum( np.searchsorted(coarse_end, middle), len(coarse_nodes)-1 ) ]
+        return coarse_node
+
+    def subtree_nodes(self, split_period, subtree):
+        '''  the nodes of one of the branching**split_period subtrees the tree splits into at decision period split_period
+
+           the nodes of every period are ordered so that the descendants of a node are consecutive, so subtree s holds the s-th of
+           branching**split_period equal blocks of the nodes of every period from split_period on; with split_period 0 the subtree is the tree
+
+        Returns
+        -------
+        states : range
+            the final states of the subtree
+
+        decision_nodes : integer array
+            the decision nodes of the subtree, in the periods from split_period on
+
+        utility_nodes : list of (integer, range)
+            the utility periods whose decision period is split_period or later (but the final one), last period first,
+            with the period nodes of the subtree in each
+        '''
+        nsubtrees = self.branching**split_period
+        states = range( subtree*self.final_states//nsubtrees, (subtree+1)*self.final_states//nsubtrees )
+        decision_nodes = np.concatenate( [ self.decision_period_pointer[p] + np.arange( subtree*self.decision_nodes[p]//nsubtrees, (subtree+1)*self.decision_nodes[p]//nsubtrees )
+                                           for p in range(split_period, self.nperiods) ] )
+        utility_nodes = [ ( u_period, range( subtree*self.utility_period_nodes[u_period]//nsubtrees, (subtree+1)*self.utility_period_nodes[u_period]//nsubtrees ) )
+                          for u_period in range(self.utility_nperiods-2, -1, -1) if self.utility_decision_period[u_period] >= split_period ]
+        return states, decision_nodes, utility_nodes
+
     def allocate_data_structures(self):
         '''   Creates data structures to store tree values
         '''
@@ -414,9 +552,14 @@ class tree_model():
         self.final_damage_by_state = np.zeros(self.final_states)
         self.final_total_derivative_term = np.zeros(self.final_states)
         self.cost_by_state = np.zeros(self.x_dim)
-        self.marginal_utility_by_state = np.zeros([self.utility_full_tree,3])
-        self.marginal_utility_in_tree = np.zeros([self.full_tree,3])
+        ''' marginal utility wrt consumption now (column 0) and in each branch next period (columns 1 to branching) '''
+        self.marginal_utility_by_state = np.zeros([self.utility_full_tree,self.branching+1])
+        self.marginal_utility_in_tree = np.zeros([self.full_tree,self.branching+1])
         self.sdf_in_tree = np.zeros(self.utility_full_tree)
+        ''' with utility_steps, the ratio of the aggregated consumption of a utility period to consumption at its start, and the value of
+            a payment at its start in units of the aggregated consumption, see dlw_utility.utility_by_node (1 on the uniform grid) '''
+        self.consumption_aggregation = np.ones(self.utility_full_tree)
+        self.payment_weight = np.ones(self.utility_full_tree)
         self.ghg_by_state = np.zeros(self.full_tree)
         self.emissions_per_period = np.zeros(self.nperiods)
         self.emissions_to_ghg = np.zeros(self.nperiods)
@@ -462,7 +605,7 @@ class tree_model():
             first_node = self.decision_period_pointer[p]
             previous_first_node = self.decision_period_pointer[p-1]
             for n in range(0, self.decision_nodes[p]):
-                previous_node = previous_first_node+int(n/2)
+                previous_node = previous_first_node+int(n/self.branching)
                 self.ghg_by_state[first_node+n] = self.ghg_by_state[previous_node] + self.additional_emissions_by_state[previous_node]
             
         first_node = self.decision_period_pointer[self.nperiods-1]+self.final_states
@@ -16,25 +16,33 @@ def utility_function(x,*var_args):
        these future damages depend on the given choices of emissions reductions in prior periods, x[0]...
        as well as emissions reductions in state n, x[n]
     '''
+    subtree_utility(x, 0, 0, *var_args)
+    return root_utility(x, 0, *var_args)
+
+def subtree_utility(x, split_period, subtree, *var_args):
+    '''
+       the utility recursion in one of the subtrees the tree splits into at decision period split_period (see tree_model.subtree_nodes):
+       final period utility, average mitigation and cost of the decision nodes, and the utility periods from split_period on;
+       the subtrees are independent, each only writes the nodes of its own subtree, root_utility completes the recursion
+       with split_period 0 there is one subtree, the whole tree
+    '''
     my_tree = var_args[0]
     my_damage_model = var_args[1]
-    my_cost_model = var_args[2]
+    states, decision_nodes, utility_nodes = my_tree.subtree_nodes(split_period, subtree)
 
     period = my_tree.nperiods
 
     ''' r is the parameter rho from the dlw paper
-        a is alpha in the dlw paper
         b is beta in the dlw paper  (for continuation use an annual discounting period)
     '''
     period_length = my_tree.utility_times[1] - my_tree.utility_times[0]
     r = ( 1.0 - 1.0 / my_tree.eis)
-    a = ( 1.0 - my_tree.ra)
     b = (1.0 - my_tree.time_pref)**period_length
 
     first_node = my_tree.x_dim
     utility_periods = my_tree.utility_nperiods-2
     first_utility_node = my_tree.utility_period_pointer[utility_periods] + my_tree.utility_period_nodes[utility_periods]
-    for n in range(0, my_tree.final_states):
+    for n in states:
 
         my_tree.ave_mitigation[first_node+n] = my_damage_model.average_mitigation(x,first_node+n)
         my_tree.final_damage_by_state[n] = my_damage_model.damage_function(x, first_node+n)
@@ -50,34 +58,20 @@ def utility_function(x,*var_args):
         my_tree.consumption_by_state[first_utility_node+n] = my_tree.potential_consumption[period] * (1. - my_tree.final_damage_by_state[n])
         my_tree.utility_by_state[first_utility_node+n] = (1. - b)**(1./r) * my_tree.consumption_by_state[first_utility_node+n] * continuation
 #        print 'util calc', continuation, my_tree.consumption_by_state[first_utility_node+n],my_tree.utility_by_state[first_utility_node+n]
+    decision_node_cost(x, decision_nodes, *var_args)
+    for u_period, period_nodes in utility_nodes:
+        period_utility(x, u_period, period_nodes, *var_args)
+
+def root_utility(x, split_period, *var_args):
     '''
-        calculate utility at time nperiods-2
-        note:  no uncertainty at this time -- the value of the final state is known, the final mitigation is chosen with full information
+       completes the utility recursion after subtree_utility has run in every subtree of decision period split_period:
+       the decision nodes and the utility periods before split_period, and the ghg levels; returns the objective (minus utility at time 0)
     '''
-    for back in range( 0, my_tree.utility_nperiods-1 ):
-        u_period = utility_periods - back
-        first_node = my_tree.utility_period_pointer[u_period]
-        for n in range(0, my_tree.utility_period_nodes[u_period]):
-        
-            my_tree.utility_by_state[first_node+n] = utility_by_node( my_tree, my_damage_model, my_cost_model, u_period, n, x )
-            marginal_utility_by_node( my_tree, my_damage_model, my_cost_model, u_period, n, x )
-            my_tree.utility_by_state[first_node+n] = utility_by_node( my_tree, my_damage_model, my_cost_model, u_period, n, x )
-#            if back>0 : #  for earlier periods add payment at t "epsilon" times marginal utility to utility at t
-            my_tree.utility_by_state[first_node+n] += my_tree.period_consumption_epsilon[my_tree.utility_nperiods-back-2] * my_tree.marginal_utility_by_state[first_node+n,0]
-            my_tree.utility_by_state[first_node+n] += my_tree.node_consumption_epsilon[first_node+n] * my_tree.marginal_utility_by_state[first_node+n,0]
-            
-            '''
-                calculation of zero-coupon bond price requires finding price such that utility( cons + price ) = discounted final_state_utility(consumption + epsilon)
-                in general epsilon = 0, but for finding bond price epsilon = $1
-            '''
-            if back==0 :
-                my_tree.utility_by_state[first_node+n] += my_tree.final_period_consumption_epsilon * my_tree.marginal_utility_by_state[first_node+n,1]
-            if back==0 :    # for final period use marginal utility at t of c(t+1) to calculate additional utility of payment at t+1
-                my_tree.utility_by_state[first_node+n] += my_tree.period_consumption_epsilon[my_tree.utility_nperiods-1] * my_tree.marginal_utility_by_state[first_node+n,1]
-            '''
-               now for periods 1,...,nperiods-2 (working backwards) calculate the utility using info known at that time
-               what is known is that the true state is in a given partition of the final states
-            '''
+    my_tree = var_args[0]
+    decision_node_cost(x, np.arange(my_tree.decision_period_pointer[split_period]), *var_args)
+    for u_period in range(my_tree.utility_nperiods-2, -1, -1):
+        if my_tree.utility_decision_period[u_period] < split_period :
+            period_utility(x, u_period, range(0, my_tree.utility_period_nodes[u_period]), *var_args)
     '''
         create a final certainty equivalent sum over the utility in states at time 1
     '''
@@ -91,25 +85,65 @@ def utility_function(x,*var_args):
     
     return util
 
+def decision_node_cost(x, nodes, *var_args):
+    '''
+        average mitigation and mitigation cost in the decision nodes nodes, cost in one vectorized pass
+    '''
+    my_tree = var_args[0]
+    my_damage_model = var_args[1]
+    my_cost_model = var_args[2]
+    for node in nodes:
+        my_tree.ave_mitigation[node] = my_damage_model.average_mitigation(x, node)
+    my_tree.cost_by_state[nodes] = my_cost_model.cost_by_state_array( np.asarray(x, dtype=float)[nodes], my_tree.ave_mitigation[nodes], nodes )
+
+def period_utility(x, u_period, period_nodes, *var_args):
+    '''
+        calculate utility in the nodes period_nodes of utility period u_period, the utility of the next period must be known
+        note:  at time nperiods-2 there is no uncertainty -- the value of the final state is known, the final mitigation is chosen with full information
+    '''
+    my_tree = var_args[0]
+    my_damage_model = var_args[1]
+    my_cost_model = var_args[2]
+    back = my_tree.utility_nperiods-2 - u_period
+    first_node = my_tree.utility_period_pointer[u_period]
+    for n in period_nodes:
+    
+        my_tree.utility_by_state[first_node+n] = utility_by_node( my_tree, my_damage_model, my_cost_model, u_period, n, x )
+        marginal_utility_by_node( my_tree, my_damage_model, my_cost_model, u_period, n, x )
+        my_tree.utility_by_state[first_node+n] = utility_by_node( my_tree, my_damage_model, my_cost_model, u_period, n, x )
+#        if back>0 : #  for earlier periods add payment at t "epsilon" times marginal utility to utility at t
+        my_tree.utility_by_state[first_node+n] += my_tree.period_consumption_epsilon[my_tree.utility_nperiods-back-2] * my_tree.marginal_utility_by_state[first_node+n,0]
+        my_tree.utility_by_state[first_node+n] += my_tree.node_consumption_epsilon[first_node+n] * my_tree.marginal_utility_by_state[first_node+n,0]
+        
+        '''
+            calculation of zero-coupon bond price requires finding price such that utility( cons + price ) = discounted final_state_utility(consumption + epsilon)
+            in general epsilon = 0, but for finding bond price epsilon = $1
+        '''
+        if back==0 :
+            my_tree.utility_by_state[first_node+n] += my_tree.final_period_consumption_epsilon * my_tree.marginal_utility_by_state[first_node+n,1]
+        if back==0 :    # for final period use marginal utility at t of c(t+1) to calculate additional utility of payment at t+1
+            my_tree.utility_by_state[first_node+n] += my_tree.period_consumption_epsilon[my_tree.utility_nperiods-1] * my_tree.marginal_utility_by_state[first_node+n,1]
+        '''
+           now for periods 1,...,nperiods-2 (working backwards) calculate the utility using info known at that time
+           what is known is that the true state is in a given partition of the final states
+        '''
+
 def utility_by_node( tree, damage_model, cost_model, period, period_node, x ):
     node = tree.utility_period_pointer[period] + period_node
     period_length = tree.utility_times[period+1] - tree.utility_times[period]
     tree_period = tree.utility_decision_period[period]
     if period!=tree_period and tree.decision_nodes[tree_period]!=tree.utility_period_nodes[period]:
-        tree_node = tree.decision_period_pointer[tree_period]+int(period_node/2)
+        tree_node = tree.decision_period_pointer[tree_period]+int(period_node/tree.branching)
     else:
         tree_node = tree.decision_period_pointer[tree_period]+period_node
     r = ( 1.0 - 1.0 / tree.eis)
     a = ( 1.0 - tree.ra)
     b = (1.0 - tree.time_pref)**period_length
-    average_mitigation = damage_model.average_mitigation(x, tree_node)
-    tree.ave_mitigation[tree_node] = average_mitigation
     '''        
            damages_by_state stores climate damages at each node in the tree
+           ave_mitigation and cost_by_state were filled for the whole tree by utility_function
     '''
     tree.damage_by_state[tree_node] = damage_model.damage_function(x, tree_node)
-    mitigation = x[ tree_node ]
-    tree.cost_by_state[tree_node] = cost_model.cost_by_state( mitigation, average_mitigation, tree_node )
     if tree.information_period[period]==0 :
         '''
            no branching implies certainty equivalent utility at time period depends only on the utility next period given information known today
@@ -124,7 +158,7 @@ def utility_by_node( tree, damage_model, cost_model, period, period_node, x ):
         '''                
                    this loops over the partition of states reached from node first_node+n
         '''
-        next_utility_node = tree.utility_period_pointer[period+1] + 2*period_node
+        next_utility_node = tree.utility_period_pointer[period+1] + tree.branching*period_node
         for ns in range( tree.next_node[tree_node][0], tree.next_node[tree_node][1]+1 ):
             sum_probs += tree.node_probs[ns]
             ave_util += tree.utility_by_state[next_utility_node]**a * tree.node_probs[ns]
@@ -151,19 +185,30 @@ def utility_by_node( tree, damage_model, cost_model, period, period_node, x ):
         '''
             else use interpolated consumption
         '''
-        next_utility_node = tree.utility_period_pointer[period]+tree.utility_period_nodes[period]+period_node
+        next_period = tree.interpolation_period[period]
+        next_utility_node = tree.utility_period_pointer[next_period]+period_node
         cons_of_x_plus_1 = tree.consumption_by_state[next_utility_node]
-        if tree.utility_decision_period[period+1] != tree_period :
-            next_tree_node =  tree.decision_period_pointer[ tree.utility_decision_period[period+1] ]+ period_node
+        if tree.utility_decision_period[next_period] != tree_period :
+            next_tree_node =  tree.decision_period_pointer[ tree.utility_decision_period[next_period] ]+ period_node
             cons_of_x_plus_1 = cons_of_x_plus_1 * (1.-tree.cost_by_state[tree_node])/(1.-tree.cost_by_state[next_tree_node])
         if tree_period == 0 :
-            interval = tree.utility_times[period+1]
+            interval = tree.utility_times[next_period]
             segment = tree.utility_times[period]            
         else:
-            interval = tree.utility_times[period+1] - tree.decision_times[tree_period]
+            interval = tree.utility_times[next_period] - tree.decision_times[tree_period]
             segment = tree.utility_times[period] - tree.decision_times[tree_period]
             
         interp_cons_at_t = interval_consumption( cons_of_x_plus_1, cons_at_t, segment/interval)
+        if tree.utility_substeps[period] > 1 :
+            '''
+                a utility period of several sub-intervals: the consumption that gives the utility of the sub-intervals, in closed form,
+                and the value of a payment at the start of the period in units of that consumption (see optimize_plan.term_structure)
+            '''
+            b_sub = (1.0 - tree.time_pref)**tree.sub_interval_length
+            aggregation = consumption_aggregation( cons_of_x_plus_1, cons_at_t, tree.sub_interval_length/interval, tree.utility_substeps[period], b_sub, r )
+            tree.consumption_aggregation[node] = aggregation
+            tree.payment_weight[node] = (1. - b_sub) / (1. - b) * aggregation**(1.-r)
+            interp_cons_at_t *= aggregation
         tree.consumption_by_state[node] = interp_cons_at_t
         cons_at_t = interp_cons_at_t
     '''
@@ -180,7 +225,7 @@ def marginal_utility_by_node( tree, damage_model, cost_model, period, period_nod
     period_length = tree.utility_times[period+1] - tree.utility_times[period]
     tree_period = tree.utility_decision_period[period]
     if period!=tree_period and tree.decision_nodes[tree_period]!=tree.utility_period_nodes[period]:
-        tree_node = tree.decision_period_pointer[tree_period]+int(period_node/2)
+        tree_node = tree.decision_period_pointer[tree_period]+int(period_node/tree.branching)
     else:
         tree_node = tree.decision_period_pointer[tree_period]+period_node
     r = ( 1.0 - 1.0 / tree.eis)
@@ -193,6 +238,8 @@ def marginal_utility_by_node( tree, damage_model, cost_model, period, period_nod
            calculate and save marginal utilities -- used to compute the stochastic discount factors
     '''
     tree.marginal_utility_by_state[node, 0] = mu_0( cons_of_x, b, r, a, tree.ce_term[node] )
+    ''' the final period continuation discounts with the first utility period, see subtree_utility '''
+    b_final = (1.0 - tree.time_pref)**(tree.utility_times[1] - tree.utility_times[0])
     if tree.decision_period[period] == 1 :
         tree_node = tree.decision_period_pointer[tree.utility_decision_period[period]]+period_node
         tree.marginal_utility_in_tree[tree_node,0] = tree.marginal_utility_by_state[node,0]
@@ -203,10 +250,10 @@ def marginal_utility_by_node( tree, damage_model, cost_model, period, period_nod
         '''
         next_node = tree.utility_period_pointer[period] + tree.utility_period_nodes[period] + period_node
         cons_at_t_plus_1 = tree.consumption_by_state[next_node]
-        tree.ce_term[next_node] = tree.utility_by_state[next_node]**r - ( 1.0 - b )*cons_at_t_plus_1**r 
-        tree.marginal_utility_by_state[next_node, 0] = (1.0 - b ) * (tree.utility_by_state[node]/tree.consumption_by_state[next_node])**(1-r)
+        tree.ce_term[next_node] = tree.utility_by_state[next_node]**r - ( 1.0 - b_final )*cons_at_t_plus_1**r 
+        tree.marginal_utility_by_state[next_node, 0] = (1.0 - b_final ) * (tree.utility_by_state[node]/tree.consumption_by_state[next_node])**(1-r)
 
-        next_term =  b * (1.0 - b ) / ( 1.0 - b * growth_term**r )
+        next_term =  b * (1.0 - b_final ) / ( 1.0 - b_final * growth_term**r )
         tree.marginal_utility_by_state[node, 1] = tree.utility_by_state[node]**(1-r) * next_term * tree.consumption_by_state[next_node]**(r-1)
         u_term = ( (1.0 - b) * cons_of_x**r + next_term * cons_at_t_plus_1**r ) 
 #        print 'u_term', u_term**(1.0/r), tree.utility_by_state[node], cons_of_x, cons_at_t_plus_1
@@ -217,38 +264,27 @@ def marginal_utility_by_node( tree, damage_model, cost_model, period, period_nod
             tree_node = tree.decision_period_pointer[tree.utility_decision_period[period]]+period_node
             tree.marginal_utility_in_tree[tree_node,1] = tree.marginal_utility_by_state[node,1]
     else :
-        if period==0:
-            next_up = 1
-            next_down = 2
-            prob = tree.node_probs[next_up]
-            tree.marginal_utility_by_state[node,1] = mu_1( tree.consumption_by_state[next_up], b, r, a, cons_of_x, prob, tree.consumption_by_state[next_down], tree.ce_term[next_up], tree.ce_term[next_down])
-            tree.marginal_utility_by_state[node,2] = mu_1( tree.consumption_by_state[next_down], b, r, a, cons_of_x, 1.-prob, tree.consumption_by_state[next_up], tree.ce_term[next_down], tree.ce_term[next_up])
+        b_next = (1.0 - tree.time_pref)**(tree.utility_times[period+2] - tree.utility_times[period+1])
+        if tree.information_period[period]==1 :
+            '''
+               one marginal utility per branch, the branches of the node are consecutive in the next period
+               (for period 0 the nodes 1 to branching)
+            '''
+            branches = np.arange(tree.branching)
+            next_nodes = tree.utility_period_pointer[period+1]+tree.branching*period_node+branches
+            next_tree_nodes = tree.decision_period_pointer[tree.utility_decision_period[period]+1]+tree.branching*period_node+branches
+            prob = tree.node_probs[next_tree_nodes] / tree.node_probs[next_tree_nodes].sum()
+            for i in branches:
+                tree.marginal_utility_by_state[node,1+i] = mu_branch( i, b, r, a, cons_of_x, prob, tree.consumption_by_state[next_nodes], tree.ce_term[next_nodes], b_next)
             if tree.decision_period[period] == 1 :
                 tree_node = tree.decision_period_pointer[tree.utility_decision_period[period]]+period_node
-                tree.marginal_utility_in_tree[tree_node,1] = tree.marginal_utility_by_state[node,1]
-                tree.marginal_utility_in_tree[tree_node,2] = tree.marginal_utility_by_state[node,2]
+                tree.marginal_utility_in_tree[tree_node,1:] = tree.marginal_utility_by_state[node,1:]
         else:
-            if tree.information_period[period]==1 :
-                next_up = tree.utility_period_pointer[period+1]+2*period_node
-                next_down = tree.utility_period_pointer[period+1]+2*period_node+1
-                next_tree_node_up = tree.decision_period_pointer[tree.utility_decision_period[period]+1]+2*period_node
-                prob_up = tree.node_probs[next_tree_node_up]
-                prob_down = tree.node_probs[next_tree_node_up+1]
-                total_prob = prob_up+prob_down
-                prob= prob_up/total_prob
-                tree.marginal_utility_by_state[node,1] = mu_1( tree.consumption_by_state[next_up], b, r, a, cons_of_x, prob, tree.consumption_by_state[next_down], tree.ce_term[next_up], tree.ce_term[next_down])
-                prob = prob_down/total_prob
-                tree.marginal_utility_by_state[node,2] = mu_1( tree.consumption_by_state[next_down], b, r, a, cons_of_x, prob, tree.consumption_by_state[next_up], tree.ce_term[next_down], tree.ce_term[next_up])
-                if tree.decision_period[period] == 1 :
-                    tree_node = tree.decision_period_pointer[tree.utility_decision_period[period]]+period_node
-                    tree.marginal_utility_in_tree[tree_node,1] = tree.marginal_utility_by_state[node,1]
-                    tree.marginal_utility_in_tree[tree_node,2] = tree.marginal_utility_by_state[node,2]
-            else:
-                next_node = tree.utility_period_pointer[period+1] + period_node
-                tree.marginal_utility_by_state[node,1] = mu_2(tree.consumption_by_state[next_node], b, r, a, cons_of_x, tree.ce_term[next_node])
-                if tree.decision_period[period] == 1 :
-                    tree_node = tree.decision_period_pointer[tree.utility_decision_period[period]]+period_node
-                    tree.marginal_utility_in_tree[tree_node,1] = tree.marginal_utility_by_state[node,1]
+            next_node = tree.utility_period_pointer[period+1] + period_node
+            tree.marginal_utility_by_state[node,1] = mu_2(tree.consumption_by_state[next_node], b, r, a, cons_of_x, tree.ce_term[next_node], b_next)
+            if tree.decision_period[period] == 1 :
+                tree_node = tree.decision_period_pointer[tree.utility_decision_period[period]]+period_node
+                tree.marginal_utility_in_tree[tree_node,1] = tree.marginal_utility_by_state[node,1]
     return
 
 def mu_0( x, b, r, a, cefd ):
@@ -276,26 +312,48 @@ def mu_1( x, b, r, a, c0, p, c2, cefd1, cefd2 ):
     mu = (t1 * t2 * t3 * t5 )    
     return mu
 
-def mu_2( x, b, r, a, c0, cefd):
+def mu_branch( i, b, r, a, c0, p, c, cefd, b_next=None ):
+    '''
+       marginal utility of time t utility function with respect to consumption next period in branch i of the next node
+       d/dx of ((1.0-b)*c0^r + b*( sum_j p[j]*((1-b1)*c[j]^r + cefd[j])^(a/r) )^(r/a) )^(1/r)  at x = c[i]
+       where c0 is time t consumption, and p, c and cefd are the probabilities, consumption and cert_equiv utility
+       of the branches, b1 is the discount factor b_next of the next period (None when it is as long as this one),
+       for two branches this is mu_1
+    '''
+    if b_next is None :
+        b_next = b
+    t1 = (1. - b_next) * b * p[i] * c[i]**(r-1)
+    t2 = ( cefd[i] - (b_next - 1.) * c[i]**r )**(a/r-1)
+    t4 = np.dot( p, ( cefd - ( b_next - 1. ) * c**r )**(a/r) )
+    t3 = t4**((r/a)-1.)
+    t5 = ( b * t4**(r/a) - (b-1) * c0**r )**((1.0/r)-1.)
+    mu = (t1 * t2 * t3 * t5 )
+    return mu
+
+def mu_2( x, b, r, a, c0, cefd, b_next=None):
     '''
            marginal utility of time t consumption function with respect to last period consumption
-           d/dx of ((1.0-b)*c0^r + b*( (1-b)*x^r + cefd) )^(r/a) )^(1/r)
+           d/dx of ((1.0-b)*c0^r + b*( (1-b1)*x^r + cefd) )^(r/a) )^(1/r)
+           where b1 is the discount factor b_next of the next period (None when it is as long as this one)
     '''
-    t1 = (1. - b) * b * x**(r-1)
-    t2 = ( (1. - b) * c0**r - ( b - 1.) * b * x**r + b * cefd )**((1./r)-1.)
+    if b_next is None :
+        b_next = b
+    t1 = (1. - b_next) * b * x**(r-1)
+    t2 = ( (1. - b) * c0**r - ( b_next - 1.) * b * x**r + b * cefd )**((1./r)-1.)
     mu = (t1 * t2 )
     return mu
 
 def numerical_utility_gradient(x,*var_args):
-    '''  numerical derivative
+    '''  numerical derivative, one-sided, the utility of the base plan is evaluated once
+         see dlw_parallel.finite_difference_gradient for central differences and for a gradient sharded over processes
     '''
     my_tree = var_args[0]
     delta = .0000001
+    base_utility = utility_function(x,*var_args)
     for n in range(0, my_tree.x_dim):
-        base_utility = utility_function(x,*var_args)
-        x[n] += delta
-        new_utility = utility_function(x,*var_args)
-        x[n] -= delta
+        x_n = np.array(x, dtype=float)
+        x_n[n] += delta
+        new_utility = utility_function(x_n,*var_args)
         my_tree.grad[n] = (new_utility - base_utility)/delta
 
     return(my_tree.grad)
@@ -308,7 +366,7 @@ def d_cert_equiv_utility( my_tree, a, utility_period, period_node, j):
     if my_tree.information_period[utility_period]==1 :
         ave_d_ceu = 0.
         sum_probs = 0.
-        next_node  += 2*period_node
+        next_node  += my_tree.branching*period_node
         for ns in range( my_tree.next_node[tree_node][0], my_tree.next_node[tree_node][1]+1):
             sum_probs += my_tree.node_probs[ns]
             ave_d_ceu += my_tree.node_probs[ns] * a * my_tree.utility_by_state[next_node]**(a-1) * my_tree.d_utility_by_state[next_node][j]
@@ -339,15 +397,50 @@ def d_interval_consumption( ctp1, d_ctp1, ct, d_ct, t):
     d_ave = term1 * term2 
     return( d_ave)
 
+def consumption_aggregation( ctp1, ct, dt, steps, b, r ):
+    '''
+       for a utility period of steps sub-intervals of the interval from ct to ctp1, each a fraction dt of the interval and discounted by b,
+       the ratio of the consumption c that gives the utility of the sub-intervals, (1-b**steps)*c**r = (1-b)*sum_i b**i * c_i**r,
+       to the consumption c_0 at the start of the period; the interpolated consumption c_i = c_0 * (ctp1/ct)**(i*dt) of the
+       sub-intervals grows geometrically, so the sum has a closed form and the ratio does not depend on where the period starts
+    '''
+    q = ( ctp1 / ct )**(r*dt)
+    return aggregate_weight( q, steps, b )**(1./r)
+
+def aggregate_weight( q, steps, b ):
+    '''
+       (1-b)*sum_i (b*q)**i / (1-b**steps), sum over i < steps, see consumption_aggregation
+    '''
+    z = b * q
+    if abs(1. - z) < 1.0e-12 :
+        geometric_sum = float(steps)
+    else :
+        geometric_sum = (1. - z**steps) / (1. - z)
+    return (1. - b) * geometric_sum / (1. - b**steps)
+
+def d_consumption_aggregation( ctp1, d_ctp1, ct, d_ct, dt, steps, b, r ):
+    '''
+       derivative of consumption_aggregation, d_ctp1 and d_ct are the derivatives of ctp1 and ct
+    '''
+    q = ( ctp1 / ct )**(r*dt)
+    d_q = q * r * dt * ( d_ctp1/ctp1 - d_ct/ct )
+    z = b * q
+    if abs(1. - z) < 1.0e-12 :
+        d_geometric_sum = .5 * steps * (steps-1.)
+    else :
+        d_geometric_sum = ( (1. - z**steps) - steps * z**(steps-1) * (1. - z) ) / (1. - z)**2
+    d_weight = (1. - b) * b * d_geometric_sum * d_q / (1. - b**steps)
+    return (1./r) * aggregate_weight( q, steps, b )**(1./r - 1.) * d_weight
+
 def d_consumption( tree, damage_model, cost_model, utility_period, period_node, x, j):
 
     utility_node = tree.utility_period_pointer[utility_period]+period_node
     tree_period = tree.utility_decision_period[utility_period]
     if utility_period!=tree_period and tree.decision_nodes[tree_period]!=tree.utility_period_nodes[utility_period]:
-        tree_node = tree.decision_period_pointer[tree_period]+int(period_node/2)
+        tree_node = tree.decision_period_pointer[tree_period]+int(period_node/tree.branching)
     else:
         tree_node = tree.decision_period_pointer[tree_period]+period_node
-    d_cbs = cost_model.d_cost_by_state( damage_model, x[tree_node], tree.ave_mitigation[tree_node], tree_node, j )
+    d_cbs = cost_model.cost_gradient[tree_node, j]
     d_dbs = damage_model.d_damage_by_state(x, tree_node, j)
     d_cons = -tree.potential_consumption[tree_period] * ( d_dbs*(1.-tree.cost_by_state[tree_node]) + d_cbs*(1.-tree.damage_by_state[tree_node]) )
     d_dmgcons = -tree.potential_consumption[tree_period] * ( d_dbs*(1.-tree.cost_by_state[tree_node]) )
@@ -362,23 +455,36 @@ def d_consumption( tree, damage_model, cost_model, utility_period, period_node,
         '''
             else use interpolated consumption and calculate the derviative of interpolated consumption
         '''
-        next_utility_node = utility_node + tree.utility_period_nodes[utility_period]
+        next_period = tree.interpolation_period[utility_period]
+        next_utility_node = tree.utility_period_pointer[next_period]+period_node
         cons_of_x_plus_1 = tree.consumption_by_state[next_utility_node]
         d_cons_p1 = tree.d_cons_by_state[next_utility_node][j]
         if j == 0 : d_dmgcons_p1 = tree.d_damage[next_utility_node]
-        if tree.utility_decision_period[utility_period+1] != tree_period :
-            next_tree_node =  tree.decision_period_pointer[ tree.utility_decision_period[utility_period+1] ]+ period_node
+        if tree.utility_decision_period[next_period] != tree_period :
+            next_tree_node =  tree.decision_period_pointer[ tree.utility_decision_period[next_period] ]+ period_node
             cons_of_x_plus_1 = cons_of_x_plus_1 * (1.-tree.cost_by_state[tree_node])/(1.-tree.cost_by_state[next_tree_node])
             d_dbs = damage_model.d_damage_by_state(x, next_tree_node, j)
-            d_cons_p1 = -tree.potential_consumption[ tree.utility_decision_period[utility_period+1] ] * ( d_dbs*(1.-tree.cost_by_state[tree_node]) + d_cbs*(1.-tree.damage_by_state[next_tree_node]))
-            if j == 0 : d_dmgcons_p1 = -tree.potential_consumption[ tree.utility_decision_period[utility_period+1] ] * ( d_dbs*(1.-tree.cost_by_state[tree_node]) )
+            d_cons_p1 = -tree.potential_consumption[ tree.utility_decision_period[next_period] ] * ( d_dbs*(1.-tree.cost_by_state[tree_node]) + d_cbs*(1.-tree.damage_by_state[next_tree_node]))
+            if j == 0 : d_dmgcons_p1 = -tree.potential_consumption[ tree.utility_decision_period[next_period] ] * ( d_dbs*(1.-tree.cost_by_state[tree_node]) )
         if tree_period == 0 :
-            interval = tree.utility_times[utility_period+1]
+            interval = tree.utility_times[next_period]
             segment = tree.utility_times[utility_period]            
         else:
-            interval = tree.utility_times[utility_period+1] - tree.decision_times[tree_period]
+            interval = tree.utility_times[next_period] - tree.decision_times[tree_period]
             segment = tree.utility_times[utility_period] - tree.decision_times[tree_period]
         cons_at_t = tree.potential_consumption[tree_period]*(1.-tree.cost_by_state[tree_node])*(1.-tree.damage_by_state[tree_node])
+        if tree.utility_substeps[utility_period] > 1 :
+            ''' the derivative of the aggregated consumption, see consumption_aggregation '''
+            interp_cons_at_t = interval_consumption( cons_of_x_plus_1, cons_at_t, segment/interval )
+            aggregation = tree.consumption_aggregation[utility_node]
+            substeps = ( tree.sub_interval_length/interval, tree.utility_substeps[utility_period], (1.0 - tree.time_pref)**tree.sub_interval_length, 1.0 - 1.0/tree.eis )
+            d_inter_cons = d_interval_consumption( cons_of_x_plus_1, d_cons_p1, cons_at_t, d_cons, segment/interval ) * aggregation \
+                           + interp_cons_at_t * d_consumption_aggregation( cons_of_x_plus_1, d_cons_p1, cons_at_t, d_cons, *substeps )
+            tree.d_cons_by_state[utility_node][j] = d_inter_cons
+            if j == 0 :
+                tree.d_damage[utility_node] = d_interval_consumption( cons_of_x_plus_1, d_dmgcons_p1, cons_at_t, d_dmgcons, segment/interval ) * aggregation \
+                                              + interp_cons_at_t * d_consumption_aggregation( cons_of_x_plus_1, d_dmgcons_p1, cons_at_t, d_dmgcons, *substeps )
+            return(d_inter_cons)
         d_inter_cons = d_interval_consumption( cons_of_x_plus_1, d_cons_p1, cons_at_t, d_cons, segment/interval )
         tree.d_cons_by_state[utility_node][j] = d_inter_cons
         if j == 0 :
@@ -386,18 +492,39 @@ def d_consumption( tree, damage_model, cost_model, utility_period, period_node,
 
     return(d_inter_cons)
 
-def analytic_utility_gradient(x,*var_args):
+def analytic_utility_gradient(x,*var_args, columns=None, directions=None):
     '''
        analytic derivatives are computed in this function
        all variables and arrays with a leading d_ are derivatives
+       columns lists the elements of x to differentiate with respect to, None for all of them,
+       the gradient of the other elements is set to 0 (see reduced_utility_gradient)
+       with directions, an [x_dim] x [columns] matrix, column j of the gradient is the derivative along directions[:, j]
+       instead of wrt x[j] (see tied_utility_gradient)
     '''
     my_tree = var_args[0]
     my_damage_model = var_args[1]
     my_cost_model = var_args[2]
+    if columns is None :
+        columns = range(0, my_tree.x_dim)
+    else :
+        my_tree.grad[:] = 0.
+    if directions is not None :
+        my_damage_model.set_directions(directions)
+        try:
+            return analytic_utility_gradient(x, *var_args, columns=columns)
+        finally:
+            my_damage_model.set_directions(None)
 
     period = my_tree.utility_nperiods-2
     tree_period = my_tree.utility_decision_period[period]+1
 
+    '''
+        derivatives of cost by state for all nodes wrt all mitigations, in one vectorized pass
+    '''
+    my_cost_model.cost_gradient_by_state( my_damage_model, x, my_tree.ave_mitigation )
+    if my_damage_model.directions is not None :
+        my_cost_model.cost_gradient[:, :my_damage_model.directions.shape[1]] = np.dot(my_cost_model.cost_gradient, my_damage_model.directions)
+
     '''
         r = rho in the dlw paper
         a = alpha in the dlw paper
@@ -416,12 +543,12 @@ def analytic_utility_gradient(x,*var_args):
     first_tree_node = my_tree.x_dim
     for n in range(0, my_tree.final_states):
         my_tree.final_damage_by_state[n] = my_damage_model.damage_function(x, first_tree_node+n)
-        for j in range(0, my_tree.x_dim):
+        for j in columns:
             my_tree.d_final_damage_by_state[n][j] = my_damage_model.d_damage_by_state(x, first_tree_node+n, j )
         continuation = ( 1. / (1. - b*growth_term**r) )**(1./r)
         cons_of_x = (my_tree.potential_consumption[tree_period] * (1. - my_tree.final_damage_by_state[n]))
         my_tree.utility_by_state[first_node+n] = (1.-b)**(1./r) * cons_of_x * continuation
-        for j in range(0, my_tree.x_dim):
+        for j in columns:
             my_tree.d_utility_of_final_state[n][j] = -((1.-b)**(1./r) * continuation * my_tree.potential_consumption[tree_period]*my_damage_model.d_damage_by_state(x, first_tree_node+n, j))
             my_tree.d_cons_by_state[first_node+n][j] = -my_tree.potential_consumption[tree_period]*my_tree.d_final_damage_by_state[n][j]
         my_tree.marginal_damages[first_node+n] = my_tree.d_cons_by_state[first_node+n][0]
@@ -445,7 +572,7 @@ def analytic_utility_gradient(x,*var_args):
             '''
                 calculate the derivative of utility with respect to x[j]
             '''
-            for j in range(0,my_tree.x_dim):
+            for j in columns:
                 term1 = (1./r) * ( (1.-b)* my_tree.consumption_by_state[first_node+n]**r + b * my_tree.cert_equiv_utility[first_node+n]**r )**(1./r - 1.)
                 term2 = ( (1.-b) * r * my_tree.consumption_by_state[first_node+n]**(r-1.0))
                 term3 = d_consumption( my_tree, my_damage_model, my_cost_model, utility_period, n, x, j)
@@ -464,10 +591,10 @@ def analytic_utility_gradient(x,*var_args):
     period_length = my_tree.utility_times[1]
     b = ( 1. - my_tree.time_pref)**period_length    
     n = 0
-    for j in range(0, my_tree.x_dim):
+    for j in columns:
         term1 = (1./r) * ( (1.-b)* my_tree.consumption_by_state[n]**r + b * my_tree.cert_equiv_utility[n]**r )**(1./r - 1.)
         term2 = ( (1.-b) * r * my_tree.consumption_by_state[n]**(r-1.))
-        term3 = -my_cost_model.d_cost_by_state( my_damage_model, x[n], 0.0, n, j ) 
+        term3 = -my_cost_model.cost_gradient[n, j]
         if j==0 : my_tree.marginal_damages[0] = term3
         term4 = b * (r/a) * my_tree.cert_equiv_utility[n]**(r-a)
         term5 = d_cert_equiv_utility(  my_tree, a, n, n, j )
@@ -475,3 +602,169 @@ def analytic_utility_gradient(x,*var_args):
         my_tree.grad[j] = -my_tree.d_utility_by_state[0][j]
     return my_tree.grad
 
+def hessian_vector_product(x, v, *var_args, delta=.00001):
+    '''
+       product of the hessian of the objective with the vector v,
+       a central difference of the analytic gradient along v,
+       the gradient uses the tree state left by utility_function so it is evaluated first at each point
+    '''
+    utility_function(x + delta * v, *var_args)
+    grad_plus = analytic_utility_gradient(x + delta * v, *var_args).copy()
+    utility_function(x - delta * v, *var_args)
+    grad_minus = analytic_utility_gradient(x - delta * v, *var_args).copy()
+    return (grad_plus - grad_minus) / (2. * delta)
+
+def reduced_plan(x, xbounds):
+    '''
+       maps the variables pinned by equal lower and upper bounds (see optimize_plan.set_constraints) out of a plan
+       returns the indices of the free variables and the full plan with the pinned variables at their bound,
+       the template that expand_plan fills with the free variables
+    '''
+    lower = np.array([ bound[0] for bound in xbounds ], dtype=float)
+    upper = np.array([ bound[1] for bound in xbounds ], dtype=float)
+    free = np.where( lower < upper )[0]
+    template = np.where( lower < upper, np.asarray(x, dtype=float), lower )
+    return free, template
+
+def expand_plan(x_free, free, template):
+    '''
+       the full plan of the free variables x_free, see reduced_plan
+    '''
+    x = template.copy()
+    x[free] = x_free
+    return x
+
+def reduced_utility_function(x_free, free, template, *var_args):
+    '''
+       the objective as a function of the free variables only, see reduced_plan
+    '''
+    return utility_function( expand_plan(x_free, free, template), *var_args )
+
+def reduced_utility_gradient(x_free, free, template, *var_args):
+    '''
+       the gradient with respect to the free variables only, the columns of the pinned variables are not computed
+    '''
+    return analytic_utility_gradient( expand_plan(x_free, free, template), *var_args, columns=free )[free]
+
+def tied_directions(representative):
+    '''
+       the [x_dim] x [groups] matrix mapping the mitigations of a tied plan (one per group of nodes with the same
+       representative, see tree_model.pruned_representatives) to the full plan, and the representative of each group
+    '''
+    groups = np.unique(representative)
+    directions = (representative[:, None] == groups[None, :]).astype(float)
+    return directions, groups
+
+def tied_utility_function(x_tied, directions, *var_args):
+    '''
+       the objective as a function of the mitigations of a tied plan, see tied_directions
+    '''
+    return utility_function( np.dot(directions, x_tied), *var_args )
+
+def tied_utility_gradient(x_tied, directions, *var_args):
+    '''
+       the gradient with respect to the mitigations of a tied plan, one column of the analytic gradient per group
+    '''
+    columns = directions.shape[1]
+    return analytic_utility_gradient( np.dot(directions, x_tied), *var_args, columns=range(0, columns), directions=directions )[:columns].copy()
+
+def leaf_problem(x, *var_args):
+    '''
+       the parts of the utility of the last decision period that do not depend on its own mitigation, see leaf_utility:
+       the leaf nodes (the decision nodes of the last period, leaf i leads to final state i), their damage, and the
+       average mitigation of their final states as base + weight * leaf mitigation
+    '''
+    my_tree = var_args[0]
+    my_damage_model = var_args[1]
+    leaves = np.arange(my_tree.decision_period_pointer[my_tree.nperiods-1], my_tree.x_dim)
+    final_nodes = my_tree.x_dim + np.arange(my_tree.final_states)
+    x = np.asarray(x, dtype=float)
+    average_mitigation = np.array([ my_damage_model.average_mitigation(x, node) for node in leaves ])
+    weight = my_damage_model.d_average_mitigation(final_nodes[0], leaves[0])
+    base = np.array([ my_damage_model.average_mitigation(x, node) for node in final_nodes ]) - weight * x[leaves]
+    return { 'leaves' : leaves, 'final_nodes' : final_nodes, 'average_mitigation' : average_mitigation,
+             'damage' : my_damage_model.damage_function_array(average_mitigation, leaves), 'base' : base, 'weight' : weight }
+
+def leaf_utility(x_leaf, problem, *var_args):
+    '''
+       the utility at the last decision period of every leaf for the leaf mitigations x_leaf, all leaves in one pass (see leaf_problem)
+       the last period does not branch and consumption grows geometrically from the leaf node to the final state over its steps
+       sub-intervals, so the recursion of period_utility has the closed form
+       U**r = (1-b)*c**r*sum_i (b*q)**i + b**steps * U_final**r,  q = (c_final/c)**(r/steps)  (see consumption_aggregation)
+       the consumption epsilons of the term structure are zero
+    '''
+    my_tree = var_args[0]
+    my_damage_model = var_args[1]
+    my_cost_model = var_args[2]
+    period = my_tree.nperiods
+    r = ( 1.0 - 1.0 / my_tree.eis)
+    b = (1.0 - my_tree.time_pref)**(my_tree.utility_times[1] - my_tree.utility_times[0])
+    steps = int(round( (my_tree.decision_times[period] - my_tree.decision_times[period-1]) / my_tree.sub_interval_length ))
+    growth_term = (1. + my_tree.growth)
+
+    cost = my_cost_model.cost_by_state_array( x_leaf, problem['average_mitigation'], problem['leaves'] )
+    consumption = my_tree.potential_consumption[period-1] * (1. - problem['damage']) * (1. - cost)
+    final_damage = my_damage_model.damage_function_array( problem['base'] + problem['weight'] * x_leaf, problem['final_nodes'] )
+    final_consumption = my_tree.potential_consumption[period] * (1. - final_damage)
+
+    z = b * ( final_consumption / consumption )**(r/steps)
+    near_one = np.abs(1. - z) < 1.0e-12
+    geometric_sum = np.where( near_one, float(steps), (1. - z**steps) / np.where(near_one, 2., 1. - z) )
+    final_utility = (1. - b) * final_consumption**r / ( 1. - b * growth_term**r )
+    return ( (1. - b) * consumption**r * geometric_sum + b**steps * final_utility )**(1./r)
+
+def solve_leaves(x, lower, upper, *var_args, points=33, xtol=1.0e-10):
+    '''
+       the mitigation of the last decision period that maximizes utility given the rest of the plan x, within the bounds lower and upper
+       of the leaves; utility increases in the utility of every leaf, so each leaf is a one dimensional problem of its own:
+       the leaf utilities are evaluated for all leaves at once on a grid of points mitigations (the leaf utility need not be unimodal:
+       the cost has a kink at the backstop and damages decay above full mitigation), and a golden section search run on all leaves
+       in lockstep refines the grid cell of the best one
+    '''
+    problem = leaf_problem(x, *var_args)
+    nleaves = len(problem['leaves'])
+    grid = np.linspace(0., 1., points)
+    trials = lower[:,None] + (upper-lower)[:,None] * grid[None,:]
+    values = np.column_stack([ leaf_utility(trials[:,k], problem, *var_args) for k in range(0, points) ])
+    best = np.argmax(values, axis=1)
+    low = trials[ np.arange(nleaves), np.maximum(best-1, 0) ]
+    high = trials[ np.arange(nleaves), np.minimum(best+1, points-1) ]
+
+    ratio = (math.sqrt(5.) - 1.) / 2.
+    x_low = high - ratio * (high - low)
+    x_high = low + ratio * (high - low)
+    u_low = leaf_utility(x_low, problem, *var_args)
+    u_high = leaf_utility(x_high, problem, *var_args)
+    while np.max(high - low) > xtol :
+        move_up = u_high > u_low
+        low = np.where( move_up, x_low, low )
+        high = np.where( move_up, high, x_high )
+        x_next = np.where( move_up, low + ratio * (high - low), high - ratio * (high - low) )
+        u_next = leaf_utility(x_next, problem, *var_args)
+        x_low, x_high = np.where( move_up, x_high, x_next ), np.where( move_up, x_next, x_low )
+        u_low, u_high = np.where( move_up, u_high, u_next ), np.where( move_up, u_next, u_low )
+    x_leaf = .5 * (low + high)
+    ''' the grid points are candidates too, the search only improves on the best of them '''
+    u_leaf = leaf_utility(x_leaf, problem, *var_args)
+    return np.where( u_leaf >= values[ np.arange(nleaves), best ], x_leaf, trials[ np.arange(nleaves), best ] )
+
+def nested_plan(x_outer, lower, upper, *var_args):
+    '''
+       the full plan of the mitigations x_outer of the decision periods before the last, the mitigation of the last period
+       solved by solve_leaves within its bounds lower and upper
+    '''
+    x = np.concatenate( [ np.asarray(x_outer, dtype=float), np.asarray(lower, dtype=float) ] )
+    x[len(x_outer):] = solve_leaves(x, lower, upper, *var_args)
+    return x
+
+def nested_utility_and_gradient(x_outer, lower, upper, *var_args):
+    '''
+       the objective as a function of the mitigations before the last decision period, the last period optimal given them
+       (see nested_plan), and its gradient, together so the leaves are solved once per point; the leaves are optimal, so by
+       the envelope theorem their response to x_outer does not change the objective to first order and the gradient is the one
+       of the objective in the outer columns at the nested plan
+    '''
+    x = nested_plan(x_outer, lower, upper, *var_args)
+    outer = np.arange(len(x_outer))
+    util = utility_function(x, *var_args)
+    return util, analytic_utility_gradient(x, *var_args, columns=outer)[outer].copy()
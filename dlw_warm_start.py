@@ -0,0 +1,169 @@
+'''
+   Warm-start store for the dlw climate model
+   every solved mitigation plan is kept, indexed by the normalized vector of model parameters that produced it,
+   and the plan solved at the nearest parameters (or a distance weighted blend of the nearest plans)
+   is returned as the initial guess for a new optimization
+'''
+import os
+import numpy as np
+from dlw_log import LogUtil # For logging. Currently DEBUG use only.
+try:
+    import fcntl # For locking the store file between concurrent jobs (not available on Windows).
+except ImportError:
+    fcntl = None
+
+log = LogUtil() # Instanciate the logger utility.
+
+'''
+    the parameters in the key and the scale used to normalize each one,
+    a difference of one scale unit in any parameter counts as the same distance
+'''
+parameter_names = [ 'tp1', 'ra', 'eis', 'growth', 'time_pref', 'peak_temp', 'disaster_tail',
+                    'g', 'a', 'join', 'max_price', 'teconst', 'tescale' ]
+parameter_scales = np.array([ 10., 2., .25, .005, .005, 2., 5.,
+                              20., .5, 500., 500., .5, .5 ])
+
+def model_parameters(my_tree, my_damage_model, my_cost_model):
+    '''Collects the parameters that determine the optimal plan
+
+    Parameters
+    ----------
+    my_tree : tree object
+        the tree structure and the utility parameters
+
+    my_damage_model : damage class object
+        the damage parameters
+
+    my_cost_model : cost class object
+        the cost parameters
+
+    Returns
+    -------
+    params : dict
+        parameter name -> value, plus the tree shape in 'nperiods' and 'final_states'
+    '''
+    params = { 'tp1' : my_tree.decision_times[1], 'ra' : my_tree.ra, 'eis' : my_tree.eis, 'growth' : my_tree.growth,
+               'time_pref' : my_tree.time_pref, 'peak_temp' : my_damage_model.peak_temp, 'disaster_tail' : my_damage_model.disaster_tail,
+               'g' : my_cost_model.g, 'a' : my_cost_model.a, 'join' : my_cost_model.join, 'max_price' : my_cost_model.max_price,
+               'teconst' : my_cost_model.teconst, 'tescale' : my_cost_model.tescale,
+               'nperiods' : my_tree.nperiods, 'final_states' : my_tree.final_states }
+    return params
+
+class warm_start_store(object):
+    '''Persistent store of solved mitigation plans, one file per tree shape
+    '''
+    def __init__(self, output_path, nperiods, final_states, x_dim, neighbors=1):
+        '''Initializes the store and loads the plans already solved for this tree shape
+
+        Parameters
+        ----------
+        output_path : string
+            directory of the store files
+
+        nperiods : integer
+            number of periods in the tree
+
+        final_states : integer
+            number of final states in the tree
+
+        x_dim : integer
+            length of the mitigation plans
+
+        neighbors : integer
+            number of nearest plans blended into the initial guess, 1 returns the nearest plan
+        '''
+        self.filename = os.path.join(output_path, 'warm_start_%i_%i.npz' % (nperiods, final_states))
+        self.x_dim = x_dim
+        self.neighbors = neighbors
+        self.load()
+
+    def load(self):
+        '''    read the solved plans from the store file, an absent file is an empty store
+        '''
+        self.keys = np.zeros([0, len(parameter_names)])
+        self.plans = np.zeros([0, self.x_dim])
+        self.fits = np.zeros(0)
+        if os.path.exists(self.filename):
+            with np.load(self.filename) as store:
+                self.keys = store['keys']
+                self.plans = store['plans']
+                self.fits = store['fits']
+        self.key_norms = (self.keys**2).sum(axis=1)
+        log.log_it("warm start store %s holds %i plans" % (self.filename, len(self.fits)))
+
+    def normalize(self, params):
+        '''    the key of a parameter dict: parameter values divided by their scales
+        '''
+        return np.array([ params[name] for name in parameter_names ], dtype=float) / parameter_scales
+
+    def nearest(self, params):
+        '''Finds the initial guess for a new optimization
+
+        Parameters
+        ----------
+        params : dict
+            model parameters, as returned by model_parameters
+
+        Returns
+        -------
+        guess : float vector
+            the plan solved at the nearest parameters, or the inverse distance weighted average of the
+            nearest "neighbors" plans, None if the store is empty
+
+        distance : float
+            normalized distance to the nearest solved plan
+        '''
+        if len(self.fits) == 0 :
+            return None, None
+        key = self.normalize(params)
+        distance = np.sqrt( np.maximum( self.key_norms - 2.*np.dot(self.keys, key) + np.dot(key, key), 0. ) )
+        neighbors = min( self.neighbors, len(distance) )
+        if neighbors == 1 :
+            nearest = np.argmin(distance)
+            return self.plans[nearest].copy(), distance[nearest]
+        nearest = np.argpartition(distance, neighbors-1)[:neighbors]
+        if distance[nearest].min() == 0. :
+            best = nearest[ np.argmin(distance[nearest]) ]
+            return self.plans[best].copy(), 0.
+        weights = 1. / distance[nearest]
+        guess = np.dot(weights, self.plans[nearest]) / weights.sum()
+        return guess, distance[nearest].min()
+
+    def add(self, params, plan, fit):
+        '''Adds a solved plan to the store and writes the store file
+            the file is re-read under a lock first, so plans added by concurrent jobs are kept
+
+        Parameters
+        ----------
+        params : dict
+            model parameters, as returned by model_parameters
+
+        plan : float vector
+            the optimal mitigation plan
+
+        fit : float
+            the value of the objective (negative utility) at plan
+        '''
+        key = self.normalize(params)
+        with open(self.filename + '.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            self.load()
+            same = np.where( (self.keys == key).all(axis=1) )[0]
+            if len(same) > 0 :
+                ''' a plan for these parameters is already stored, keep the better one '''
+                if fit < self.fits[same[0]] :
+                    self.plans[same[0]] = plan
+                    self.fits[same[0]] = fit
+            else :
+                self.keys = np.vstack( [self.keys, key] )
+                self.plans = np.vstack( [self.plans, np.asarray(plan, dtype=float)] )
+                self.fits = np.append( self.fits, fit )
+                self.key_norms = np.append( self.key_norms, np.dot(key, key) )
+            temp_filename = self.filename + '.%i.tmp' % os.getpid()
+            with open(temp_filename, 'wb') as f:
+                np.savez(f, keys=self.keys, plans=self.plans, fits=self.fits)
+            os.replace(temp_filename, self.filename)
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        log.log_it("warm start store %s now holds %i plans" % (self.filename, len(self.fits)))
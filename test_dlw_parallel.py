@@ -0,0 +1,28 @@
+'''
+   tests of the parallel evaluations of dlw_parallel
+'''
+import numpy as np
+import pytest
+import dlw_utility as fm
+import dlw_parallel
+from conftest import build_models
+
+@pytest.mark.parametrize('split_period', [ 1, 2 ])
+def test_subtree_evaluation_matches_serial_exactly(run_dir, split_period):
+    args = build_models()
+    my_tree = args[0]
+    x = np.random.RandomState(2).uniform(.3, 1.1, my_tree.x_dim)
+    fit = fm.utility_function(x, *args)
+    grad = fm.analytic_utility_gradient(x, *args).copy()
+    consumption = my_tree.consumption_by_state.copy()
+    utility = my_tree.utility_by_state.copy()
+    evaluation = dlw_parallel.subtree_evaluation(*args, split_period=split_period, processes=2)
+    try:
+        my_tree.consumption_by_state[:] = 0.
+        my_tree.utility_by_state[:] = 0.
+        assert evaluation.utility(x) == fit
+        assert np.array_equal(evaluation.gradient(x), grad)
+        assert np.array_equal(my_tree.consumption_by_state, consumption)
+        assert np.array_equal(my_tree.utility_by_state, utility)
+    finally:
+        evaluation.close()
@@ -0,0 +1,73 @@
+'''
+   tests of the utility recursion and its gradients
+'''
+import numpy as np
+import dlw_utility as fm
+from dlw_optimize_class import optimize_plan
+from conftest import build_models
+
+def central_difference(f, x, delta=1.0e-6):
+    '''    central difference gradient of f at x
+    '''
+    grad = np.zeros(len(x))
+    for n in range(0, len(x)):
+        step = np.zeros(len(x))
+        step[n] = delta
+        grad[n] = ( f(x + step) - f(x - step) ) / (2.*delta)
+    return grad
+
+def test_tied_gradient_matches_finite_differences(run_dir):
+    args = build_models(prob_scale=1.5)
+    my_tree = args[0]
+    representative = my_tree.pruned_representatives(.1)
+    directions, groups = fm.tied_directions(representative)
+    assert 0 < len(groups) < my_tree.x_dim
+    x_tied = np.random.RandomState(2).uniform(.3, 1.1, len(groups))
+    fm.tied_utility_function(x_tied, directions, *args)
+    grad = fm.tied_utility_gradient(x_tied, directions, *args)
+    numerical = central_difference(lambda x : fm.tied_utility_function(x, directions, *args), x_tied)
+    assert np.allclose(grad, numerical, rtol=1.0e-5, atol=1.0e-8)
+
+def test_trinomial_gradient_matches_finite_differences(run_dir):
+    args = build_models(nperiods=3, branching=3, decision_times=[ 0, 30, 185, 385 ])
+    x = np.random.RandomState(2).uniform(.3, 1.1, args[0].x_dim)
+    fm.utility_function(x, *args)
+    grad = fm.analytic_utility_gradient(x, *args).copy()
+    numerical = central_difference(lambda x : fm.utility_function(x, *args), x)
+    assert np.allclose(grad, numerical, rtol=1.0e-5, atol=1.0e-8)
+
+def test_utility_steps_aggregation_is_exact(run_dir):
+    args = build_models(utility_steps=[ 385 ] * 4)
+    my_tree = args[0]
+    my_optimization = optimize_plan(my_tree=my_tree)
+    x = np.random.RandomState(2).uniform(.3, 1.1, my_tree.x_dim)
+    error = my_optimization.utility_grid_error(x, *args[1:])
+    assert error['utility_nodes'] < error['uniform_utility_nodes']
+    assert abs(error['utility_error']) < 1.0e-12
+    assert error['gradient_error'] < 1.0e-12
+
+def test_nested_leaves_are_optimal(models):
+    my_tree = models[0]
+    outer_nodes = my_tree.decision_period_pointer[my_tree.nperiods-1]
+    lower = np.zeros(my_tree.x_dim - outer_nodes)
+    upper = np.zeros(my_tree.x_dim - outer_nodes) + 3.
+    x_outer = np.random.RandomState(2).uniform(.3, 1.1, outer_nodes)
+    x = fm.nested_plan(x_outer, lower, upper, *models)
+    assert np.array_equal(x[:outer_nodes], x_outer)
+    fit = fm.utility_function(x, *models)
+    grad = fm.analytic_utility_gradient(x, *models).copy()
+    leaf_grad = grad[outer_nodes:]
+    x_leaf = x[outer_nodes:]
+    ''' with these bounds every leaf is interior, where the gradient vanishes '''
+    assert np.all( (x_leaf > lower + 1.0e-6) & (x_leaf < upper - 1.0e-6) )
+    assert np.all( np.abs(leaf_grad) < 1.0e-6 )
+    ''' no leaf can improve on its own: the objective (negative utility) does not decrease when one leaf moves '''
+    for leaf in range(0, len(x_leaf)):
+        for step in [ -1.0e-3, 1.0e-3 ]:
+            moved = x.copy()
+            moved[outer_nodes+leaf] = np.clip(moved[outer_nodes+leaf] + step, lower[leaf], upper[leaf])
+            assert fm.utility_function(moved, *models) >= fit - 1.0e-12
+    ''' the nested objective is the objective at the nested plan, its gradient the outer columns of the gradient there '''
+    nested_fit, nested_grad = fm.nested_utility_and_gradient(x_outer, lower, upper, *models)
+    assert nested_fit == fit
+    assert np.array_equal(nested_grad, grad[:outer_nodes])